@@ -3,23 +3,41 @@ Car Stock Management System - Hybrid Cloud Storage
 نظام إدارة مخزون السيارات - تخزين هجين (تليجرام + ImgBB)
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Depends, Header, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Depends, Header, Query, Response, Body
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse, RedirectResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.datastructures import Headers
 import httpx
 import json
 import os
 import io
 import base64
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, List, Literal, Union
+from pydantic import BaseModel, StrictInt, model_validator
 from dotenv import load_dotenv
 import asyncio
 from pathlib import Path
 import hashlib
 import secrets
+import threading
+import time
+import functools
+import copy
+import collections
+import sqlite3
+import re
+import bisect
+import heapq
+import itertools
+import csv
+import codecs
+import concurrent.futures
+import shutil
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
 
 # Load .env from project root
 env_path = Path(__file__).parent.parent / ".env"
@@ -161,6 +179,186 @@ def require_permission(permission: str):
 # Cache Management
 # ================================
 
+# لقطة المنتجات في الذاكرة (مفتاحها رقم المنتج بعد التطبيع)
+# تُحدّث مباشرة عند الإضافة/التعديل/الحذف وتُعاد قراءتها من Convex بعد انتهاء المدة
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "30"))
+
+_catalog_snapshot: dict = {}
+_catalog_loaded_at: float = 0.0
+_catalog_version: int = 0  # يزيد مع كل كتابة على اللقطة
+# فهرس رقم المنتج -> _id في Convex (يبقى صالحاً بعد انتهاء مدة اللقطة)
+_product_ids: dict = {}
+_catalog_lock = threading.RLock()
+
+# فهارس مشتقة من اللقطة (بحث، ترتيب، إحصائيات...) تُحدّث تدريجياً مع كل تغيير.
+# كل فهرس يوفر: reset(products) و upsert(key, old, new) و remove(key, old)
+# upsert/remove تُستدعى تحت _catalog_lock، لذا القراءة منها يجب أن تكون تحت نفس القفل.
+# reset يُنفذ خارج القفل على نسخة من الفهرس (copy.copy) ثم تُبدّل حالتها تحته،
+# لذا يجب أن يبني حاويات جديدة بدل تفريغ الحاويات الحالية.
+catalog_listeners: list = []
+# آخر _catalog_version كتب كل مفتاح (إضافة/تعديل/حذف) حتى لا يعيده جلب بدأ قبلها
+_written_versions: dict = {}
+
+def _notify_listeners(event: str, *args):
+    for listener in catalog_listeners:
+        try:
+            getattr(listener, event)(*args)
+        except Exception as e:
+            print(f"Catalog index error ({type(listener).__name__}.{event}): {e}")
+
+class SingleFlight:
+    """دمج الطلبات المتزامنة لنفس المفتاح في عملية جلب واحدة
+
+    أول مستدعٍ ينفذ الدالة، والبقية ينتظرون نتيجته (أو خطأه) بدل تكرار الطلب.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+
+    def stats(self) -> dict:
+        return {"executed": self.executed, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+catalog_fetches = SingleFlight()
+
+def catalog_is_fresh() -> bool:
+    """هل اللقطة الحالية صالحة؟"""
+    if CATALOG_CACHE_TTL <= 0 or not _catalog_loaded_at:
+        return False
+    return (time.monotonic() - _catalog_loaded_at) < CATALOG_CACHE_TTL
+
+def invalidate_catalog_cache():
+    """إبطال اللقطة لإجبار القراءة التالية على الذهاب إلى Convex"""
+    global _catalog_loaded_at
+    with _catalog_lock:
+        _catalog_loaded_at = 0.0
+
+def _rebuilt_listener(listener, products: dict):
+    fresh = copy.copy(listener)
+    fresh.reset(products)
+    return fresh
+
+def _snapshot_replace(products: dict, version: int):
+    """استبدال اللقطة بنتيجة جلب كامل بدأ عند _catalog_version = version
+
+    المفاتيح التي كُتبت محلياً بعد بدء الجلب تبقى كما هي (الجلب قد لا يتضمنها).
+    بناء الفهارس أو حساب الفروقات يتم خارج القفل، وتحته يُطبق الناتج فقط.
+    """
+    global _catalog_snapshot, _catalog_loaded_at, _product_ids, _written_versions
+    with _catalog_lock:
+        previous = dict(_catalog_snapshot)
+    if previous:
+        # تحديث الفهارس بالفروقات فقط بدل إعادة بنائها
+        changed = [(key, previous.get(key), product) for key, product in products.items() if previous.get(key) != product]
+        removed = [(key, old) for key, old in previous.items() if key not in products]
+    else:
+        fresh = [_rebuilt_listener(listener, products) for listener in catalog_listeners]
+    with _catalog_lock:
+        recent = {key for key, written in _written_versions.items() if written > version}
+        final = dict(products)
+        for key in recent:
+            if key in _catalog_snapshot:
+                final[key] = _catalog_snapshot[key]
+            else:
+                final.pop(key, None)
+        if previous:
+            # المفاتيح غير الحديثة لم تتغير في اللقطة منذ نسخها، والحديثة تبقى كما هي
+            for key, old, product in changed:
+                if key not in recent:
+                    _notify_listeners("upsert", key, old, product)
+            for key, old in removed:
+                if key not in recent:
+                    _notify_listeners("remove", key, old)
+        else:
+            for listener, rebuilt in zip(catalog_listeners, fresh):
+                for key in recent:
+                    old, new = products.get(key), final.get(key)
+                    if new is None and old is not None:
+                        rebuilt.remove(key, old)
+                    elif new is not None and new != old:
+                        rebuilt.upsert(key, old, new)
+                vars(listener).update(vars(rebuilt))
+        _catalog_snapshot = final
+        _product_ids = {pn: p["_id"] for pn, p in final.items() if p.get("_id")}
+        _written_versions = {key: written for key, written in _written_versions.items() if written > version}
+        _catalog_loaded_at = time.monotonic()
+
+def _snapshot_put(product: dict):
+    global _catalog_version
+    # المنتجات داخل اللقطة لا تُعدّل في مكانها - نستبدلها بنسخة جديدة دائماً
+    key = normalize_pn(product.get("product_number", ""))
+    with _catalog_lock:
+        _catalog_version += 1
+        _written_versions[key] = _catalog_version
+        old = _catalog_snapshot.get(key)
+        _catalog_snapshot[key] = dict(product)
+        if product.get("_id"):
+            _product_ids[key] = product["_id"]
+        _notify_listeners("upsert", key, old, _catalog_snapshot[key])
+
+def _snapshot_patch(product_number: str, patch: dict):
+    global _catalog_version
+    key = normalize_pn(product_number)
+    # تغيير رقم المنتج ينقل المدخل إلى المفتاح الجديد
+    new_key = normalize_pn(patch["product_number"]) if patch.get("product_number") else key
+    with _catalog_lock:
+        _catalog_version += 1
+        if new_key != key and key in _product_ids:
+            _product_ids[new_key] = _product_ids.pop(key)
+        current = _catalog_snapshot.pop(key, None) if new_key != key else _catalog_snapshot.get(key)
+        if current is None:
+            return
+        _written_versions[key] = _written_versions[new_key] = _catalog_version
+        # إعادة التسمية إلى رقم موجود تستبدل مدخله، فيُمرر للفهارس كقيمة سابقة
+        replaced = _catalog_snapshot.get(new_key) if new_key != key else None
+        _catalog_snapshot[new_key] = {**current, **patch}
+        if new_key != key:
+            _notify_listeners("remove", key, current)
+            _notify_listeners("upsert", new_key, replaced, _catalog_snapshot[new_key])
+        else:
+            _notify_listeners("upsert", key, current, _catalog_snapshot[key])
+
+def _snapshot_remove(product_number: str):
+    global _catalog_version
+    key = normalize_pn(product_number)
+    with _catalog_lock:
+        _catalog_version += 1
+        _written_versions[key] = _catalog_version
+        old = _catalog_snapshot.pop(key, None)
+        _product_ids.pop(key, None)
+        if old is not None:
+            _notify_listeners("remove", key, old)
+
 # ================================
 # Database Abstraction (Convex)
 # ================================
@@ -183,6 +381,183 @@ except Exception as e:
     print(f"Error initializing Convex: {e}")
     convex_client = None
 
+# عميل Convex متزامن (كل استدعاء طلب HTTP/WebSocket يحجب الخيط)، لذلك تُنفّذ
+# استدعاءاته من الـ endpoints في مجموعة خيوط محدودة بدل حلقة الأحداث
+CONVEX_MAX_CONCURRENCY = max(1, int(os.getenv("CONVEX_MAX_CONCURRENCY", "8")))
+
+def _new_db_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=CONVEX_MAX_CONCURRENCY, thread_name_prefix="convex")
+
+# يُغلق عند إيقاف السيرفر ويُعاد إنشاؤه عند التشغيل التالي (الاختبارات وأدوات القياس تشغل التطبيق أكثر من مرة)
+_db_executor: Optional[ThreadPoolExecutor] = _new_db_executor()
+_main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+async def run_db(func, *args, **kwargs):
+    """تشغيل دالة وصول للبيانات (متزامنة) خارج حلقة الأحداث"""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = _new_db_executor()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def spawn(coro):
+    """جدولة coroutine على حلقة الأحداث الرئيسية، حتى من داخل خيوط run_db"""
+    try:
+        return asyncio.get_running_loop().create_task(coro)
+    except RuntimeError:
+        if _main_loop is None:
+            coro.close()
+            return None
+        return asyncio.run_coroutine_threadsafe(coro, _main_loop)
+
+# تجميع كتابات Convex المتقاربة: نافذة الانتظار (ملي ثانية) والحد الأقصى للعمليات في الطلب الواحد
+CONVEX_BATCH_WINDOW_MS = float(os.getenv("CONVEX_BATCH_WINDOW_MS", "10"))
+CONVEX_BATCH_MAX = max(1, int(os.getenv("CONVEX_BATCH_MAX", "50")))
+
+class MutationBatcher:
+    """دمج كتابات المنتجات في طلب واحد (products:applyBatch)
+
+    العمليات التي تصل خلال النافذة (أو حتى الحد الأقصى) تُرسل معاً بالترتيب، وتعديلات
+    نفس الـ _id المنتظرة تُدمج في تعديل واحد. كل مستدعٍ ينتظر نتيجة عمليته (أو خطأها) فقط.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = max(0.0, window)
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = []   # [{"op": {...}, "futures": [...]}]
+        self._updates = {}   # _id -> التعديل المنتظر الذي يمكن الدمج فيه
+        self._thread = None
+        self._sending = False
+        # كل التعديلات على stats تحت self._cond (من المستدعين ومن خيط الإرسال)
+        self.stats = {"batches": 0, "ops": 0, "merged": 0, "failed": 0}
+
+    def submit(self, op: dict) -> concurrent.futures.Future:
+        return self.submit_many([op])[0]
+
+    def submit_many(self, ops: list) -> list:
+        """إضافة عدة عمليات معاً (تدخل نفس الدفعة ما دامت ضمن الحد الأقصى)"""
+        futures = []
+        with self._cond:
+            for op in ops:
+                futures.append(self._enqueue(op))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="convex-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return futures
+
+    def _enqueue(self, op: dict) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        entry = self._updates.get(op["id"]) if op["op"] == "update" else None
+        if entry is not None:
+            entry["op"]["updates"].update(op["updates"])
+            entry["futures"].append(future)
+            self.stats["merged"] += 1
+            return future
+        entry = {"op": {**op, "updates": dict(op["updates"])} if op["op"] == "update" else op, "futures": [future]}
+        self._pending.append(entry)
+        if op["op"] == "update":
+            self._updates[op["id"]] = entry
+        elif op.get("id"):
+            # ما يأتي بعد الحذف لا يُدمج فيما قبله
+            self._updates.pop(op["id"], None)
+        return future
+
+    def call(self, op: dict):
+        """إرسال عملية وانتظار نتيجتها (من خيوط run_db)"""
+        return self.submit(op).result()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {**self.stats, "pending": len(self._pending)}
+
+    def drain(self, timeout: float) -> bool:
+        """انتظار إرسال كل العمليات المنتظرة (عند الإيقاف)، يُرجع False إذا انتهت المهلة"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"Convex batcher: {len(self._pending)} pending ops not sent before shutdown")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _take(self) -> list:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            self._sending = True
+            for entry in batch:
+                op = entry["op"]
+                if op["op"] == "update" and self._updates.get(op["id"]) is entry:
+                    del self._updates[op["id"]]
+            return batch
+
+    def _run(self):
+        # خيط واحد يرسل الدفعات بالتتابع، فتُطبق العمليات على نفس المنتج بترتيب وصولها
+        while True:
+            batch = self._take()
+            try:
+                self._send(batch)
+            except Exception as e:
+                # لا نترك مستدعياً ينتظر للأبد، والخيط يكمل مع الدفعة التالية
+                print(f"Convex batcher error: {e}")
+                self._fail(batch, e)
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def _send(self, batch: list):
+        with self._cond:
+            self.stats["batches"] += 1
+            self.stats["ops"] += len(batch)
+        self._apply(batch)
+
+    def _apply(self, batch: list):
+        try:
+            results = convex_client.mutation("products:applyBatch", {"ops": [entry["op"] for entry in batch]})
+        except Exception as e:
+            if len(batch) > 1:
+                # رفض الدفعة كاملة (مثلاً وسائط غير صالحة لعملية واحدة): كل عملية وحدها
+                for entry in batch:
+                    self._apply([entry])
+                return
+            results = [{"ok": False, "error": str(e)}]
+        if not isinstance(results, list) or len(results) != len(batch):
+            # نُفذت الدفعة لكن لا نعرف نتيجة كل عملية: لا نعيد إرسالها
+            count = len(results) if isinstance(results, list) else type(results).__name__
+            results = [{"ok": False, "error": f"applyBatch returned {count} results for {len(batch)} ops"}] * len(batch)
+        for entry, result in zip(batch, results):
+            if not isinstance(result, dict):
+                result = {"ok": False, "error": f"Invalid applyBatch result: {result!r}"}
+            if result.get("ok"):
+                for future in entry["futures"]:
+                    future.set_result(result.get("value"))
+            else:
+                self._fail([entry], Exception(result.get("error") or "Convex mutation failed"))
+
+    def _fail(self, batch: list, error: Exception):
+        for entry in batch:
+            futures = [future for future in entry["futures"] if not future.done()]
+            if futures:
+                with self._cond:
+                    self.stats["failed"] += 1
+            for future in futures:
+                future.set_exception(error)
+
+convex_batcher = MutationBatcher(CONVEX_BATCH_WINDOW_MS / 1000, CONVEX_BATCH_MAX)
+
 def normalize_pn(pn):
     arabic_digits = "٠١٢٣٤٥٦٧٨٩"
     western_digits = "0123456789"
@@ -192,22 +567,36 @@ def normalize_pn(pn):
     return res
 
 def load_cache() -> dict:
-    """تحميل المنتجات من Convex"""
-    if not convex_client:
-        return {}
-    try:
-        # Get all products without filter to avoid issues with some Convex clients
-        products = convex_client.query("products:getProducts", {})
-        
+    """تحميل المنتجات (من اللقطة في الذاكرة، أو من Convex عند انتهاء صلاحيتها)
 
-        # Convert list to dict keyed by normalized product_number
-        return {normalize_pn(p.get('product_number', '')): p for p in products if p.get('product_number') is not None}
-    except Exception as e:
-        print(f"Convex Query Error: {e}")
+    يُرجع نسخة من القاموس، أما المنتجات نفسها فمشتركة مع اللقطة:
+    من يريد تعديل منتج يأخذ نسخة منه أولاً.
+    """
+    if not ensure_catalog():
         return {}
+    with _catalog_lock:
+        return dict(_catalog_snapshot)
 
-def save_cache(data: dict):
-    pass
+def ensure_catalog() -> bool:
+    """تحديث اللقطة من Convex إذا انتهت صلاحيتها (بدون نسخها)"""
+    if not convex_client:
+        return False
+    if not catalog_is_fresh():
+        try:
+            # الطلبات المتزامنة تشترك في جلب واحد
+            catalog_fetches.do("products:getProducts", _fetch_catalog)
+        except Exception as e:
+            print(f"Convex Query Error: {e}")
+            return False
+    return True
+
+def _fetch_catalog():
+    version = _catalog_version
+    # Get all products without filter to avoid issues with some Convex clients
+    products = convex_client.query("products:getProducts", {})
+
+    # Convert list to dict keyed by normalized product_number
+    _snapshot_replace({normalize_pn(p.get('product_number', '')): p for p in products if p.get('product_number') is not None}, version)
 
 def add_product_to_db(product: dict):
     if not convex_client: return
@@ -216,87 +605,1577 @@ def add_product_to_db(product: dict):
     if "quantity" in p: p["quantity"] = int(p["quantity"])
     if "price_iqd" in p: p["price_iqd"] = float(p["price_iqd"])
     if "wholesale_price_iqd" in p: p["wholesale_price_iqd"] = float(p["wholesale_price_iqd"])
-    convex_client.mutation("products:addProduct", p)
+    new_id = convex_batcher.call({"op": "add", "product": p})
+
+    # نفس القيم الافتراضية التي يضعها addProduct في Convex
+    p.setdefault("original_quantity", p.get("quantity", 0))
+    p.setdefault("status", "متوفر" if p.get("quantity", 0) > 0 else "نفذ")
+    p.setdefault("last_update", datetime.now().isoformat())
+    if new_id:
+        p["_id"] = new_id
+    if p.get("product_number") is not None:
+        _snapshot_put(p)
+
+def resolve_product_id(product_number: str) -> Optional[str]:
+    """إيجاد _id المنتج في Convex: من الفهرس أولاً ثم باستعلام مفهرس برقم المنتج"""
+    key = normalize_pn(product_number)
+    with _catalog_lock:
+        product_id = _product_ids.get(key)
+    if product_id:
+        return product_id
+    target = convex_client.query("products:getProductByNumber", {"product_number": str(product_number)})
+    if not target:
+        return None
+    with _catalog_lock:
+        _product_ids[key] = target["_id"]
+    return target["_id"]
+
+def _forget_product_id(product_number: str):
+    with _catalog_lock:
+        _product_ids.pop(normalize_pn(product_number), None)
+
+def _with_product_id(product_number: str, fn):
+    """تنفيذ عملية على _id المنتج، مع إعادة المحاولة مرة واحدة إذا كان الـ _id المحفوظ قديماً"""
+    product_id = resolve_product_id(product_number)
+    if not product_id:
+        return False
+    try:
+        fn(product_id)
+    except Exception as e:
+        if "not found" not in str(e).lower():
+            raise
+        # المنتج حُذف أو أُعيد إنشاؤه خارج هذا الخادم
+        _forget_product_id(product_number)
+        fresh_id = resolve_product_id(product_number)
+        if not fresh_id or fresh_id == product_id:
+            return False
+        fn(fresh_id)
+    return True
 
 def update_product_in_db(product_number: str, updates: dict):
     if not convex_client: return
     try:
-        all_products = convex_client.query("products:getProducts", {}) 
-        # Safely find target using .get()
-        target = next((p for p in all_products if str(p.get('product_number')) == str(product_number)), None)
-        
-        if target:
-            patch = {}
-            # Only take valid fields for the updates object in Convex TS
-            # EXCLUDING product_number because it's the identifier and might cause validation errors if sent in updates
-            valid_fields = ["product_name", "car_name", "model_number", "type", "quantity", "price_iqd", "wholesale_price_iqd", "image", "status", "last_update", "message_id"]
-            for k in valid_fields:
-                if k in updates and updates[k] is not None:
-                    val = updates[k]
-                    if k == "quantity": val = int(val)
-                    if k in ["price_iqd", "wholesale_price_iqd"]: val = float(val)
-                    patch[k] = val
-            
-            # Use target["_id"] directly, assuming it's a string ID or the client handles it
-            convex_client.mutation("products:updateProduct", {"id": target["_id"], "updates": patch})
+        patch = {}
+        # Only take valid fields for the updates object in Convex TS
+        valid_fields = ["product_name", "car_name", "model_number", "type", "quantity", "price_iqd", "wholesale_price_iqd", "image", "thumbnail", "status", "last_update", "message_id", "telegram_file_id", "telegram_photo"]
+        for k in valid_fields:
+            if k in updates and updates[k] is not None:
+                val = updates[k]
+                if k == "quantity": val = int(val)
+                if k in ["price_iqd", "wholesale_price_iqd"]: val = float(val)
+                patch[k] = val
+
+        # product_number is the identifier: only send it when it is being renamed
+        new_number = updates.get("product_number")
+        if new_number is not None and normalize_pn(new_number) != normalize_pn(product_number):
+            patch["product_number"] = normalize_pn(new_number)
+
+        applied = _with_product_id(
+            product_number,
+            lambda product_id: convex_batcher.call({"op": "update", "id": product_id, "updates": patch})
+        )
+        if not applied:
+            return
+
+        # updateProduct في Convex يشتق الحالة من الكمية دائماً
+        with _catalog_lock:
+            current = _catalog_snapshot.get(normalize_pn(product_number), {})
+        quantity = patch.get("quantity", current.get("quantity", 0))
+        patch["status"] = "متوفر" if quantity > 0 else "نفذ"
+        patch.setdefault("last_update", datetime.now().isoformat())
+        _snapshot_patch(product_number, patch)
     except Exception as e:
         print(f"Error in update_product_in_db: {e}")
         raise e
 
+def _snapshot_apply_adjustment(product_number: str, state: dict):
+    _snapshot_patch(product_number, {
+        "quantity": state["quantity"],
+        "status": state["status"],
+        "last_update": state["last_update"]
+    })
+
+def _check_delta(delta):
+    if isinstance(delta, bool) or not isinstance(delta, int):
+        raise ValueError(f"delta must be an integer, got {delta!r}")
+
+def adjust_quantity_in_db(product_number: str, delta: int = 0, clear: bool = False) -> Optional[dict]:
+    """تغيير الكمية ذرياً في Convex (لا تنزل تحت الصفر والحالة تُشتق في نفس الخطوة)
+
+    طلب واحد بدل قراءة المنتج وتعديله وكتابته، فلا يبيع موظفان نفس القطعة الأخيرة مرتين.
+    يُرجع {quantity, status, last_update, applied, message_id} أو None إذا لم يوجد المنتج.
+    """
+    if not convex_client: return None
+    _check_delta(delta)
+    state = {}
+    applied = _with_product_id(
+        product_number,
+        lambda product_id: state.update(convex_batcher.call({"op": "adjust", "id": product_id, "delta": delta, "clear": clear}))
+    )
+    if not applied:
+        return None
+    _snapshot_apply_adjustment(product_number, state)
+    return state
+
+def adjust_quantities_in_db(movements: list) -> list:
+    """عدة تغييرات كمية ذرية في دفعة واحدة: [(رقم المنتج، delta، clear)] -> [الحالة الجديدة أو Exception]"""
+    results = [None] * len(movements)
+    targets = []
+    for i, (product_number, delta, clear) in enumerate(movements):
+        _check_delta(delta)
+        try:
+            product_id = resolve_product_id(product_number)
+        except Exception as e:
+            results[i] = e
+            continue
+        if not product_id:
+            results[i] = LookupError("المنتج غير موجود")
+            continue
+        targets.append((i, product_id))
+
+    futures = convex_batcher.submit_many([
+        {"op": "adjust", "id": product_id, "delta": movements[i][1], "clear": movements[i][2]}
+        for i, product_id in targets
+    ])
+    latest = {}
+    for (i, _), future in zip(targets, futures):
+        product_number = movements[i][0]
+        try:
+            results[i] = future.result()
+        except Exception as e:
+            if "not found" in str(e).lower():
+                _forget_product_id(product_number)
+            results[i] = e
+            continue
+        latest[product_number] = results[i]
+    # العمليات طُبقت بالترتيب، فآخر حالة لكل منتج هي الحالية
+    for product_number, state in latest.items():
+        _snapshot_apply_adjustment(product_number, state)
+    return results
+
 def delete_product_from_db(product_number: str):
     if not convex_client: return
     try:
-        all_products = convex_client.query("products:getProducts", {}) 
-        target = next((p for p in all_products if str(p.get('product_number')) == str(product_number)), None)
-        if target:
-            convex_client.mutation("products:deleteProduct", {"id": target["_id"]})
+        _with_product_id(
+            product_number,
+            lambda product_id: convex_batcher.call({"op": "delete", "id": product_id})
+        )
+        _snapshot_remove(product_number)
     except Exception as e:
         print(f"Error in delete_product_from_db: {e}")
         raise e
 
 
+# ================================
+# Search Index
+# ================================
+
+# توحيد أشكال الحروف العربية: أ/إ/آ/ٱ -> ا، ة -> ه، ى -> ي، حذف التطويل والتشكيل
+_ARABIC_DIACRITICS = re.compile("[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED]")
+_ARABIC_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه",
+    "ى": "ي",
+    "ـ": None,
+    **{a: w for a, w in zip("٠١٢٣٤٥٦٧٨٩", "0123456789")}
+})
+
+def normalize_search_text(text) -> str:
+    """تطبيع النص للبحث (يُطبق نفسه على الفهرس وعلى الاستعلام)"""
+    text = _ARABIC_DIACRITICS.sub("", str(text or "")).translate(_ARABIC_FOLD)
+    return " ".join(text.lower().split())
+
+class SearchIndex:
+    """فهرس ثلاثيات (trigrams) مقلوب على حقول المنتج مع ترتيب النتائج حسب الصلة"""
+
+    # وزن كل حقل في ترتيب النتائج
+    FIELDS = {"product_number": 5, "product_name": 4, "car_name": 3, "model_number": 2, "type": 2}
+
+    def __init__(self):
+        self._docs = {}        # key -> {field: normalized text}
+        self._doc_grams = {}   # key -> set of grams
+        self._postings = {}    # gram -> set of keys
+
+    @staticmethod
+    def _grams(text: str) -> set:
+        if len(text) < 3:
+            return {text} if text else set()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def reset(self, products: dict):
+        self._docs = {}
+        self._doc_grams = {}
+        self._postings = {}
+        for key, product in products.items():
+            self.upsert(key, None, product)
+
+    def upsert(self, key: str, old: Optional[dict], new: dict):
+        fields = {f: normalize_search_text(new.get(f, "")) for f in self.FIELDS}
+        if self._docs.get(key) == fields:
+            return
+        grams = set()
+        for text in fields.values():
+            grams |= self._grams(text)
+        previous = self._doc_grams.get(key, set())
+        for gram in previous - grams:
+            bucket = self._postings.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._postings[gram]
+        for gram in grams - previous:
+            self._postings.setdefault(gram, set()).add(key)
+        self._docs[key] = fields
+        self._doc_grams[key] = grams
+
+    def remove(self, key: str, old: Optional[dict]):
+        for gram in self._doc_grams.pop(key, set()):
+            bucket = self._postings.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._postings[gram]
+        self._docs.pop(key, None)
+
+    def _candidates(self, query: str) -> set:
+        if len(query) >= 3:
+            buckets = sorted((self._postings.get(g, set()) for g in self._grams(query)), key=len)
+            if not buckets or not buckets[0]:
+                return set()
+            result = set(buckets[0])
+            for bucket in buckets[1:]:
+                result &= bucket
+                if not result:
+                    break
+            return result
+        # استعلام قصير: كل ثلاثية تحتويه تدل على مستند يحتويه
+        result = set()
+        for gram, keys in self._postings.items():
+            if query in gram:
+                result |= keys
+        return result
+
+    def search(self, query: str) -> dict:
+        """إرجاع {key: score} للمنتجات المطابقة"""
+        query = normalize_search_text(query)
+        if not query:
+            return {}
+        scores = {}
+        for key in self._candidates(query):
+            score = 0
+            for field, weight in self.FIELDS.items():
+                text = self._docs[key][field]
+                if query not in text:
+                    continue
+                if text == query:
+                    score += weight * 3
+                elif text.startswith(query):
+                    score += weight * 2
+                else:
+                    score += weight
+            if score:
+                scores[key] = score
+        return scores
+
+search_index = SearchIndex()
+catalog_listeners.append(search_index)
+
+class SuggestIndex:
+    """مصفوفات مرتبة (bisect) لإكمال أسماء السيارات والأنواع والقطع أثناء الكتابة
+
+    كل قيمة تُفهرس من بداية كل كلمة فيها، فـ "كام" تقترح "تويوتا كامري".
+    """
+
+    FIELDS = ("car_name", "type", "product_name")
+
+    def __init__(self):
+        self._entries = {f: [] for f in self.FIELDS}  # sorted [(word-start suffix, value key)]
+        self._counts = {f: {} for f in self.FIELDS}   # value key -> number of products
+        self._labels = {f: {} for f in self.FIELDS}   # value key -> {original spelling: count}
+
+    @staticmethod
+    def _suffixes(value_key: str) -> list:
+        words = value_key.split(" ")
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def _add(self, field: str, value):
+        value_key = normalize_search_text(value)
+        if not value_key:
+            return
+        counts = self._counts[field]
+        if value_key not in counts:
+            counts[value_key] = 0
+            for suffix in self._suffixes(value_key):
+                bisect.insort(self._entries[field], (suffix, value_key))
+        counts[value_key] += 1
+        labels = self._labels[field].setdefault(value_key, {})
+        labels[value] = labels.get(value, 0) + 1
+
+    def _discard(self, field: str, value):
+        value_key = normalize_search_text(value)
+        counts = self._counts[field]
+        if value_key not in counts:
+            return
+        counts[value_key] -= 1
+        labels = self._labels[field][value_key]
+        labels[value] = labels.get(value, 1) - 1
+        if labels[value] <= 0:
+            del labels[value]
+        if counts[value_key] <= 0:
+            del counts[value_key]
+            del self._labels[field][value_key]
+            entries = self._entries[field]
+            for suffix in self._suffixes(value_key):
+                i = bisect.bisect_left(entries, (suffix, value_key))
+                if i < len(entries) and entries[i] == (suffix, value_key):
+                    del entries[i]
+
+    def reset(self, products: dict):
+        self._entries = {f: [] for f in self.FIELDS}
+        self._counts = {f: {} for f in self.FIELDS}
+        self._labels = {f: {} for f in self.FIELDS}
+        for key, product in products.items():
+            self.upsert(key, None, product)
+
+    def upsert(self, key: str, old: Optional[dict], new: dict):
+        for field in self.FIELDS:
+            old_value = old.get(field) if old else None
+            new_value = new.get(field)
+            if old_value == new_value:
+                continue
+            if old_value:
+                self._discard(field, old_value)
+            if new_value:
+                self._add(field, new_value)
+
+    def remove(self, key: str, old: Optional[dict]):
+        for field in self.FIELDS:
+            if old and old.get(field):
+                self._discard(field, old[field])
+
+    def suggest(self, field: str, prefix: str, limit: int = 10) -> list:
+        counts = self._counts[field]
+        prefix = normalize_search_text(prefix)
+        if prefix:
+            entries = self._entries[field]
+            lo = bisect.bisect_left(entries, (prefix,))
+            hi = bisect.bisect_left(entries, (prefix + "\uffff",))
+            candidates = {value_key for _, value_key in entries[lo:hi]}
+        else:
+            candidates = counts.keys()
+        top = heapq.nsmallest(limit, candidates, key=lambda k: (-counts[k], k))
+        return [
+            {"value": max(self._labels[field][k].items(), key=lambda x: x[1])[0], "count": counts[k]}
+            for k in top
+        ]
+
+suggest_index = SuggestIndex()
+catalog_listeners.append(suggest_index)
+
+# مفاتيح الترتيب لكل وضع (رقم المنتج في النهاية لكسر التعادل وجعل الترتيب ثابتاً)
+PRODUCT_SORT_KEYS = {
+    "price": lambda p, pn: (p.get("price_iqd") or 0, pn),
+    "quantity": lambda p, pn: (p.get("quantity") or 0, pn),
+    "name": lambda p, pn: (p.get("product_name") or "", pn),
+    "last_update": lambda p, pn: (p.get("last_update") or "", pn),
+}
+
+class SortIndex:
+    """مصفوفة مرتبة لكل وضع ترتيب تُحدّث مع كل تغيير
+
+    الصفحة المرتبة ونطاق السعر يصبحان تقطيعاً بـ bisect بدل ترتيب كل المنتجات في كل طلب.
+    """
+
+    def __init__(self, sort_keys: dict):
+        self._sort_keys = sort_keys
+        self._arrays = {mode: [] for mode in sort_keys}   # sorted [(value, pn)]
+        self._current = {mode: {} for mode in sort_keys}  # pn -> مفتاحه الحالي
+
+    def __len__(self):
+        return len(self._current["last_update"])
+
+    @staticmethod
+    def _delete(array: list, sort_key: tuple):
+        i = bisect.bisect_left(array, sort_key)
+        if i < len(array) and array[i] == sort_key:
+            del array[i]
+
+    def reset(self, products: dict):
+        self._current = {mode: {key: key_fn(p, key) for key, p in products.items()} for mode, key_fn in self._sort_keys.items()}
+        self._arrays = {mode: sorted(current.values()) for mode, current in self._current.items()}
+
+    def upsert(self, key: str, old: Optional[dict], new: dict):
+        for mode, key_fn in self._sort_keys.items():
+            sort_key = key_fn(new, key)
+            previous = self._current[mode].get(key)
+            if previous == sort_key:
+                continue
+            if previous is not None:
+                self._delete(self._arrays[mode], previous)
+            bisect.insort(self._arrays[mode], sort_key)
+            self._current[mode][key] = sort_key
+
+    def remove(self, key: str, old: Optional[dict]):
+        for mode in self._sort_keys:
+            previous = self._current[mode].pop(key, None)
+            if previous is not None:
+                self._delete(self._arrays[mode], previous)
+
+    def range(self, mode: str, low=None, high=None) -> tuple:
+        """حدود [lo, hi) للمفاتيح التي قيمتها بين low و high (شاملة)"""
+        array = self._arrays[mode]
+        lo = 0 if low is None else bisect.bisect_left(array, (low,))
+        hi = len(array) if high is None else bisect.bisect_right(array, (high, "\U0010ffff"))
+        return lo, max(lo, hi)
+
+    def walk(self, mode: str, lo: int, hi: int, reverse: bool = False, after: tuple = None):
+        """المرور على المفاتيح ضمن [lo, hi) بالترتيب المطلوب، بدءاً مما بعد مؤشر الصفحة"""
+        array = self._arrays[mode]
+        if reverse:
+            if after is not None:
+                hi = min(hi, bisect.bisect_left(array, after))
+            for i in range(hi - 1, lo - 1, -1):
+                yield array[i]
+        else:
+            if after is not None:
+                lo = max(lo, bisect.bisect_right(array, after))
+            for i in range(lo, hi):
+                yield array[i]
+
+sort_index = SortIndex(PRODUCT_SORT_KEYS)
+catalog_listeners.append(sort_index)
+
+# حدود شرائح السعر في عدادات الفلاتر (كل شريحة [حد, الحد التالي))
+FACET_PRICE_BUCKETS = [float(x) for x in os.getenv("FACET_PRICE_BUCKETS", "0,10000,25000,50000,100000,250000").split(",") if x.strip()]
+
+class FacetIndex:
+    """خرائط بتات (أعداد Python) لكل سيارة ونوع وحالة مخزون وشريحة سعر
+
+    كل منتج له رقم صف ثابت، وعدد نتائج أي فلتر هو عدد البتات بعد AND للخرائط.
+    """
+
+    def __init__(self, price_buckets: list):
+        self.price_buckets = sorted(price_buckets) or [0.0]
+        self.reset({})
+
+    def reset(self, products: dict):
+        self._rows = {}      # key -> row
+        self._free = []
+        self._next_row = 0
+        self._facets = {}    # key -> (car, type, status, bucket)
+        self.all = 0
+        self.cars = {}       # car_name -> bitmap
+        self.types = {}      # type -> bitmap
+        self.status = {"available": 0, "out_of_stock": 0}
+        self.buckets = [0] * len(self.price_buckets)
+        for key, product in products.items():
+            self.upsert(key, None, product)
+
+    def _bucket(self, price) -> int:
+        return max(0, bisect.bisect_right(self.price_buckets, price) - 1)
+
+    def _facets_of(self, product: dict) -> tuple:
+        quantity = product.get("quantity", 0) or 0
+        status = "available" if quantity > 0 else ("out_of_stock" if quantity == 0 else None)
+        return (product.get("car_name", ""), product.get("type", ""), status, self._bucket(product.get("price_iqd") or 0))
+
+    def _toggle(self, bit: int, facets: tuple):
+        car, ptype, status, bucket = facets
+        self.cars[car] = self.cars.get(car, 0) ^ bit
+        if not self.cars[car]:
+            del self.cars[car]
+        self.types[ptype] = self.types.get(ptype, 0) ^ bit
+        if not self.types[ptype]:
+            del self.types[ptype]
+        if status:
+            self.status[status] ^= bit
+        self.buckets[bucket] ^= bit
+
+    def upsert(self, key: str, old: Optional[dict], new: dict):
+        facets = self._facets_of(new)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._free.pop() if self._free else self._next_row
+            if row == self._next_row:
+                self._next_row += 1
+            self._rows[key] = row
+            self.all |= 1 << row
+        elif self._facets[key] == facets:
+            return
+        else:
+            self._toggle(1 << row, self._facets[key])
+        self._toggle(1 << row, facets)
+        self._facets[key] = facets
+
+    def remove(self, key: str, old: Optional[dict]):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        self._toggle(1 << row, self._facets.pop(key))
+        self.all &= ~(1 << row)
+        self._free.append(row)
+
+    def bitmap_of(self, keys) -> int:
+        bitmap = 0
+        for key in keys:
+            row = self._rows.get(key)
+            if row is not None:
+                bitmap |= 1 << row
+        return bitmap
+
+    @staticmethod
+    def matching(bitmaps: dict, needle: str) -> int:
+        """اتحاد خرائط القيم التي تحتوي النص (نفس فلترة /api/products)"""
+        needle = needle.lower()
+        result = 0
+        for value, bitmap in bitmaps.items():
+            if needle in (value or "").lower():
+                result |= bitmap
+        return result
+
+    def price_range(self, low: float = None, high: float = None, sorted_prices: "SortIndex" = None) -> int:
+        """المنتجات ضمن [low, high]: الشرائح الكاملة من الخرائط، وأطراف النطاق من فهرس السعر"""
+        result = 0
+        edges = self.price_buckets[1:] + [None]
+        for i, (start, end) in enumerate(zip(self.price_buckets, edges)):
+            # الشريحة الأولى تضم أيضاً ما هو أقل من حدها
+            start = None if i == 0 else start
+            if (end is not None and low is not None and end <= low) or (high is not None and start is not None and start > high):
+                continue
+            if (low is None or (start is not None and start >= low)) and (high is None or (end is not None and end <= high)):
+                result |= self.buckets[i]
+                continue
+            lo, hi = sorted_prices.range(
+                "price",
+                start if low is None or (start is not None and start > low) else low,
+                end if high is None or (end is not None and end < high) else high
+            )
+            result |= self.bitmap_of(k[-1] for k in sorted_prices.walk("price", lo, hi))
+        return result
+
+def popcount(bitmap: int) -> int:
+    return bin(bitmap).count("1")
+
+facet_index = FacetIndex(FACET_PRICE_BUCKETS)
+catalog_listeners.append(facet_index)
+
+# ================================
+# Statistics Aggregates
+# ================================
+
+# كل كم ثانية تُعاد الإحصائيات من الصفر لتصحيح أي انحراف في المجمّعات
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "600"))
+
+class StatsAggregate:
+    """إحصائيات لوحة التحكم محدّثة بالفروقات مع كل إضافة/تعديل/حذف
+
+    قراءتها لا تمر على المنتجات: المجاميع جاهزة، وأكثر المبيعات والمخزون المنخفض
+    مصفوفات مرتبة يُقرأ طرفها فقط.
+    """
+
+    TOP_N = 10
+
+    def __init__(self):
+        self.reset({})
+
+    def reset(self, products: dict):
+        self.total_products = 0
+        self.available_products = 0
+        self.total_value = 0
+        self.total_items = 0
+        self.by_type = {}
+        self.by_car = {}
+        for key, product in products.items():
+            self._apply(product, 1)
+        # تُبنى المصفوفات مرة واحدة بدل إدخال كل عنصر بـ insort
+        self._sold = sorted(k for k in (self._sold_key(key, p) for key, p in products.items()) if k)
+        self._quantities = sorted(self._quantity_key(key, p) for key, p in products.items())
+
+    @staticmethod
+    def _sold_key(key: str, product: dict):
+        # أكثر المنتجات مبيعاً (الأقل كمية من الأصلي)
+        if (product.get("original_quantity") or 0) <= 0:
+            return None
+        return ((product.get("original_quantity") or 0) - (product.get("quantity") or 0), key)
+
+    @staticmethod
+    def _quantity_key(key: str, product: dict):
+        return (product.get("quantity") or 0, key)
+
+    def _apply(self, product: dict, sign: int):
+        quantity = product.get("quantity") or 0
+        value = (product.get("price_iqd") or 0) * quantity
+        self.total_products += sign
+        if quantity > 0:
+            self.available_products += sign
+        self.total_value += sign * value
+        self.total_items += sign * quantity
+
+        ptype = product.get("type", "غير محدد")
+        entry = self.by_type.setdefault(ptype, {"count": 0, "quantity": 0, "value": 0})
+        entry["count"] += sign
+        entry["quantity"] += sign * quantity
+        entry["value"] += sign * value
+        if entry["count"] <= 0:
+            del self.by_type[ptype]
+
+        car = product.get("car_name", "غير محدد")
+        entry = self.by_car.setdefault(car, {"count": 0, "quantity": 0})
+        entry["count"] += sign
+        entry["quantity"] += sign * quantity
+        if entry["count"] <= 0:
+            del self.by_car[car]
+
+    @staticmethod
+    def _move(array: list, old_key, new_key):
+        if old_key == new_key:
+            return
+        if old_key is not None:
+            i = bisect.bisect_left(array, old_key)
+            if i < len(array) and array[i] == old_key:
+                del array[i]
+        if new_key is not None:
+            bisect.insort(array, new_key)
+
+    def upsert(self, key: str, old: Optional[dict], new: dict):
+        if old is not None:
+            self._apply(old, -1)
+        self._apply(new, 1)
+        self._move(self._sold, self._sold_key(key, old) if old else None, self._sold_key(key, new))
+        self._move(self._quantities, self._quantity_key(key, old) if old else None, self._quantity_key(key, new))
+
+    def remove(self, key: str, old: Optional[dict]):
+        if old is None:
+            return
+        self._apply(old, -1)
+        self._move(self._sold, self._sold_key(key, old), None)
+        self._move(self._quantities, self._quantity_key(key, old), None)
+
+    def report(self, products: dict) -> dict:
+        """شكل الاستجابة القديم لـ /api/stats (المنتجات تُستخدم فقط لجلب أسماء العناصر المعروضة)"""
+        top_selling = [products[key] for _, key in reversed(self._sold[-self.TOP_N:]) if key in products]
+        lowest = [products[key] for _, key in self._quantities[:self.TOP_N] if key in products]
+        return {
+            "overview": {
+                "total_products": self.total_products,
+                "available_products": self.available_products,
+                "out_of_stock": self.total_products - self.available_products,
+                "total_value": self.total_value,
+                "total_items": self.total_items,
+                "average_price": self.total_value / self.total_items if self.total_items > 0 else 0
+            },
+            "by_type": {k: dict(v) for k, v in self.by_type.items()},
+            "by_car": {k: dict(v) for k, v in sorted(self.by_car.items(), key=lambda x: x[1]["count"], reverse=True)[:self.TOP_N]},
+            "top_selling": [
+                {
+                    "product_number": p.get("product_number"),
+                    "product_name": p.get("product_name"),
+                    "sold": p.get("original_quantity", 0) - p.get("quantity", 0),
+                    "remaining": p.get("quantity", 0)
+                }
+                for p in top_selling
+            ],
+            "low_stock": [
+                {
+                    "product_number": p.get("product_number"),
+                    "product_name": p.get("product_name"),
+                    "quantity": p.get("quantity", 0)
+                }
+                for p in lowest
+                if p.get("quantity", 0) > 0 and p.get("quantity", 0) < 5
+            ]
+        }
+
+    def diff(self, other: "StatsAggregate") -> list:
+        """الفروقات بين هذه المجمّعات ومجمّعات أُعيد حسابها من الصفر"""
+        drift = []
+
+        def compare(field, maintained, recomputed):
+            if isinstance(maintained, (int, float)) and isinstance(recomputed, (int, float)):
+                same = abs(maintained - recomputed) <= 1e-6 * max(1, abs(recomputed))
+            else:
+                same = maintained == recomputed
+            if not same:
+                drift.append({"field": field, "maintained": maintained, "recomputed": recomputed})
+
+        for field in ("total_products", "available_products", "total_value", "total_items"):
+            compare(field, getattr(self, field), getattr(other, field))
+        for group in ("by_type", "by_car"):
+            mine, theirs = getattr(self, group), getattr(other, group)
+            for name in mine.keys() | theirs.keys():
+                for metric in (mine.get(name) or theirs.get(name)):
+                    compare(f"{group}.{name}.{metric}", (mine.get(name) or {}).get(metric, 0), (theirs.get(name) or {}).get(metric, 0))
+        compare("top_selling", [k for _, k in self._sold[-self.TOP_N:]], [k for _, k in other._sold[-self.TOP_N:]])
+        compare("low_stock", [k for _, k in self._quantities[:self.TOP_N]], [k for _, k in other._quantities[:self.TOP_N]])
+        return drift
+
+stats_aggregate = StatsAggregate()
+catalog_listeners.append(stats_aggregate)
+
+# نتيجة آخر مطابقة بين المجمّعات وإعادة الحساب الكاملة
+stats_drift = {"checks": 0, "drifted": 0, "last_checked": None, "last_drift_at": None, "last_drift": []}
+
+def reconcile_stats() -> list:
+    """إعادة حساب الإحصائيات من اللقطة ومقارنتها بالمجمّعات ثم تصحيحها"""
+    ensure_catalog()
+    with _catalog_lock:
+        recomputed = StatsAggregate()
+        recomputed.reset(_catalog_snapshot)
+        drift = stats_aggregate.diff(recomputed)
+        if drift:
+            stats_aggregate.reset(_catalog_snapshot)
+    now = datetime.now().isoformat()
+    stats_drift["checks"] += 1
+    stats_drift["last_checked"] = now
+    if drift:
+        stats_drift["drifted"] += 1
+        stats_drift["last_drift_at"] = now
+        stats_drift["last_drift"] = drift
+        print(f"Stats drift corrected ({len(drift)} fields): {drift[:5]}")
+    return drift
+
+async def stats_reconcile_loop():
+    """مطابقة دورية للإحصائيات"""
+    if STATS_RECONCILE_INTERVAL <= 0:
+        return
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            await run_db(reconcile_stats)
+        except Exception as e:
+            print(f"Stats reconcile error: {e}")
+
+
+# ================================
+# Columnar Catalog (optional, NumPy)
+# ================================
+
+# نسخة عمودية من اللقطة: الكمية والسعرين مصفوفات أرقام، والنوع والسيارة مرمّزة بقاموس.
+# التجميع والفلترة عليها عمليات متجهة بدل المرور على قواميس المنتجات.
+COLUMNAR_CATALOG = os.getenv("COLUMNAR_CATALOG", "false").lower() in ("1", "true", "yes")
+np = None
+if COLUMNAR_CATALOG:
+    try:
+        import numpy as np
+    except ImportError:
+        print("Warning: COLUMNAR_CATALOG is set but 'numpy' is not installed, using the dict catalog only")
+        COLUMNAR_CATALOG = False
+
+class ColumnarCatalog:
+    """أعمدة NumPy محدّثة مع كل تغيير في اللقطة (الصف المحذوف يُعاد استخدامه)"""
+
+    NUMERIC = {"quantity": "int64", "price_iqd": "float64", "wholesale_price_iqd": "float64"}
+    ENCODED = ("type", "car_name")
+
+    def __init__(self, capacity: int = 1024):
+        self.reset({}, capacity)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _allocate(self, capacity: int):
+        self._capacity = capacity
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._numeric = {f: np.zeros(capacity, dtype=t) for f, t in self.NUMERIC.items()}
+        self._codes = {f: np.full(capacity, -1, dtype=np.int32) for f in self.ENCODED}
+
+    def _grow(self):
+        old_valid, old_numeric, old_codes, size = self._valid, self._numeric, self._codes, self._size
+        self._allocate(self._capacity * 2)
+        self._valid[:size] = old_valid[:size]
+        for f in self.NUMERIC:
+            self._numeric[f][:size] = old_numeric[f][:size]
+        for f in self.ENCODED:
+            self._codes[f][:size] = old_codes[f][:size]
+
+    def _code(self, field: str, value) -> int:
+        codes = self._dictionary[field]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self._values[field])
+            self._values[field].append(value)
+        return code
+
+    @staticmethod
+    def _number(value, kind: str):
+        try:
+            return int(value or 0) if kind == "int64" else float(value or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def reset(self, products: dict, capacity: int = 1024):
+        self._rows = {}   # key -> row
+        self._free = []
+        self._size = len(products)
+        self._dictionary = {f: {} for f in self.ENCODED}  # value -> code
+        self._values = {f: [] for f in self.ENCODED}      # code -> value
+        self._allocate(max(capacity, self._size))
+        rows = list(products.items())
+        for row, (key, _) in enumerate(rows):
+            self._rows[key] = row
+        n = self._size
+        self._valid[:n] = True
+        for f, kind in self.NUMERIC.items():
+            self._numeric[f][:n] = np.fromiter((self._number(p.get(f), kind) for _, p in rows), dtype=kind, count=n)
+        for f in self.ENCODED:
+            self._codes[f][:n] = np.fromiter((self._code(f, p.get(f)) for _, p in rows), dtype=np.int32, count=n)
+
+    def upsert(self, key: str, old: Optional[dict], new: dict):
+        row = self._rows.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                if self._size == self._capacity:
+                    self._grow()
+                row = self._size
+                self._size += 1
+            self._rows[key] = row
+        self._valid[row] = True
+        for f, kind in self.NUMERIC.items():
+            self._numeric[f][row] = self._number(new.get(f), kind)
+        for f in self.ENCODED:
+            self._codes[f][row] = self._code(f, new.get(f))
+
+    def remove(self, key: str, old: Optional[dict]):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        self._valid[row] = False
+        for f in self.ENCODED:
+            self._codes[f][row] = -1
+        self._free.append(row)
+
+    def _column(self, field: str):
+        if field in self._numeric:
+            return self._numeric[field][:self._size]
+        return self._codes[field][:self._size]
+
+    def _matching_codes(self, field: str, needle: str):
+        needle = needle.lower()
+        return [code for code, value in enumerate(self._values[field]) if needle in (value or "").lower()]
+
+    def mask(self, car_name: str = None, product_type: str = None, status: str = None,
+             min_price: float = None, max_price: float = None):
+        """قناع منطقي للصفوف المطابقة لنفس فلاتر /api/products"""
+        mask = self._valid[:self._size].copy()
+        if car_name:
+            mask &= np.isin(self._column("car_name"), self._matching_codes("car_name", car_name))
+        if product_type:
+            mask &= np.isin(self._column("type"), self._matching_codes("type", product_type))
+        if status == "available":
+            mask &= self._column("quantity") > 0
+        elif status == "out_of_stock":
+            mask &= self._column("quantity") == 0
+        if min_price is not None:
+            mask &= self._column("price_iqd") >= min_price
+        if max_price is not None:
+            mask &= self._column("price_iqd") <= max_price
+        return mask
+
+    def count(self, **filters) -> int:
+        return int(np.count_nonzero(self.mask(**filters)))
+
+    def value_counts(self, field: str, mask=None) -> dict:
+        """عدد المنتجات لكل قيمة مرمّزة (bincount على الرموز)"""
+        if mask is None:
+            mask = self._valid[:self._size]
+        counts = np.bincount(self._column(field)[mask], minlength=len(self._values[field]))
+        result = {}
+        for code in np.flatnonzero(counts):
+            value = self._values[field][code]
+            value = "غير محدد" if value is None else value
+            result[value] = result.get(value, 0) + int(counts[code])
+        return result
+
+    def totals(self, mask=None) -> dict:
+        if mask is None:
+            mask = self._valid[:self._size]
+        quantity = self._column("quantity")[mask]
+        price = self._column("price_iqd")[mask]
+        return {
+            "count": int(np.count_nonzero(mask)),
+            "total_items": int(quantity.sum()),
+            "inventory_value": float(np.dot(price, quantity)),
+            "price_sum": float(price.sum()),
+            "wholesale_sum": float(self._column("wholesale_price_iqd")[mask].sum()),
+        }
+
+columnar_catalog = None
+if COLUMNAR_CATALOG:
+    columnar_catalog = ColumnarCatalog()
+    catalog_listeners.append(columnar_catalog)
+
+def catalog_with_statistics() -> tuple:
+    """نسخة من المنتجات مع إحصائيات النسخة الاحتياطية محسوبة على نفس الحالة
+
+    تُحسب بعمليات متجهة من الأعمدة إذا كانت مفعلة، وإلا بالمرور على المنتجات.
+    """
+    if not ensure_catalog():
+        cache = {}
+    else:
+        with _catalog_lock:
+            cache = dict(_catalog_snapshot)
+            if columnar_catalog is not None:
+                totals = columnar_catalog.totals()
+                return cache, {
+                    "total_value": totals["price_sum"],
+                    "total_wholesale_value": totals["wholesale_sum"],
+                    "products_by_type": columnar_catalog.value_counts("type")
+                }
+
+    statistics = {
+        "total_value": sum(p.get("price_iqd", 0) for p in cache.values()),
+        "total_wholesale_value": sum(p.get("wholesale_price_iqd", 0) for p in cache.values()),
+        "products_by_type": {}
+    }
+    
+    # إحصائيات حسب النوع
+    for product in cache.values():
+        ptype = product.get("type", "غير محدد")
+        statistics["products_by_type"][ptype] = statistics["products_by_type"].get(ptype, 0) + 1
+    return cache, statistics
+
+# ================================
+# Shared HTTP Clients
+# ================================
+
+# عملاء HTTP مشتركة طوال عمر التطبيق (اتصالات keep-alive بدل handshake جديد لكل طلب)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "15"))
+IMGBB_TIMEOUT = float(os.getenv("IMGBB_TIMEOUT", "45"))
+
+if HTTP2_ENABLED:
+    try:
+        import h2  # noqa: F401  (httpx[http2])
+    except ImportError:
+        print("Warning: HTTP2_ENABLED is set but the 'h2' package is missing, using HTTP/1.1")
+        HTTP2_ENABLED = False
+
+HTTP_UPSTREAMS = {
+    "telegram": TELEGRAM_TIMEOUT,
+    "imgbb": IMGBB_TIMEOUT,
+}
+
+_http_clients: dict = {}
+
+def _new_http_client(name: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_UPSTREAMS[name], connect=min(10.0, HTTP_UPSTREAMS[name])),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        http2=HTTP2_ENABLED
+    )
+
+def http_client(name: str) -> httpx.AsyncClient:
+    """العميل المشترك لخدمة خارجية ("telegram" أو "imgbb")"""
+    loop = asyncio.get_running_loop()
+    entry = _http_clients.get(name)
+    # الاتصالات مرتبطة بحلقة الأحداث التي أنشأتها
+    if entry is None or entry[1] is not loop or entry[0].is_closed:
+        entry = (_new_http_client(name), loop)
+        _http_clients[name] = entry
+    return entry[0]
+
+async def close_http_clients():
+    """إغلاق العملاء المشتركة وتحرير الاتصالات"""
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    for client, _loop in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            print(f"HTTP client close error: {e}")
+
 # ================================
 # Image Upload to ImgBB
 # ================================
 
-async def upload_image_to_imgbb(image_content: bytes) -> str:
-    """رفع الصورة إلى ImgBB وإرجاع الرابط"""
+# الحد الأقصى لحجم الصورة المرفوعة يُفرض أثناء القراءة على دفعات
+IMAGE_MAX_UPLOAD_MB = float(os.getenv("IMAGE_MAX_UPLOAD_MB", "15"))
+IMAGE_UPLOAD_CHUNK = 256 * 1024
+# هامش لحقول النموذج الأخرى وترويسات multipart فوق حجم الصورة
+IMAGE_UPLOAD_FORM_OVERHEAD = 64 * 1024
+# رفع الصورة في الخلفية: المنتج يُنشأ فوراً وحقل image يُملأ عند انتهاء الرفع
+IMAGE_BACKGROUND_UPLOAD = os.getenv("IMAGE_BACKGROUND_UPLOAD", "false").lower() in ("1", "true", "yes")
+UPLOADS_DIR = Path(__file__).parent / "uploads"
+PENDING_UPLOADS_DIR = UPLOADS_DIR / "pending"
+# نشر المنتجات في القناة كصور (sendPhoto) بدل نص فيه رابط ImgBB؛ مع هذا الوضع يصبح ImgBB اختيارياً
+TELEGRAM_PHOTO_MODE = os.getenv("TELEGRAM_PHOTO_MODE", "false").lower() in ("1", "true", "yes")
+# بدون ImgBB تُحفظ الصور هنا وتُخدم عبر /image/{image_id}
+LOCAL_IMAGES_DIR = UPLOADS_DIR / "images"
+LOCAL_IMAGE_PREFIX = "/image/"
+
+def imgbb_configured() -> bool:
+    return bool(IMGBB_API_KEY) and IMGBB_API_KEY != "ضع_مفتاح_imgbb_هنا"
+
+async def claim_upload(upload: UploadFile) -> tuple:
+    """أخذ ملف الصورة المرفوعة من UploadFile مع حساب بصمتها وحجمها
+
+    Starlette حفظ الصورة مسبقاً في ملف مؤقت: نقرؤه على دفعات للبصمة فقط (بدون نسخه)،
+    ثم نفصله عن UploadFile حتى لا يغلقه FastAPI مع انتهاء الطلب، فتصبح ملكيته للمستدعي.
+    يُرفض بمجرد تجاوز IMAGE_MAX_UPLOAD_MB (الطلبات التي ترسل Content-Length تُرفض قبل
+    ذلك في upload_size_middleware). يُرجع (الملف في بدايته، SHA-256، الحجم).
+    """
+    limit = int(IMAGE_MAX_UPLOAD_MB * 1024 * 1024)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await upload.read(IMAGE_UPLOAD_CHUNK)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail=f"حجم الصورة أكبر من {IMAGE_MAX_UPLOAD_MB:g} ميغابايت")
+        digest.update(chunk)
+    await upload.seek(0)
+    source, upload.file = upload.file, io.BytesIO()
+    return source, digest.hexdigest(), size
+
+async def upload_image_to_imgbb(image, filename: str) -> str:
+    """رفع الصورة إلى ImgBB وإرجاع الرابط
+
+    image بايتات أو ملف مفتوح: يُرسل كـ multipart ثنائي على دفعات (بدون base64).
+    filename يجب أن يكون فريداً لكل صورة لأن ImgBB يضعه في آخر الرابط.
+    """
     
-    if not IMGBB_API_KEY or IMGBB_API_KEY == "ضع_مفتاح_imgbb_هنا":
+    if not imgbb_configured():
         raise HTTPException(status_code=500, detail="ImgBB API Key غير مُعد. راجع ملف .env")
     
     try:
-        # تحويل الصورة إلى base64
-        image_base64 = base64.b64encode(image_content).decode('utf-8')
+        client = http_client("imgbb")
+        response = await client.post(
+            IMGBB_URL,
+            data={"key": IMGBB_API_KEY},
+            files={"image": (filename, image)}
+        )
         
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.post(
-                IMGBB_URL,
-                data={
-                    "key": IMGBB_API_KEY,
-                    "image": image_base64
-                }
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    return result["data"]["url"]
-                else:
-                    raise Exception(f"ImgBB Error: {result.get('error', {}).get('message', 'Unknown error')}")
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("success"):
+                return result["data"]["url"]
             else:
-                raise Exception(f"ImgBB HTTP Error: {response.status_code}")
+                raise Exception(f"ImgBB Error: {result.get('error', {}).get('message', 'Unknown error')}")
+        else:
+            raise Exception(f"ImgBB HTTP Error: {response.status_code}")
                 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"فشل رفع الصورة: {str(e)}")
 
+# ================================
+# Image Ingest (resize, thumbnails, dedupe)
+# ================================
+
+# صور الكاميرا (4-8 MB) تُصغّر وتُعاد ترميزها قبل الرفع، مع نسخة مصغرة لشبكة المخزون
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1600"))
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "320"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper()
+IMAGE_INDEX_FILE = os.getenv("IMAGE_INDEX_FILE", "images.db")
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    print("Warning: 'Pillow' is not installed, images are uploaded as-is without resizing or thumbnails")
+
+def _encode_image(img, max_dimension: int) -> bytes:
+    img = img.copy()
+    img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    options = {"quality": IMAGE_QUALITY}
+    if IMAGE_FORMAT == "WEBP":
+        options["method"] = 4
+    elif IMAGE_FORMAT == "JPEG":
+        options.update(optimize=True, progressive=True)
+    buf = io.BytesIO()
+    img.save(buf, format=IMAGE_FORMAT, **options)
+    return buf.getvalue()
+
+def prepare_image(source, size: int) -> tuple:
+    """تصغير الأبعاد وإعادة الترميز: يُرجع (الصورة الرئيسية، المصغرة أو None)
+
+    source ملف مفتوح على الصورة الأصلية؛ يُعاد كما هو إذا لم يكن هناك ما يُكسب.
+    """
+    if Image is None:
+        return source, None
+    try:
+        with Image.open(source) as img:
+            # فك ترميز JPEG بدقة أقل مباشرة (أسرع بكثير لصور الكاميرا الكبيرة)
+            img.draft("RGB", (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            original_size = img.size
+            img = ImageOps.exif_transpose(img)
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            if IMAGE_FORMAT == "JPEG" or not has_alpha:
+                img = img.convert("RGB")
+            elif img.mode != "RGBA":
+                img = img.convert("RGBA")
+            main = _encode_image(img, IMAGE_MAX_DIMENSION)
+            thumbnail = _encode_image(img, IMAGE_THUMBNAIL_SIZE)
+    except Exception as e:
+        print(f"Image decode error: {e}")
+        raise HTTPException(status_code=400, detail="ملف الصورة غير صالح")
+    # صورة صغيرة ومضغوطة أصلاً: لا فائدة من إعادة ترميزها
+    if len(main) >= size and max(original_size) <= IMAGE_MAX_DIMENSION:
+        source.seek(0)
+        return source, thumbnail
+    return main, thumbnail
+
+class ImageIndex:
+    """روابط الصور المرفوعة حسب بصمة المحتوى (SHA-256) حتى لا تُرفع نفس الصورة مرتين"""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                hash TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                thumbnail TEXT,
+                created_at TEXT NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.stats = {"uploaded": 0, "reused": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def get(self, digest: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT url, thumbnail FROM images WHERE hash=?", (digest,)).fetchone()
+        return {"image": row[0], "thumbnail": row[1]} if row else None
+
+    def put(self, digest: str, image: str, thumbnail: Optional[str]):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO images (hash, url, thumbnail, created_at) VALUES (?, ?, ?, ?)",
+                (digest, image, thumbnail, datetime.now().isoformat())
+            )
+
+image_index = ImageIndex(IMAGE_INDEX_FILE)
+
+def _image_extension(head: bytes) -> str:
+    if head.startswith(b"\xff\xd8"):
+        return "jpg"
+    if head.startswith(b"\x89PNG"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:4] == b"GIF8":
+        return "gif"
+    return "bin"
+
+def _store_local_image(name: str, image) -> str:
+    LOCAL_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LOCAL_IMAGES_DIR / name, "wb") as f:
+        if isinstance(image, bytes):
+            f.write(image)
+        else:
+            shutil.copyfileobj(image, f, IMAGE_UPLOAD_CHUNK)
+    return LOCAL_IMAGE_PREFIX + name
+
+async def _ingest_new_image(source, digest: str, size: int) -> dict:
+    loop = asyncio.get_running_loop()
+    main, thumbnail = await loop.run_in_executor(None, prepare_image, source, size)
+    if isinstance(main, bytes):
+        ext = IMAGE_FORMAT.lower()
+    else:
+        ext = _image_extension(main.read(16))
+        main.seek(0)
+    # أسماء فريدة مبنية على البصمة (ImgBB يبني رابط الصورة من اسم الملف)
+    main_name, thumbnail_name = f"{digest}.{ext}", f"{digest}-thumb.{IMAGE_FORMAT.lower()}"
+    if TELEGRAM_PHOTO_MODE and not imgbb_configured():
+        # بدون ImgBB: الصورة تُحفظ محلياً وتُرفع إلى التليجرام مرة واحدة عند النشر
+        urls = [await loop.run_in_executor(None, _store_local_image, main_name, main)]
+        if thumbnail:
+            urls.append(await loop.run_in_executor(None, _store_local_image, thumbnail_name, thumbnail))
+    else:
+        uploads = [upload_image_to_imgbb(main, main_name)]
+        if thumbnail:
+            uploads.append(upload_image_to_imgbb(thumbnail, thumbnail_name))
+        urls = await asyncio.gather(*uploads)
+    result = {"image": urls[0], "thumbnail": urls[1] if thumbnail else None}
+    await loop.run_in_executor(None, functools.partial(image_index.put, digest, **result))
+    image_index.stats["uploaded"] += 1
+    image_index.stats["bytes_in"] += size
+    image_index.stats["bytes_out"] += (len(main) if isinstance(main, bytes) else size) + len(thumbnail or b"")
+    return result
+
+async def _ingest_owned_image(source, digest: str, size: int) -> dict:
+    with source:
+        return await _ingest_new_image(source, digest, size)
+
+async def ingest_image(source, digest: str, size: int) -> dict:
+    """تجهيز صورة المنتج ورفعها: {"image": الرابط، "thumbnail": رابط المصغرة أو None}
+
+    source ملف مفتوح (من claim_upload) تنتقل ملكيته إلى هذه الدالة: المهمة التي ترفعه
+    تغلقه عند انتهائها حتى لو أُلغي الطلب الذي بدأها. نفس الصورة (نفس البصمة) تُعيد
+    الروابط المحفوظة، أو تنتظر رفعها الجاري، بدل رفعها إلى ImgBB مرة أخرى.
+    """
+    owner = False
+    try:
+        # SQLite على القرص: القراءة في خيط حتى لا تحجب حلقة الأحداث
+        task = image_index._inflight.get(digest)
+        known = None if task else await asyncio.get_running_loop().run_in_executor(None, image_index.get, digest)
+        # رفع متزامن لنفس الصورة: طلب واحد إلى ImgBB
+        task = None if known else image_index._inflight.get(digest)
+        if known is None and task is None:
+            task = asyncio.ensure_future(_ingest_owned_image(source, digest, size))
+            owner = True
+            image_index._inflight[digest] = task
+            task.add_done_callback(lambda _: image_index._inflight.pop(digest, None))
+    finally:
+        if not owner:
+            source.close()
+    if owner:
+        return await asyncio.shield(task)
+    image_index.stats["reused"] += 1
+    return known or await asyncio.shield(task)
+
+async def receive_product_image(upload: UploadFile) -> Optional[dict]:
+    """استلام صورة المنتج: رفعها الآن، أو حفظها للرفع في الخلفية (يُرجع None)"""
+    spool, digest, size = await claim_upload(upload)
+    if not IMAGE_BACKGROUND_UPLOAD:
+        return await ingest_image(spool, digest, size)
+    loop = asyncio.get_running_loop()
+    with spool:
+        known = await loop.run_in_executor(None, image_index.get, digest)
+        if known:
+            image_index.stats["reused"] += 1
+            return known
+        path = await loop.run_in_executor(None, _save_pending_upload, spool, digest)
+    return {"pending": str(path), "hash": digest}
+
+def _save_pending_upload(spool, digest: str) -> Path:
+    """نسخ الصورة إلى مجلد الرفع في الخلفية (يعمل في خيط)"""
+    PENDING_UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    path = PENDING_UPLOADS_DIR / f"{digest}-{secrets.token_hex(4)}"
+    with open(path, "wb") as f:
+        shutil.copyfileobj(spool, f, IMAGE_UPLOAD_CHUNK)
+    return path
+
+# ================================
+# Image Lookup & Local Cache
+# ================================
+
+# خدمة /image/{image_id} من نسخة محلية على القرص بدل إعادة التوجيه إلى ImgBB في كل مرة
+IMAGE_PROXY_CACHE = os.getenv("IMAGE_PROXY_CACHE", "false").lower() in ("1", "true", "yes")
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", str(UPLOADS_DIR / "cache")))
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", "200"))
+# روابط ImgBB لا يتغير محتواها، لذا يمكن للمتصفح الاحتفاظ بها طويلاً
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class ImageUrlIndex:
+    """فهرس معرّف الصورة -> رابطها، يُحدّث مع كل تغيير في اللقطة
+
+    المعرّف هو بصمة الرابط (أول 32 حرفاً من SHA-256)، أو أي جزء من مسار الرابط (معرف
+    ImgBB أو اسم الملف مع الامتداد أو بدونه) بشرط أن يطابق رابطاً واحداً فقط؛ الأسماء
+    المشتركة بين عدة روابط (مثل image.webp) لا تُخدم حتى لا تظهر صورة منتج آخر.
+    """
+
+    FIELDS = ("image", "thumbnail")
+
+    def __init__(self):
+        self._urls = {}  # image id -> {url: عدد المنتجات التي تستخدمه}
+
+    @staticmethod
+    def url_id(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+
+    @classmethod
+    def _ids(cls, url: str) -> set:
+        if url.startswith(LOCAL_IMAGE_PREFIX):
+            path = "/" + url[len(LOCAL_IMAGE_PREFIX):]
+        else:
+            path = url.split("://", 1)[-1].split("?", 1)[0]
+        ids = {cls.url_id(url)}
+        for segment in path.split("/")[1:]:
+            if segment:
+                ids.add(segment)
+                ids.add(segment.rsplit(".", 1)[0])
+        return ids
+
+    def _add(self, product: dict):
+        for field in self.FIELDS:
+            url = product.get(field)
+            if url:
+                for image_id in self._ids(url):
+                    urls = self._urls.setdefault(image_id, {})
+                    urls[url] = urls.get(url, 0) + 1
+
+    def _discard(self, product: dict):
+        for field in self.FIELDS:
+            url = product.get(field)
+            if url:
+                for image_id in self._ids(url):
+                    urls = self._urls.get(image_id)
+                    if not urls or url not in urls:
+                        continue
+                    urls[url] -= 1
+                    if not urls[url]:
+                        del urls[url]
+                    if not urls:
+                        del self._urls[image_id]
+
+    def reset(self, products: dict):
+        self._urls = {}
+        for product in products.values():
+            self._add(product)
+
+    def upsert(self, key, old, new):
+        if old is not None:
+            self._discard(old)
+        self._add(new)
+
+    def remove(self, key, old):
+        self._discard(old)
+
+    def get(self, image_id: str) -> Optional[str]:
+        urls = self._urls.get(image_id)
+        if urls and len(urls) == 1:
+            return next(iter(urls))
+        return None
+
+image_urls = ImageUrlIndex()
+catalog_listeners.append(image_urls)
+
+class ImageCache:
+    """نسخ محلية من الصور على القرص (الأقدم استخداماً يُحذف عند تجاوز الحد)
+
+    اسم الملف: بصمة الرابط ثم بصمة المحتوى، والأخيرة هي الـ ETag.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = {}     # url hash -> (path, etag)
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "evicted": 0}
+        # ملفات من تشغيل سابق: تُقرأ مرة واحدة عند البدء بدل البحث في المجلد مع كل طلب
+        if directory.exists():
+            for f in directory.iterdir():
+                if f.is_file() and not f.name.startswith(".") and "_" in f.name:
+                    key, etag = f.name.split("_", 1)
+                    self._files[key] = (f, etag)
+
+    @staticmethod
+    def _url_hash(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+
+    def lookup(self, url: str) -> Optional[tuple]:
+        key = self._url_hash(url)
+        entry = self._files.get(key)
+        if entry is None:
+            return None
+        if not entry[0].exists():
+            self._files.pop(key, None)
+            return None
+        return entry
+
+    async def fetch(self, url: str) -> tuple:
+        """تنزيل الصورة إلى القرص (مرة واحدة للطلبات المتزامنة) وإرجاع (المسار، ETag)"""
+        key = self._url_hash(url)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(url, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, url: str, key: str) -> tuple:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        tmp = self.directory / f".{key}.{secrets.token_hex(4)}.part"
+        client = http_client("imgbb")
+        if url.startswith("tg:"):
+            # نسخة التليجرام (file_id): رابط التنزيل يحتوي على توكن البوت فلا يُعاد توجيه المتصفح إليه أبداً
+            client = http_client("telegram")
+            resp = await client.post(f"{TG_URL}/getFile", json={"file_id": url[3:]})
+            file_path = (resp.json().get("result") or {}).get("file_path") if resp.status_code == 200 else None
+            if not file_path:
+                raise HTTPException(status_code=502, detail="تعذر جلب الصورة من التليجرام")
+            url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+        try:
+            async with client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    raise HTTPException(status_code=502, detail=f"تعذر جلب الصورة ({response.status_code})")
+                with open(tmp, "wb") as f:
+                    async for chunk in response.aiter_bytes(IMAGE_UPLOAD_CHUNK):
+                        digest.update(chunk)
+                        f.write(chunk)
+            etag = digest.hexdigest()[:32]
+            path = self.directory / f"{key}_{etag}"
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        self._files[key] = (path, etag)
+        self._evict()
+        return path, etag
+
+    def _evict(self):
+        files = [f for f in self.directory.iterdir() if f.is_file() and not f.name.startswith(".")]
+        total = sum(f.stat().st_size for f in files)
+        if total <= self.max_bytes:
+            return
+        # وقت آخر وصول يُحدّث عند كل خدمة من الكاش (touch)
+        for f in sorted(files, key=lambda f: f.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+            self._files.pop(f.name.split("_", 1)[0], None)
+            self.stats["evicted"] += 1
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, int(IMAGE_CACHE_MAX_MB * 1024 * 1024))
+
 # ================================
 # Telegram Operations
 # ================================
 
-async def send_to_telegram(product: dict, image_url: str = None, message_id: int = None, is_retry: bool = False):
-    """إرسال المنتج للتليجرام أو تحديثه وإرجاع message_id"""
-    
+# حدود الإرسال لكل محادثة (قيود Bot API: ~1 رسالة/ثانية و20 رسالة/دقيقة للقنوات والمجموعات)
+TELEGRAM_MIN_INTERVAL = float(os.getenv("TELEGRAM_MIN_INTERVAL", "1.0"))
+TELEGRAM_MAX_PER_MINUTE = int(os.getenv("TELEGRAM_MAX_PER_MINUTE", "20"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+
+class TelegramSendQueue:
+    """طابور إرسال لكل محادثة يحترم retry_after ويوزع الطلبات ضمن حدود التليجرام
+
+    عدة تعديلات (editMessage*) لنفس الرسالة تنتظر في الطابور تُدمج في طلب واحد
+    بآخر محتوى، وكل المستدعين يحصلون على نفس الاستجابة.
+    """
+
+    def __init__(self):
+        self._queues = {}         # chat_id -> deque of jobs
+        self._pending_edits = {}  # (method, chat_id, message_id) -> job
+        self._workers = {}        # chat_id -> asyncio.Task
+        self._sent_at = {}        # chat_id -> deque of send timestamps (last minute)
+        self._blocked_until = {}  # chat_id -> monotonic time from retry_after
+        self.stats = {"sent": 0, "coalesced": 0, "rate_limited": 0, "retried": 0}
+
+    async def call(self, method: str, json: dict = None, data: dict = None, files: dict = None, timeout: float = None) -> httpx.Response:
+        """إرسال طلب Bot API عبر الطابور وإرجاع الاستجابة النهائية"""
+        params = json if json is not None else (data or {})
+        chat_id = str(params.get("chat_id", ""))
+        key = None
+        if method.startswith("editMessage") and params.get("message_id") is not None:
+            key = (method, chat_id, int(params["message_id"]))
+
+        job = self._pending_edits.get(key) if key else None
+        if job is not None:
+            # تعديل أحدث لنفس الرسالة: نستبدل المحتوى وننتظر نفس النتيجة
+            job["kwargs"] = {"json": json, "data": data, "files": files, "timeout": timeout}
+            job["version"] += 1
+            self.stats["coalesced"] += 1
+        else:
+            job = {
+                "method": method,
+                "kwargs": {"json": json, "data": data, "files": files, "timeout": timeout},
+                "key": key,
+                "version": 0,
+                "future": asyncio.get_running_loop().create_future()
+            }
+            self._queues.setdefault(chat_id, collections.deque()).append(job)
+            if key:
+                self._pending_edits[key] = job
+            if chat_id not in self._workers:
+                self._workers[chat_id] = asyncio.create_task(self._run(chat_id))
+        return await asyncio.shield(job["future"])
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def _pace(self, chat_id: str):
+        sent = self._sent_at.setdefault(chat_id, collections.deque())
+        while True:
+            now = time.monotonic()
+            while sent and now - sent[0] >= 60:
+                sent.popleft()
+            wait = self._blocked_until.get(chat_id, 0) - now
+            if sent:
+                wait = max(wait, sent[-1] + TELEGRAM_MIN_INTERVAL - now)
+                if len(sent) >= TELEGRAM_MAX_PER_MINUTE:
+                    wait = max(wait, sent[0] + 60 - now)
+            if wait <= 0:
+                sent.append(now)
+                return
+            await asyncio.sleep(wait)
+
+    async def _run(self, chat_id: str):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                await self._send(chat_id, queue[0])
+        finally:
+            self._workers.pop(chat_id, None)
+
+    async def _send(self, chat_id: str, job: dict):
+        attempts = 0
+        while True:
+            await self._pace(chat_id)
+            version = job["version"]
+            kwargs = {k: v for k, v in job["kwargs"].items() if v is not None}
+            try:
+                resp = await http_client("telegram").post(f"{TG_URL}/{job['method']}", **kwargs)
+            except Exception as e:
+                self._finish(chat_id, job, error=e)
+                return
+            self.stats["sent"] += 1
+
+            if resp.status_code == 429 and attempts < TELEGRAM_MAX_RETRIES:
+                attempts += 1
+                self.stats["rate_limited"] += 1
+                try:
+                    retry_after = resp.json().get("parameters", {}).get("retry_after", 30)
+                except Exception:
+                    retry_after = 30
+                print(f"Telegram Rate Limit ({job['method']}): Retry after {retry_after}s")
+                self._blocked_until[chat_id] = time.monotonic() + float(retry_after)
+                continue
+            if resp.status_code >= 500 and attempts < TELEGRAM_MAX_RETRIES:
+                attempts += 1
+                self.stats["retried"] += 1
+                await asyncio.sleep(min(30, 2 ** attempts))
+                continue
+            if resp.status_code == 200 and job["version"] != version:
+                # وصل تعديل أحدث أثناء الإرسال - نرسله أيضاً
+                continue
+            self._finish(chat_id, job, result=resp)
+            return
+
+    def _finish(self, chat_id: str, job: dict, result=None, error=None):
+        queue = self._queues.get(chat_id)
+        if queue and queue[0] is job:
+            queue.popleft()
+        if job["key"] and self._pending_edits.get(job["key"]) is job:
+            del self._pending_edits[job["key"]]
+        if not job["future"].done():
+            if error is not None:
+                job["future"].set_exception(error)
+            else:
+                job["future"].set_result(result)
+
+    async def close(self):
+        """إيقاف العمال وإلغاء الطلبات المعلقة"""
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for queue in self._queues.values():
+            for job in queue:
+                if not job["future"].done():
+                    job["future"].cancel()
+            queue.clear()
+        self._pending_edits.clear()
+
+telegram_queue = TelegramSendQueue()
+
+def render_caption(product: dict, image_url: str = None, timestamp: bool = True) -> str:
+    """نص رسالة المنتج في القناة (HTML)؛ timestamp=False بدون سطر الوقت (للبصمة)"""
     caption = f"""
 🔧 <b>{product['product_name']}</b>
 ━━━━━━━━━━━━━━━━
@@ -310,76 +2189,686 @@ async def send_to_telegram(product: dict, image_url: str = None, message_id: int
 💰 السعر: <b>{float(product['price_iqd']):,.0f} IQD</b>
 📦 الجملة: <b>{float(product['wholesale_price_iqd']):,.0f} IQD</b>
 ━━━━━━━━━━━━━━━━
-📅 {datetime.now().strftime('%Y-%m-%d %H:%M')}
 """
+    if timestamp:
+        caption += f"📅 {datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
     
     if image_url:
         caption += f"\n🖼️ <a href='{image_url}'>عرض الصورة</a>"
+    return caption
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        try:
-            if message_id:
-                # تحديث رسالة موجودة
-                resp = await client.post(
-                    f"{TG_URL}/editMessageText",
-                    json={
-                        "chat_id": CHAT_ID,
-                        "message_id": int(message_id),
-                        "text": caption,
-                        "parse_mode": "HTML"
-                    }
-                )
-                
-                if resp.status_code == 200:
-                    return message_id
-                
-                error_data = resp.json()
-                error_desc = error_data.get("description", "")
-                
-                if "message is not modified" in error_desc:
-                    return message_id
-                
-                if resp.status_code == 429:
-                    retry_after = error_data.get("parameters", {}).get("retry_after", 30)
-                    print(f"Telegram Rate Limit (edit): Retry after {retry_after}s")
-                    return message_id # Keep using the same ID, hope it works next time
-                
-                # If editing failed for other reasons (message deleted?), send new if not already retrying
-                if not is_retry:
-                    return await send_to_telegram(product, image_url, is_retry=True)
+class CaptionFingerprints:
+    """بصمة المحتوى الظاهر لكل رسالة في القناة (بدون سطر الوقت)
+
+    تعديل لا يغير أي حقل ظاهر يُتجاهل محلياً بدل طلب editMessage* ينتهي بـ
+    "message is not modified". تُحفظ في SQLite (ملف الـ outbox) لتبقى بعد إعادة التشغيل.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_fingerprints (
+                message_id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+        self.stats = {"skipped": 0, "sent": 0}
+
+    @staticmethod
+    def of(product: dict, image_url: str = None, photo: str = None) -> str:
+        content = render_caption(product, image_url, timestamp=False) + "\x00" + (photo or "")
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def unchanged(self, message_id, fingerprint: str) -> bool:
+        if not message_id:
+            return False
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprint FROM telegram_fingerprints WHERE message_id=?", (int(message_id),)
+            ).fetchone()
+        if row and row[0] == fingerprint:
+            self.stats["skipped"] += 1
+            return True
+        return False
+
+    def remember(self, message_id, fingerprint: str):
+        if not message_id:
+            return
+        self.stats["sent"] += 1
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO telegram_fingerprints (message_id, fingerprint) VALUES (?, ?)",
+                (int(message_id), fingerprint)
+            )
+
+    def forget(self, message_id):
+        if not message_id:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM telegram_fingerprints WHERE message_id=?", (int(message_id),))
+
+async def send_to_telegram(product: dict, image_url: str = None, message_id: int = None, is_retry: bool = False, raise_errors: bool = False):
+    """إرسال المنتج للتليجرام أو تحديثه وإرجاع message_id
+
+    raise_errors=True يرفع الأخطاء بدل ابتلاعها (يستخدمه صندوق الصادر لإعادة المحاولة).
+    """
+    
+    fingerprint = CaptionFingerprints.of(product, image_url)
+    if caption_fingerprints.unchanged(message_id, fingerprint):
+        return message_id
+    
+    sent_id = await _send_text_to_telegram(product, image_url, message_id, is_retry, raise_errors)
+    if sent_id:
+        caption_fingerprints.remember(sent_id, fingerprint)
+    return sent_id
+
+async def _send_text_to_telegram(product: dict, image_url: str, message_id: int, is_retry: bool, raise_errors: bool):
+    caption = render_caption(product, image_url)
+
+    try:
+        if message_id:
+            # تحديث رسالة موجودة
+            resp = await telegram_queue.call(
+                "editMessageText",
+                json={
+                    "chat_id": CHAT_ID,
+                    "message_id": int(message_id),
+                    "text": caption,
+                    "parse_mode": "HTML"
+                }
+            )
+            
+            if resp.status_code == 200:
                 return message_id
+            
+            error_data = resp.json()
+            error_desc = error_data.get("description", "")
+            
+            if "message is not modified" in error_desc:
+                return message_id
+            
+            if resp.status_code == 429:
+                # الطابور استنفد محاولاته مع retry_after
+                print(f"Telegram Rate Limit (edit): giving up on message {message_id}")
+                if raise_errors:
+                    raise Exception(f"Telegram rate limit (edit {message_id})")
+                return message_id # Keep using the same ID, hope it works next time
+            
+            # If editing failed for other reasons (message deleted?), send new if not already retrying
+            if not is_retry:
+                return await send_to_telegram(product, image_url, is_retry=True, raise_errors=raise_errors)
+            return message_id
+        else:
+            # إرسال رسالة جديدة
+            resp = await telegram_queue.call(
+                "sendMessage",
+                json={"chat_id": CHAT_ID, "text": caption, "parse_mode": "HTML"}
+            )
+            
+            if resp.status_code == 200:
+                return resp.json()["result"]["message_id"]
+            
+            if resp.status_code == 429:
+                print("Telegram Rate Limit (send): giving up after retries")
+                if raise_errors:
+                    raise Exception("Telegram rate limit (send)")
+                return None
+            
+            raise Exception(f"Telegram API Error: {resp.text}")
+            
+    except Exception as e:
+        print(f"Telegram Error: {e}")
+        if raise_errors:
+            raise
+        return message_id if message_id else None
+
+async def _telegram_photo_input(image: str):
+    """مصدر الصورة لـ sendPhoto/editMessageMedia: رابط يجلبه التليجرام أو بايتات ملف محلي"""
+    if image.startswith(LOCAL_IMAGE_PREFIX):
+        path = LOCAL_IMAGES_DIR / image[len(LOCAL_IMAGE_PREFIX):]
+        try:
+            # قراءة الملف في خيط حتى لا تحجب حلقة الأحداث
+            return path.name, await asyncio.get_running_loop().run_in_executor(None, path.read_bytes)
+        except FileNotFoundError:
+            raise Exception(f"Local image missing: {path.name}")
+    return image
+
+def _largest_photo_id(resp: httpx.Response) -> Optional[str]:
+    photos = (resp.json().get("result") or {}).get("photo") or []
+    return photos[-1]["file_id"] if photos else None
+
+async def send_photo_to_telegram(product: dict, message_id: int = None) -> dict:
+    """نشر المنتج كصورة (sendPhoto) أو تحديثها، مع إعادة استخدام file_id
+
+    الصورة تُرفع إلى التليجرام مرة واحدة فقط: بعدها يُستخدم file_id المحفوظ، والتعديلات
+    التي لا تغير الصورة تكون editMessageCaption. يُرجع الحقول التي يجب حفظها في المنتج:
+    {"message_id", "telegram_file_id", "telegram_photo"} (telegram_photo = الصورة التي يمثلها file_id).
+    """
+    image = product.get("image")
+    caption = render_caption(product)
+    file_id = product.get("telegram_file_id")
+    same_photo = bool(file_id) and product.get("telegram_photo") == image
+    result = {"message_id": message_id, "telegram_file_id": file_id, "telegram_photo": product.get("telegram_photo")}
+    fingerprint = CaptionFingerprints.of(product, photo=image)
+    if file_id and (same_photo or not image) and caption_fingerprints.unchanged(message_id, fingerprint):
+        return result
+    sent = await _send_photo_to_telegram(product, message_id, image, caption, file_id, same_photo, result)
+    caption_fingerprints.remember(sent["message_id"], fingerprint)
+    return sent
+
+async def _send_photo_to_telegram(product: dict, message_id, image, caption: str, file_id, same_photo: bool, result: dict) -> dict:
+
+    if message_id and file_id:
+        if same_photo or not image:
+            resp = await telegram_queue.call("editMessageCaption", json={
+                "chat_id": CHAT_ID, "message_id": int(message_id), "caption": caption, "parse_mode": "HTML"
+            })
+        else:
+            # تغيرت صورة المنتج: استبدال الصورة والنص في نفس الرسالة
+            media = {"type": "photo", "caption": caption, "parse_mode": "HTML"}
+            photo = await _telegram_photo_input(image)
+            if isinstance(photo, tuple):
+                media["media"] = "attach://photo"
+                resp = await telegram_queue.call("editMessageMedia", data={
+                    "chat_id": CHAT_ID, "message_id": int(message_id), "media": json.dumps(media, ensure_ascii=False)
+                }, files={"photo": photo})
             else:
-                # إرسال رسالة جديدة
-                resp = await client.post(
-                    f"{TG_URL}/sendMessage",
-                    json={"chat_id": CHAT_ID, "text": caption, "parse_mode": "HTML"}
-                )
-                
-                if resp.status_code == 200:
-                    return resp.json()["result"]["message_id"]
-                
-                if resp.status_code == 429:
-                    error_data = resp.json()
-                    retry_after = error_data.get("parameters", {}).get("retry_after", 30)
-                    print(f"Telegram Rate Limit (send): Retry after {retry_after}s")
-                    return None
-                
-                raise Exception(f"Telegram API Error: {resp.text}")
-                
+                media["media"] = photo
+                resp = await telegram_queue.call("editMessageMedia", json={
+                    "chat_id": CHAT_ID, "message_id": int(message_id), "media": media
+                })
+            if resp.status_code == 200:
+                result.update(telegram_file_id=_largest_photo_id(resp) or file_id, telegram_photo=image)
+        if resp.status_code == 200:
+            return result
+        description = resp.json().get("description", "")
+        if "message is not modified" in description:
+            return result
+        if resp.status_code == 429:
+            raise Exception(f"Telegram rate limit (edit {message_id})")
+        if resp.status_code >= 500:
+            raise Exception(f"Telegram API Error: {resp.text}")
+        # الرسالة محذوفة أو لا يمكن تعديلها: ننشر رسالة جديدة
+        print(f"Telegram photo edit failed for {message_id}: {description}")
+
+    # رسالة جديدة (أو رسالة نصية قديمة تُستبدل بصورة)
+    params = {"chat_id": CHAT_ID, "caption": caption, "parse_mode": "HTML"}
+    if same_photo or not image:
+        # نفس الصورة، أو حُذف رابط الصورة من المنتج: نعيد نشر الصورة المحفوظة في التليجرام
+        resp = await telegram_queue.call("sendPhoto", json={**params, "photo": file_id})
+    else:
+        photo = await _telegram_photo_input(image)
+        if isinstance(photo, tuple):
+            resp = await telegram_queue.call("sendPhoto", data=params, files={"photo": photo})
+        else:
+            resp = await telegram_queue.call("sendPhoto", json={**params, "photo": photo})
+    if resp.status_code != 200:
+        raise Exception(f"Telegram API Error: {resp.text}")
+    result.update(
+        message_id=resp.json()["result"]["message_id"],
+        telegram_file_id=_largest_photo_id(resp) or file_id,
+        telegram_photo=image or result["telegram_photo"]
+    )
+    if message_id and message_id != result["message_id"]:
+        outbox.enqueue("telegram_delete", product["product_number"], {"message_id": message_id})
+    return result
+
+# ================================
+# Outbox (Write-behind Side Effects)
+# ================================
+
+# صندوق صادر دائم: الـ endpoints تسجل الآثار الجانبية (التليجرام) وتعود فور
+# نجاح الكتابة في Convex، وعامل في الخلفية يفرغه مع إعادة المحاولة
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "outbox.db")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "20"))
+
+class Outbox:
+    """طابور مهام دائم في SQLite يبقى بعد إعادة التشغيل"""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                product_number TEXT,
+                payload TEXT NOT NULL DEFAULT '{}',
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TEXT NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._in_progress = None
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+        self.stats = {"done": 0, "retried": 0, "dead": 0, "deduplicated": 0}
+
+    def handler(self, kind: str):
+        """تسجيل دالة (async) لتنفيذ نوع من المهام"""
+        def register(fn):
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    def enqueue(self, kind: str, product_number: str = None, payload: dict = None, dedupe: bool = False) -> Optional[int]:
+        """إضافة مهمة، مع dedupe=True تُتجاهل إذا كانت هناك مهمة معلقة مماثلة لم تبدأ بعد"""
+        with self._lock:
+            if dedupe:
+                row = self._db.execute(
+                    "SELECT id FROM outbox WHERE kind=? AND product_number IS ? AND status='pending' AND id IS NOT ?",
+                    (kind, product_number, self._in_progress)
+                ).fetchone()
+                if row:
+                    self.stats["deduplicated"] += 1
+                    return row[0]
+            cur = self._db.execute(
+                "INSERT INTO outbox (kind, product_number, payload, created_at) VALUES (?, ?, ?, ?)",
+                (kind, product_number, json.dumps(payload or {}, ensure_ascii=False), datetime.now().isoformat())
+            )
+        self._notify()
+        return cur.lastrowid
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def _notify(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if _main_loop is not None:
+                _main_loop.call_soon_threadsafe(self._notify)
+            return
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self.start()
+        else:
+            self._wakeup.set()
+
+    def _claim(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, kind, product_number, payload, attempts FROM outbox "
+                "WHERE status='pending' AND next_attempt <= ? ORDER BY id LIMIT 1",
+                (time.time(),)
+            ).fetchone()
+            self._in_progress = row[0] if row else None
+        return row
+
+    def _seconds_until_next(self) -> float:
+        with self._lock:
+            row = self._db.execute("SELECT MIN(next_attempt) FROM outbox WHERE status='pending'").fetchone()
+        if not row or row[0] is None:
+            return 60.0
+        return max(0.0, min(60.0, row[0] - time.time()))
+
+    async def _process(self, row):
+        job_id, kind, product_number, payload, attempts = row
+        try:
+            handler = self._handlers.get(kind)
+            if handler is None:
+                raise Exception(f"no handler for outbox job '{kind}'")
+            await handler(product_number, json.loads(payload))
         except Exception as e:
-            print(f"Telegram Error: {e}")
-            return message_id if message_id else None
+            attempts += 1
+            dead = attempts >= OUTBOX_MAX_ATTEMPTS
+            self.stats["dead" if dead else "retried"] += 1
+            print(f"Outbox {kind} #{job_id} failed (attempt {attempts}): {e}")
+            with self._lock:
+                self._db.execute(
+                    "UPDATE outbox SET attempts=?, next_attempt=?, last_error=?, status=? WHERE id=?",
+                    (attempts, time.time() + min(300, 2 ** attempts), str(e)[:500], "dead" if dead else "pending", job_id)
+                )
+        else:
+            self.stats["done"] += 1
+            with self._lock:
+                self._db.execute("DELETE FROM outbox WHERE id=?", (job_id,))
+        finally:
+            self._in_progress = None
+
+    async def _run(self):
+        while True:
+            row = self._claim()
+            if row is None:
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._seconds_until_next())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(row)
+
+    def start(self):
+        """تشغيل العامل على حلقة الأحداث الحالية"""
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def drain(self, timeout: float):
+        """تنفيذ المهام المستحقة ثم إيقاف العامل (عند الإغلاق)"""
+        if self._task is None or self._task.done():
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=timeout)
+        except asyncio.TimeoutError:
+            print("Outbox drain timed out, remaining jobs stay queued for next start")
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+outbox = Outbox(OUTBOX_FILE)
+caption_fingerprints = CaptionFingerprints(OUTBOX_FILE)
+
+@outbox.handler("telegram_upsert")
+async def _outbox_telegram_upsert(product_number: str, payload: dict):
+    """نشر/تحديث رسالة المنتج بحالته الحالية وحفظ message_id الجديد"""
+    cache = await run_db(load_cache)
+    product = cache.get(normalize_pn(product_number))
+    if product is None:
+        return  # حُذف المنتج قبل أن نصل إليه
+    msg_id = product.get("message_id")
+    if TELEGRAM_PHOTO_MODE and (product.get("image") or product.get("telegram_file_id")):
+        sent = await send_photo_to_telegram(product, message_id=msg_id)
+        new_msg_id = sent["message_id"]
+        changes = {k: v for k, v in sent.items() if v is not None and v != product.get(k) and k != "message_id"}
+        if changes:
+            await run_db(update_product_in_db, product["product_number"], changes)
+    else:
+        new_msg_id = await send_to_telegram(product, product.get("image"), message_id=msg_id, raise_errors=True)
+    if not new_msg_id:
+        raise Exception("Telegram did not return a message_id")
+    if new_msg_id != msg_id:
+        await run_db(update_product_in_db, product["product_number"], {"message_id": new_msg_id})
+        cache = await run_db(load_cache)
+        if normalize_pn(product["product_number"]) not in cache:
+            # حُذف المنتج أثناء الإرسال: لا نترك رسالة يتيمة في القناة
+            outbox.enqueue("telegram_delete", product["product_number"], {"message_id": new_msg_id})
+
+@outbox.handler("image_upload")
+async def _outbox_image_upload(product_number: str, payload: dict):
+    """رفع صورة محفوظة (وضع IMAGE_BACKGROUND_UPLOAD) ثم ملء حقل image في المنتج"""
+    path = Path(payload["pending"])
+    if not path.exists():
+        return  # نُفذت مسبقاً
+    try:
+        images = await ingest_image(open(path, "rb"), payload["hash"], path.stat().st_size)
+    except HTTPException as e:
+        if e.status_code != 400:
+            raise
+        print(f"Background image for {product_number} rejected: {e.detail}")
+        path.unlink(missing_ok=True)
+        return
+    # thumbnail="" تمسح مصغرة الصورة السابقة إن لم تُنشأ مصغرة للجديدة
+    await run_db(update_product_in_db, product_number, {"image": images["image"], "thumbnail": images.get("thumbnail") or ""})
+    path.unlink(missing_ok=True)
+    outbox.enqueue("telegram_upsert", product_number, dedupe=True)
+
+@outbox.handler("telegram_delete")
+async def _outbox_telegram_delete(product_number: str, payload: dict):
+    if not payload.get("message_id"):
+        return
+    caption_fingerprints.forget(payload["message_id"])
+    resp = await telegram_queue.call(
+        "deleteMessage",
+        json={"chat_id": CHAT_ID, "message_id": payload["message_id"]}
+    )
+    # 400 يعني أن الرسالة محذوفة مسبقاً أو قديمة جداً - لا فائدة من الإعادة
+    if resp.status_code not in (200, 400):
+        raise Exception(f"Telegram API Error: {resp.text}")
+
+# ================================
+# Idempotency Keys
+# ================================
+
+# إعادة محاولة نفس الطلب (انقطاع الاتصال في المحل) بنفس ترويسة Idempotency-Key
+# تُرجع الاستجابة المحفوظة دون تكرار العمل في Convex و ImgBB والتليجرام
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = max(1, int(os.getenv("IDEMPOTENCY_MAX_KEYS", "2000")))
+
+def is_idempotent_route(method: str, path: str) -> bool:
+    return method == "POST" and (
+        path in ("/api/products", "/api/stock/movements") or path.startswith("/api/update-status/")
+    )
+
+class IdempotencyStore:
+    """الاستجابات الناجحة لكل مفتاح (محدودة العدد وتنتهي صلاحيتها)
+
+    المفتاح خاص بكل جلسة. الطلب المكرر أثناء تنفيذ الأصلي ينتظر نتيجته،
+    والطلب الفاشل لا يُحفظ حتى تعيد المحاولة تنفيذه فعلاً.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries = collections.OrderedDict()
+        self.stats = {"stored": 0, "replayed": 0, "waited": 0, "conflicts": 0, "evicted": 0}
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [k for k, e in self._entries.items() if e["response"] is not None and e["expires"] <= now]
+        while len(self._entries) - len(expired) >= self.max_keys:
+            # الأقدم أولاً، ولا نطرد طلباً قيد التنفيذ
+            oldest = next((k for k, e in self._entries.items() if e["response"] is not None and k not in expired), None)
+            if oldest is None:
+                break
+            expired.append(oldest)
+        for key in expired:
+            del self._entries[key]
+        self.stats["evicted"] += len(expired)
+
+    def begin(self, key: tuple):
+        """يُرجع (entry, owner): owner=True يعني أن هذا الطلب هو من ينفذ
+
+        بصمة الطلب (fingerprint) يملؤها المنفذ عند اكتمال قراءة المحتوى.
+        """
+        self._prune()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = {"fingerprint": None, "response": None, "done": asyncio.Event(), "expires": 0.0}
+            self._entries[key] = entry
+            return entry, True
+        return entry, False
+
+    def finish(self, key: tuple, entry: dict, response: Optional[dict]):
+        if response is None:
+            self._entries.pop(key, None)
+        else:
+            entry["response"] = response
+            entry["expires"] = time.monotonic() + self.ttl
+            self.stats["stored"] += 1
+        entry["done"].set()
+
+    def __len__(self):
+        return len(self._entries)
+
+idempotency_store = IdempotencyStore()
+
+def _replay(response: dict) -> Response:
+    return Response(
+        content=response["body"],
+        status_code=response["status"],
+        headers={**response["headers"], "Idempotent-Replayed": "true"}
+    )
+
+# أقصى محتوى يُحسب له بصمة (أكبر صورة مسموحة مع حقول النموذج)
+IDEMPOTENCY_MAX_BODY = int(IMAGE_MAX_UPLOAD_MB * 1024 * 1024) + IMAGE_UPLOAD_FORM_OVERHEAD
+
+def _json_error(status_code: int, detail: str) -> Response:
+    return Response(
+        content=json.dumps({"detail": detail}, ensure_ascii=False),
+        status_code=status_code, media_type="application/json"
+    )
+
+class BodyDigest:
+    """بصمة SHA-256 لمحتوى الطلب تُحسب على دفعات أثناء وصوله
+
+    فاصل multipart يُحذف لأنه يتغير مع كل إعادة إرسال؛ آخر len(boundary)-1 بايت
+    تُؤجل للدفعة التالية حتى لا يفوتنا فاصل مقسوم بين دفعتين.
+    """
+
+    def __init__(self, headers: Headers, limit: int = None):
+        content_type = headers.get("content-type", "")
+        boundary = ""
+        if content_type.startswith("multipart/form-data") and "boundary=" in content_type:
+            boundary = content_type.split("boundary=", 1)[1].split(";", 1)[0].strip().strip('"')
+        self._boundary = boundary.encode()
+        self._hash = hashlib.sha256()
+        self._tail = b""
+        self.limit = IDEMPOTENCY_MAX_BODY if limit is None else limit
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise HTTPException(status_code=413, detail=f"حجم الطلب أكبر من {self.limit // (1024 * 1024)} ميغابايت")
+        if not self._boundary:
+            self._hash.update(chunk)
+            return
+        parts = (self._tail + chunk).split(self._boundary)
+        last = parts.pop()
+        for part in parts:
+            self._hash.update(part)
+        keep = len(self._boundary) - 1
+        if len(last) > keep:
+            self._hash.update(last[:len(last) - keep])
+            last = last[len(last) - keep:]
+        self._tail = last
+
+    def hexdigest(self) -> str:
+        self._hash.update(self._tail)
+        self._tail = b""
+        return self._hash.hexdigest()
+
+class IdempotencyMiddleware:
+    """Idempotency-Key: تنفيذ الطلب مرة واحدة وإعادة استجابته المحفوظة للتكرارات
+
+    البصمة = الطريقة والمسار والمعاملات وSHA-256 المحتوى. المحتوى لا يُحمّل في الذاكرة:
+    البصمة تُحسب أثناء مروره إلى المعالج، والطلب المكرر يُقرأ ويُحسب فقط بعد انتهاء الأصلي.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        key = headers.get("idempotency-key")
+        if not key or not is_idempotent_route(scope["method"], scope["path"]):
+            return await self.app(scope, receive, send)
+        
+        # المفتاح مرتبط بالجلسة
+        auth = hashlib.sha256(headers.get("authorization", "").encode()).hexdigest()
+        store_key = (auth, key[:200])
+        prefix = f"{scope['method']} {scope['path']}?{scope.get('query_string', b'').decode('latin-1')}"
+        
+        while True:
+            entry, owner = idempotency_store.begin(store_key)
+            if owner:
+                return await self._execute(scope, receive, send, headers, store_key, entry, prefix)
+            if entry["response"] is None:
+                idempotency_store.stats["waited"] += 1
+                await entry["done"].wait()
+                if entry["response"] is None:
+                    continue  # فشل الطلب الأصلي: ننفذ هذا الطلب من جديد
+            break
+        
+        digest = BodyDigest(headers)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] != "http.request":
+                    return  # انقطع الاتصال
+                digest.update(message.get("body", b""))
+                if not message.get("more_body", False):
+                    break
+        except HTTPException as e:
+            return await _json_error(e.status_code, e.detail)(scope, receive, send)
+        if entry["fingerprint"] != f"{prefix} {digest.hexdigest()}":
+            idempotency_store.stats["conflicts"] += 1
+            return await _json_error(422, "مفتاح Idempotency-Key مستخدم لطلب مختلف")(scope, receive, send)
+        idempotency_store.stats["replayed"] += 1
+        await _replay(entry["response"])(scope, receive, send)
+
+    async def _execute(self, scope, receive, send, headers, store_key, entry, prefix):
+        digest = BodyDigest(headers)
+        received = False
+        
+        async def hashing_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                digest.update(message.get("body", b""))
+                received = not message.get("more_body", False)
+            return message
+        
+        start, chunks = {}, []
+        
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+                if 200 <= message["status"] < 300:
+                    # المعالج لم يقرأ كل المحتوى: نكمل البصمة قبل الرد (بعده يُعتبر الاتصال منتهياً)
+                    try:
+                        while not received and (await hashing_receive())["type"] == "http.request":
+                            pass
+                    except HTTPException:
+                        pass  # تجاوز الحد: الاستجابة لا تُحفظ
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+        
+        stored = None
+        try:
+            await self.app(scope, hashing_receive, capture)
+            if 200 <= start.get("status", 500) < 300 and received:
+                entry["fingerprint"] = f"{prefix} {digest.hexdigest()}"
+                stored = {
+                    "status": start["status"],
+                    "headers": {
+                        k.decode("latin-1"): v.decode("latin-1") for k, v in start.get("headers", [])
+                        if k.lower() != b"content-length"
+                    },
+                    "body": b"".join(chunks)
+                }
+        finally:
+            idempotency_store.finish(store_key, entry, stored)
 
-async def delete_from_telegram(message_id: int):
-    """حذف رسالة من التليجرام"""
-    async with httpx.AsyncClient(timeout=30) as client:
+app.add_middleware(IdempotencyMiddleware)
+
+def is_image_upload_route(method: str, path: str) -> bool:
+    return (method == "POST" and path == "/api/products") or (method == "PATCH" and path.startswith("/api/products/"))
+
+@app.middleware("http")
+async def upload_size_middleware(request, call_next):
+    """رفض رفع الصور الكبيرة من Content-Length قبل أن يقرأ Starlette الطلب ويحفظه"""
+    length = request.headers.get("content-length")
+    if length and is_image_upload_route(request.method, request.url.path) \
+            and request.headers.get("content-type", "").startswith("multipart/form-data"):
         try:
-            await client.post(
-                f"{TG_URL}/deleteMessage",
-                json={"chat_id": CHAT_ID, "message_id": message_id}
+            too_large = int(length) > IMAGE_MAX_UPLOAD_MB * 1024 * 1024 + IMAGE_UPLOAD_FORM_OVERHEAD
+        except ValueError:
+            return Response(
+                content=json.dumps({"detail": "ترويسة Content-Length غير صحيحة"}, ensure_ascii=False),
+                status_code=400, media_type="application/json"
             )
-        except:
-            pass
+        if too_large:
+            return Response(
+                content=json.dumps({"detail": f"حجم الصورة أكبر من {IMAGE_MAX_UPLOAD_MB:g} ميغابايت"}, ensure_ascii=False),
+                status_code=413, media_type="application/json", headers={"Connection": "close"}
+            )
+    return await call_next(request)
 
 # ================================
 # API Endpoints
@@ -393,6 +2882,28 @@ async def health_check_api():
         "telegram": bool(BOT_TOKEN and CHAT_ID)
     }
 
+@app.get("/api/metrics")
+async def get_metrics(session: dict = Depends(get_current_user)):
+    """مؤشرات الأداء الداخلية (الكاش ودمج الطلبات)"""
+    with _catalog_lock:
+        age = time.monotonic() - _catalog_loaded_at if _catalog_loaded_at else None
+        size = len(_catalog_snapshot)
+    return {
+        "catalog": {
+            "products": size,
+            "ttl_seconds": CATALOG_CACHE_TTL,
+            "age_seconds": age,
+            "fresh": catalog_is_fresh(),
+            "fetches": catalog_fetches.stats()
+        },
+        "telegram_queue": {**telegram_queue.stats, "queued": telegram_queue.queued()},
+        "telegram_edits": {"skipped_unchanged": caption_fingerprints.stats["skipped"], "sent": caption_fingerprints.stats["sent"]},
+        "outbox": {**outbox.stats, **outbox.counts()},
+        "convex_batcher": convex_batcher.snapshot(),
+        "images": {**image_index.stats, "cache": image_cache.stats},
+        "idempotency": {**idempotency_store.stats, "keys": len(idempotency_store)}
+    }
+
 # ================================
 # Authentication Endpoints
 # ================================
@@ -418,7 +2929,7 @@ async def login(username: str = Form(...), password: str = Form(...)):
     if not user_data and convex_client:
         try:
             # Query users from Convex
-            all_users = convex_client.query("users:listUsers")
+            all_users = await run_db(convex_client.query, "users:listUsers")
             convex_user = next((u for u in all_users if u.get("username") == username), None)
             if convex_user and convex_user.get("password") == password_hash:
                 user_data = {
@@ -433,7 +2944,7 @@ async def login(username: str = Form(...), password: str = Form(...)):
         raise HTTPException(status_code=401, detail="اسم المستخدم أو كلمة المرور غير صحيحة")
     
     # إنشاء جلسة
-    token = create_session(user_data["username"], user_data["role"])
+    token = await run_db(create_session, user_data["username"], user_data["role"])
     
     return {
         "token": token,
@@ -452,7 +2963,7 @@ async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     if convex_client:
         try:
-            convex_client.mutation("users:deleteSession", {"token": token})
+            await run_db(convex_client.mutation, "users:deleteSession", {"token": token})
         except: pass
     
     return {"message": "تم تسجيل الخروج بنجاح"}
@@ -554,133 +3065,262 @@ async def delete_user(
     
     return {"message": "تم حذف المستخدم بنجاح"}
 
+def encode_cursor(sort_by: str, order: str, key: tuple) -> str:
+    """مؤشر صفحة معتم: آخر مفتاح ترتيب تم إرجاعه"""
+    raw = json.dumps({"s": sort_by, "o": order, "k": list(key)}, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, sort_by: str, order: str) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        key = tuple(data["k"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صالح")
+    if data.get("s") != sort_by or data.get("o") != order:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة لا يطابق الترتيب المطلوب")
+    return key
+
+def project_product(product: dict, fields: Optional[list]) -> dict:
+    if not fields:
+        return product
+    return {f: product[f] for f in fields if f in product}
+
 @app.get("/api/products")
 async def get_products(
+    response: Response,
     search: str = None,
     car_name: str = None,
     product_type: str = None,
     status: str = None,
     min_price: float = None,
     max_price: float = None,
-    sort_by: str = "last_update",
+    sort_by: str = None,
     order: str = "desc",
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
     session: dict = Depends(get_current_user)
 ):
-    """جلب جميع المنتجات مع فلترة وبحث متقدم"""
-    cache = load_cache()
-    products = list(cache.values())
+    """جلب المنتجات مع فلترة وبحث متقدم
+
+    مع limit تُرجع صفحة {items, total, next_cursor}؛ المؤشر يعتمد على مفتاح الترتيب
+    وليس على الموضع، فلا تتكرر العناصر ولا تُفقد عند التعديل بين الصفحات.
+    fields=a,b,c يُرجع الحقول المطلوبة فقط (مع product_number دائماً).
+    """
+    loaded = catalog_is_fresh() or await run_db(ensure_catalog)
     
-    # تطبيق الفلاتر
-    if search:
-        search_lower = search.lower()
-        products = [p for p in products if 
-            search_lower in p.get("product_name", "").lower() or
-            search_lower in p.get("car_name", "").lower() or
-            search_lower in p.get("product_number", "").lower() or
-            search_lower in p.get("type", "").lower() or
-            search_lower in p.get("model_number", "").lower()
-        ]
+    if sort_by is None:
+        sort_by = "relevance" if search else "last_update"
+    if sort_by == "relevance" and not search:
+        sort_by = "last_update"
+    if sort_by not in PRODUCT_SORT_KEYS and sort_by != "relevance":
+        sort_by = "last_update"
+    if sort_by == "relevance":
+        # الأعلى صلة أولاً، والأحدث عند التساوي
+        order = "desc"
+    reverse = order == "desc"
     
+    # تطبيق الفلاتر
+    filters = []
     if car_name:
-        products = [p for p in products if car_name.lower() in p.get("car_name", "").lower()]
+        car_needle = car_name.lower()
+        filters.append(lambda p: car_needle in p.get("car_name", "").lower())
     
     if product_type:
-        products = [p for p in products if product_type.lower() in p.get("type", "").lower()]
+        type_needle = product_type.lower()
+        filters.append(lambda p: type_needle in p.get("type", "").lower())
     
-    if status:
-        if status == "available":
-            products = [p for p in products if p.get("quantity", 0) > 0]
-        elif status == "out_of_stock":
-            products = [p for p in products if p.get("quantity", 0) == 0]
+    if status == "available":
+        filters.append(lambda p: p.get("quantity", 0) > 0)
+    elif status == "out_of_stock":
+        filters.append(lambda p: p.get("quantity", 0) == 0)
     
+    price_filters = []
     if min_price is not None:
-        products = [p for p in products if p.get("price_iqd", 0) >= min_price]
+        price_filters.append(lambda p: (p.get("price_iqd") or 0) >= min_price)
     
     if max_price is not None:
-        products = [p for p in products if p.get("price_iqd", 0) <= max_price]
+        price_filters.append(lambda p: (p.get("price_iqd") or 0) <= max_price)
     
-    # الترتيب
-    reverse = order == "desc"
-    if sort_by == "price":
-        products.sort(key=lambda x: x.get("price_iqd", 0), reverse=reverse)
-    elif sort_by == "quantity":
-        products.sort(key=lambda x: x.get("quantity", 0), reverse=reverse)
-    elif sort_by == "name":
-        products.sort(key=lambda x: x.get("product_name", ""), reverse=reverse)
-    else:  # last_update
-        products.sort(key=lambda x: x.get("last_update", ""), reverse=reverse)
+    field_list = None
+    if fields:
+        field_list = ["product_number"] + [f.strip() for f in fields.split(",") if f.strip() and f.strip() != "product_number"]
+    
+    paged = limit is not None or cursor is not None
+    limit = limit or 50
+    after = decode_cursor(cursor, sort_by, order) if cursor else None
+    
+    with _catalog_lock:
+        snapshot = _catalog_snapshot if loaded else {}
+        if search:
+            # البحث من الفهرس (مع توحيد الحروف العربية) بدل المرور على كل المنتجات،
+            # والنتائج قليلة فتُرتب مباشرة
+            scores = search_index.search(search) if loaded else {}
+            checks = filters + price_filters
+            if sort_by == "relevance":
+                sort_key = lambda p, pn: (scores.get(pn, 0), p.get("last_update") or "", pn)
+            else:
+                sort_key = PRODUCT_SORT_KEYS[sort_by]
+            keyed = sorted(
+                ((sort_key(snapshot[key], key), snapshot[key]) for key in scores
+                 if key in snapshot and all(check(snapshot[key]) for check in checks)),
+                key=lambda kp: kp[0],
+                reverse=reverse
+            )
+            total = len(keyed)
+            if after is not None:
+                keys = [k for k, _ in keyed]
+                if reverse:
+                    # المفاتيح تنازلية: أول عنصر مفتاحه أصغر من المؤشر
+                    lo, hi = 0, len(keys)
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if keys[mid] < after:
+                            hi = mid
+                        else:
+                            lo = mid + 1
+                    keyed = keyed[lo:]
+                else:
+                    keyed = keyed[bisect.bisect_right(keys, after):]
+        else:
+            # المرور على الفهرس المرتب مسبقاً: نطاق السعر يُقطع بـ bisect عند الترتيب بالسعر
+            lo, hi = (0, len(sort_index)) if loaded else (0, 0)
+            checks = filters + price_filters
+            if sort_by == "price" and loaded:
+                lo, hi = sort_index.range("price", min_price, max_price)
+                checks = filters
+            
+            def matches():
+                for sort_key in sort_index.walk(sort_by, lo, hi, reverse, after):
+                    product = snapshot.get(sort_key[-1])
+                    if product is not None and all(check(product) for check in checks):
+                        yield sort_key, product
+            
+            if not checks:
+                total = hi - lo
+            elif not filters and loaded:
+                price_lo, price_hi = sort_index.range("price", min_price, max_price)
+                total = price_hi - price_lo
+            elif paged and loaded and columnar_catalog is not None:
+                # عدّ متجه على الأعمدة بدل المرور على المنتجات
+                total = columnar_catalog.count(
+                    car_name=car_name, product_type=product_type, status=status,
+                    min_price=min_price, max_price=max_price
+                )
+            elif paged:
+                total = sum(
+                    1 for sort_key in sort_index.walk(sort_by, lo, hi)
+                    if sort_key[-1] in snapshot and all(check(snapshot[sort_key[-1]]) for check in checks)
+                )
+            keyed = matches()
+            if not paged:
+                keyed = list(keyed)
+                total = len(keyed)
+        
+        response.headers["X-Total-Count"] = str(total)
+        if not paged:
+            return [project_product(p, field_list) for _, p in keyed]
+        
+        # الصفحة التالية: العناصر التي تأتي بعد مفتاح المؤشر في نفس الترتيب
+        page = list(itertools.islice(keyed, limit + 1))
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(sort_by, order, page[-1][0])
+        return {
+            "items": [project_product(p, field_list) for _, p in page],
+            "total": total,
+            "limit": limit,
+            "next_cursor": next_cursor
+        }
+
+@app.get("/api/products/facets")
+async def get_product_facets(
+    search: str = None,
+    car_name: str = None,
+    product_type: str = None,
+    status: str = None,
+    min_price: float = None,
+    max_price: float = None,
+    session: dict = Depends(get_current_user)
+):
+    """عدد النتائج لكل سيارة ونوع وحالة وشريحة سعر ضمن الفلاتر الحالية
+
+    عدادات كل مجموعة تُحسب بكل الفلاتر عدا فلتر المجموعة نفسها، فتظهر نتيجة تغيير الاختيار.
+    """
+    loaded = catalog_is_fresh() or await run_db(ensure_catalog)
     
-    return products
+    with _catalog_lock:
+        masks = {}
+        if not loaded:
+            masks["search"] = 0
+        elif search:
+            masks["search"] = facet_index.bitmap_of(search_index.search(search))
+        if car_name:
+            masks["car_name"] = facet_index.matching(facet_index.cars, car_name)
+        if product_type:
+            masks["product_type"] = facet_index.matching(facet_index.types, product_type)
+        if status in facet_index.status:
+            masks["status"] = facet_index.status[status]
+        if min_price is not None or max_price is not None:
+            masks["price"] = facet_index.price_range(min_price, max_price, sort_index)
+        
+        def base(excluded: str) -> int:
+            result = facet_index.all
+            for name, mask in masks.items():
+                if name != excluded:
+                    result &= mask
+            return result
+        
+        def counts(bitmaps: dict, excluded: str) -> list:
+            scope = base(excluded)
+            result = [{"value": value, "count": popcount(bitmap & scope)} for value, bitmap in bitmaps.items()]
+            return sorted((r for r in result if r["count"]), key=lambda r: (-r["count"], str(r["value"])))
+        
+        price_scope = base("price")
+        edges = facet_index.price_buckets[1:] + [None]
+        return {
+            "total": popcount(base(None)),
+            "car_name": counts(facet_index.cars, "car_name"),
+            "product_type": counts(facet_index.types, "product_type"),
+            "status": {name: popcount(bitmap & base("status")) for name, bitmap in facet_index.status.items()},
+            "price": [
+                {"min": start, "max": end, "count": popcount(bitmap & price_scope)}
+                for start, end, bitmap in zip(facet_index.price_buckets, edges, facet_index.buckets)
+            ]
+        }
+
+@app.get("/api/suggest")
+async def suggest(
+    field: str = Query("car_name"),
+    q: str = "",
+    limit: int = Query(10, ge=1, le=50),
+    session: dict = Depends(get_current_user)
+):
+    """اقتراحات الإكمال التلقائي لأسماء السيارات والأنواع والقطع"""
+    field = {"product_type": "type"}.get(field, field)
+    if field not in SuggestIndex.FIELDS:
+        raise HTTPException(status_code=400, detail="حقل غير مدعوم للاقتراحات")
+    if not catalog_is_fresh():
+        await run_db(ensure_catalog)
+    with _catalog_lock:
+        return suggest_index.suggest(field, q, limit)
 
 @app.get("/api/stats")
 async def get_statistics(session: dict = Depends(get_current_user)):
-    """إحصائيات شاملة للوحة التحكم"""
-    cache = load_cache()
-    products = list(cache.values())
-    
-    total_products = len(products)
-    available_products = sum(1 for p in products if p.get("quantity", 0) > 0)
-    out_of_stock = total_products - available_products
-    
-    total_value = sum(p.get("price_iqd", 0) * p.get("quantity", 0) for p in products)
-    total_items = sum(p.get("quantity", 0) for p in products)
-    
-    # حسب النوع
-    by_type = {}
-    for p in products:
-        ptype = p.get("type", "غير محدد")
-        if ptype not in by_type:
-            by_type[ptype] = {"count": 0, "quantity": 0, "value": 0}
-        by_type[ptype]["count"] += 1
-        by_type[ptype]["quantity"] += p.get("quantity", 0)
-        by_type[ptype]["value"] += p.get("price_iqd", 0) * p.get("quantity", 0)
-    
-    # حسب السيارة
-    by_car = {}
-    for p in products:
-        car = p.get("car_name", "غير محدد")
-        if car not in by_car:
-            by_car[car] = {"count": 0, "quantity": 0}
-        by_car[car]["count"] += 1
-        by_car[car]["quantity"] += p.get("quantity", 0)
-    
-    # أكثر المنتجات مبيعاً (الأقل كمية من الأصلي)
-    top_selling = sorted(
-        [p for p in products if p.get("original_quantity", 0) > 0],
-        key=lambda x: (x.get("original_quantity", 0) - x.get("quantity", 0)),
-        reverse=True
-    )[:10]
-    
-    return {
-        "overview": {
-            "total_products": total_products,
-            "available_products": available_products,
-            "out_of_stock": out_of_stock,
-            "total_value": total_value,
-            "total_items": total_items,
-            "average_price": total_value / total_items if total_items > 0 else 0
-        },
-        "by_type": by_type,
-        "by_car": dict(sorted(by_car.items(), key=lambda x: x[1]["count"], reverse=True)[:10]),
-        "top_selling": [
-            {
-                "product_number": p.get("product_number"),
-                "product_name": p.get("product_name"),
-                "sold": p.get("original_quantity", 0) - p.get("quantity", 0),
-                "remaining": p.get("quantity", 0)
-            }
-            for p in top_selling
-        ],
-        "low_stock": [
-            {
-                "product_number": p.get("product_number"),
-                "product_name": p.get("product_name"),
-                "quantity": p.get("quantity", 0)
-            }
-            for p in sorted(products, key=lambda x: x.get("quantity", 0))[:10]
-            if p.get("quantity", 0) > 0 and p.get("quantity", 0) < 5
-        ]
-    }
+    """إحصائيات شاملة للوحة التحكم (من المجمّعات المحدّثة تدريجياً)"""
+    if not catalog_is_fresh():
+        await run_db(ensure_catalog)
+    with _catalog_lock:
+        return stats_aggregate.report(_catalog_snapshot)
+
+@app.get("/api/stats/drift")
+async def get_stats_drift(recompute: bool = False, session: dict = Depends(get_current_user)):
+    """تقرير الانحراف بين المجمّعات وإعادة الحساب الكاملة (recompute=true للمطابقة الآن)"""
+    if recompute:
+        await run_db(reconcile_stats)
+    return {**stats_drift, "interval": STATS_RECONCILE_INTERVAL}
 
 @app.post("/api/products")
 async def create_product(
@@ -707,7 +3347,7 @@ async def create_product(
     if not BOT_TOKEN or not CHAT_ID:
         raise HTTPException(status_code=500, detail="التليجرام غير مُعد. راجع ملف .env")
     
-    cache = load_cache()
+    cache = await run_db(load_cache)
     
     if product_number:
         if product_number in cache:
@@ -720,11 +3360,13 @@ async def create_product(
         rand_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
         product_number = f"PN-{date_str}-{rand_str}"
     
-    # رفع الصورة إلى ImgBB
-    image_url = None
+    # تجهيز الصورة ورفعها إلى ImgBB (مع نسخة مصغرة)، أو في الخلفية بعد إنشاء المنتج
+    images = {"image": None, "thumbnail": None}
+    pending_image = None
     if image:
-        image_content = await image.read()
-        image_url = await upload_image_to_imgbb(image_content)
+        images = await receive_product_image(image)
+        if "pending" in images:
+            pending_image, images = images, {"image": None, "thumbnail": None}
     
     # إنشاء بيانات المنتج
     product = {
@@ -738,33 +3380,79 @@ async def create_product(
         "price_iqd": price_iqd,
         "wholesale_price_iqd": wholesale_price_iqd,
         "status": "متوفر",
-        "image": image_url,
+        "image": images["image"],
+        "thumbnail": images["thumbnail"],
         "last_update": datetime.now().isoformat()
     }
     
-    # إرسال للتليجرام
-    msg_id = await send_to_telegram(product, image_url)
-    
-    # حفظ المعرفات 
-    product["message_id"] = msg_id
-    
     # حفظ في Convex
-    add_product_to_db(product)
+    await run_db(add_product_to_db, product)
+    
+    # النشر في التليجرام في الخلفية (message_id يُحفظ عند وصوله)
+    product["message_id"] = None
+    outbox.enqueue("telegram_upsert", normalize_pn(product_number), dedupe=True)
+    if pending_image:
+        outbox.enqueue("image_upload", normalize_pn(product_number), pending_image)
+        product["image_pending"] = True
     
     return product
 
 @app.get("/image/{image_id}")
-async def get_image(image_id: str):
-    """إعادة توجيه إلى رابط الصورة في ImgBB"""
+async def get_image(image_id: str, if_none_match: Optional[str] = Header(None)):
+    """صورة المنتج: من الكاش المحلي إن كان مفعلاً، وإلا إعادة توجيه إلى ImgBB"""
     
-    # البحث عن المنتج الذي يحتوي على هذه الصورة
-    cache = load_cache()
+    url = image_urls.get(image_id)
+    if url is None and not catalog_is_fresh():
+        await run_db(ensure_catalog)
+        url = image_urls.get(image_id)
+    if url is None:
+        # معرّفات قديمة لا تطابق جزءاً كاملاً من المسار (تُقبل فقط إن طابقت صورة واحدة)
+        with _catalog_lock:
+            matches = {p["image"] for p in _catalog_snapshot.values() if p.get("image") and image_id in p["image"]}
+        url = matches.pop() if len(matches) == 1 else None
+    if url is None:
+        raise HTTPException(status_code=404, detail="الصورة غير موجودة")
     
-    for product in cache.values():
-        if product.get("image") and image_id in product["image"]:
-            return RedirectResponse(url=product["image"])
+    if url.startswith(LOCAL_IMAGE_PREFIX):
+        return await _local_image_response(url, if_none_match)
+    
+    if not IMAGE_PROXY_CACHE:
+        return RedirectResponse(url=url, headers={"Cache-Control": "public, max-age=86400"})
     
-    raise HTTPException(status_code=404, detail="الصورة غير موجودة")
+    path, etag = await _cached_image(url)
+    return _image_response(path, etag, mimetypes.guess_type(url)[0], if_none_match)
+
+async def _cached_image(source: str) -> tuple:
+    entry = image_cache.lookup(source)
+    if entry is None:
+        image_cache.stats["misses"] += 1
+        return await image_cache.fetch(source)
+    image_cache.stats["hits"] += 1
+    return entry
+
+def _image_response(path: Path, etag: str, media_type: Optional[str], if_none_match: Optional[str]) -> Response:
+    headers = {"ETag": f'"{etag}"', "Cache-Control": IMAGE_CACHE_CONTROL}
+    if if_none_match and f'"{etag}"' in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+        image_cache.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    os.utime(path)
+    return FileResponse(path, media_type=media_type or "application/octet-stream", headers=headers)
+
+async def _local_image_response(url: str, if_none_match: Optional[str]) -> Response:
+    """صورة محفوظة محلياً (وضع التليجرام بدون ImgBB)، أو نسختها في التليجرام إن فُقد الملف"""
+    name = url[len(LOCAL_IMAGE_PREFIX):]
+    path = LOCAL_IMAGES_DIR / name
+    media_type = mimetypes.guess_type(name)[0]
+    if path.exists():
+        # اسم الملف هو بصمة المحتوى الأصلي فهو ETag ثابت
+        return _image_response(path, name.rsplit(".", 1)[0], media_type, if_none_match)
+    # القرص لا يبقى بعد إعادة النشر: المصغرة تُستبدل بالصورة الرئيسية من التليجرام
+    with _catalog_lock:
+        product = next((p for p in _catalog_snapshot.values() if url in (p.get("image"), p.get("thumbnail"))), None)
+    if product is None or not product.get("telegram_file_id") or product.get("telegram_photo") != product.get("image"):
+        raise HTTPException(status_code=404, detail="الصورة غير موجودة")
+    path, etag = await _cached_image(f"tg:{product['telegram_file_id']}")
+    return _image_response(path, etag, "image/jpeg", if_none_match)
 
 @app.post("/api/update-status/{product_number:path}")
 async def update_product_status(
@@ -774,46 +3462,109 @@ async def update_product_status(
 ):
     """تحديث حالة المنتج (تم بيع، تم بيع بالكامل، نفذ)"""
     product_number = normalize_pn(product_number)
-    cache = load_cache()
+    if not catalog_is_fresh():
+        await run_db(ensure_catalog)
+    with _catalog_lock:
+        product = _catalog_snapshot.get(product_number)
     
-    if product_number not in cache:
+    if product is None:
         raise HTTPException(status_code=404, detail="المنتج غير موجود")
     
-    product = cache[product_number]
-    original_qty = product["quantity"]
-    
-    changed = False
-    if action == "sold_one":
-        if product["quantity"] > 0:
-            product["quantity"] -= 1
-            product["status"] = "متوفر" if product["quantity"] > 0 else "نفذ"
-            changed = True
-    elif action == "sold_all":
-        if product["quantity"] > 0:
-            product["quantity"] = 0
-            product["status"] = "نفذ"
-            changed = True
-    
-    if not changed:
+    if action not in ("sold_one", "sold_all"):
         return product
-
-    product["last_update"] = datetime.now().isoformat()
     
+    # تغيير ذري في Convex: الكمية لا تنزل تحت الصفر حتى مع بيعين متزامنين
     try:
-        update_product_in_db(product_number, product)
+        state = await run_db(adjust_quantity_in_db, product_number, -1 if action == "sold_one" else 0, action == "sold_all")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في قاعدة البيانات: {str(e)}")
+    if state is None:
+        raise HTTPException(status_code=404, detail="المنتج غير موجود")
     
-    msg_id = product.get("message_id")
-    if msg_id:
-        try:
-            new_msg_id = await send_to_telegram(product, product.get("image"), message_id=msg_id)
-            if new_msg_id and new_msg_id != msg_id:
-                update_product_in_db(product_number, {"message_id": new_msg_id})
-        except: pass
+    # الحالة التي أرجعها Convex لهذا الطلب (لا ما تركته طلبات متزامنة أخرى في الـ snapshot)
+    with _catalog_lock:
+        product = dict(_catalog_snapshot.get(product_number) or product)
+    product.update(quantity=state["quantity"], status=state["status"], last_update=state["last_update"])
+    
+    # حتى لو لم يُحفظ message_id بعد (النشر الأول ما زال في الـ outbox): المهمة تعيد قراءة المنتج
+    outbox.enqueue("telegram_upsert", product_number, dedupe=True)
             
     return product
 
+# الحد الأقصى لعدد الحركات في طلب واحد
+STOCK_MOVEMENTS_MAX = 500
+
+class StockMovement(BaseModel):
+    """حركة مخزون: delta عدد صحيح غير صفري (سالب للبيع) أو action"""
+    product_number: Union[str, int]
+    delta: Optional[StrictInt] = None
+    action: Optional[Literal["sold_one", "sold_all"]] = None
+
+    @model_validator(mode="after")
+    def _one_change(self):
+        if (self.delta is None) == (self.action is None):
+            raise ValueError("يجب تحديد delta أو action (واحد فقط)")
+        if self.delta == 0:
+            raise ValueError("delta يجب أن يكون عدداً صحيحاً غير صفري")
+        if not str(self.product_number).strip():
+            raise ValueError("رقم المنتج مطلوب")
+        return self
+
+@app.post("/api/stock/movements")
+async def stock_movements(
+    movements: List[StockMovement] = Body(...),
+    session: dict = Depends(get_current_user)
+):
+    """حركات مخزون لعدة منتجات في طلب واحد (بيع عدة قطع عند الكاونتر)
+
+    كل عنصر {product_number, delta} أو {product_number, action: sold_one | sold_all}،
+    والعناصر غير الصالحة (delta كسرية أو صفر...) ترفض الطلب كله بـ 422.
+    كل حركة تغيير ذري في Convex (لا تنزل الكمية تحت الصفر) وكلها في دفعة واحدة،
+    ورسالة التليجرام لكل منتج تُحدّث مرة واحدة. النتيجة لكل عنصر على حدة.
+    """
+    if len(movements) > STOCK_MOVEMENTS_MAX:
+        raise HTTPException(status_code=400, detail=f"الحد الأقصى {STOCK_MOVEMENTS_MAX} حركة في الطلب")
+    
+    if not catalog_is_fresh():
+        await run_db(ensure_catalog)
+    
+    results = []
+    pending = []   # (موضع النتيجة، رقم المنتج، delta، clear)
+    with _catalog_lock:
+        for item in movements:
+            product_number = normalize_pn(item.product_number)
+            if product_number not in _catalog_snapshot:
+                results.append({"product_number": product_number, "ok": False, "error": "المنتج غير موجود"})
+                continue
+            delta = item.delta if item.action is None else (-1 if item.action == "sold_one" else 0)
+            results.append({"product_number": product_number, "ok": True})
+            pending.append((len(results) - 1, product_number, delta, item.action == "sold_all"))
+    
+    states = await run_db(adjust_quantities_in_db, [(pn, delta, clear) for _, pn, delta, clear in pending]) if pending else []
+    
+    changed = {}
+    for (index, product_number, _, _), state in zip(pending, states):
+        if isinstance(state, Exception):
+            results[index].update({"ok": False, "error": f"خطأ في قاعدة البيانات: {state}"})
+            continue
+        results[index].update({
+            "quantity_before": state["quantity"] - state["applied"],
+            "quantity": state["quantity"],
+            "applied": state["applied"]
+        })
+        changed[product_number] = True
+    
+    # تحديث واحد لرسالة كل منتج (dedupe في الـ outbox ودمج التعديلات في طابور التليجرام)،
+    # حتى لو لم يُحفظ message_id بعد لأن المهمة تعيد قراءة المنتج
+    for product_number in changed:
+        outbox.enqueue("telegram_upsert", product_number, dedupe=True)
+    
+    return {
+        "results": results,
+        "updated_products": len({r["product_number"] for r in results if r["ok"] and r["applied"]}),
+        "failed": sum(1 for r in results if not r["ok"])
+    }
+
 @app.patch("/api/products/{product_number:path}")
 async def update_product(
     product_number: str,
@@ -841,12 +3592,12 @@ async def update_product(
             wholesale_price_iqd = float(str(wholesale_price_iqd).replace(',', ''))
     except Exception as e:
         raise HTTPException(status_code=400, detail="صيغة السعر غير صحيحة")
-    cache = load_cache()
+    cache = await run_db(load_cache)
     
     if product_number not in cache:
         raise HTTPException(status_code=404, detail="المنتج غير موجود")
     
-    product = cache[product_number]
+    product = dict(cache[product_number])
     
     # تحديث الحقول المرسلة فقط
     if product_name is not None:
@@ -872,10 +3623,14 @@ async def update_product(
         product["product_number"] = new_product_number
     
     # تحديث الصورة إذا تم رفع صورة جديدة
+    pending_image = None
     if image:
-        image_content = await image.read()
-        image_url = await upload_image_to_imgbb(image_content)
-        product["image"] = image_url
+        images = await receive_product_image(image)
+        if "pending" in images:
+            pending_image = images
+        else:
+            # صورة بدون مصغرة (Pillow غير متوفر مثلاً): "" تمسح مصغرة الصورة القديمة في Convex
+            product.update(image=images["image"], thumbnail=images.get("thumbnail") or "")
         
     product["last_update"] = datetime.now().isoformat()
     
@@ -886,17 +3641,13 @@ async def update_product(
     # updateProduct mutation in TS handles partial updates if we passed just ID and fields.
     # Here we are calling a wrapper that calls TS mutation.
     
-    update_product_in_db(product_number, product)
+    await run_db(update_product_in_db, product_number, product)
     
-    # Update on Telegram
-    msg_id = product.get("message_id")
-    if msg_id:
-        try:
-            new_msg_id = await send_to_telegram(product, product.get("image"), message_id=msg_id)
-            if new_msg_id and new_msg_id != msg_id:
-                update_product_in_db(product_number, {"message_id": new_msg_id})
-        except Exception as e:
-            print(f"Telegram Update Error: {e}")
+    # Update on Telegram (في الخلفية): المعالج ينشر رسالة جديدة إن لم تكن هناك رسالة
+    outbox.enqueue("telegram_upsert", product["product_number"], dedupe=True)
+    if pending_image:
+        outbox.enqueue("image_upload", normalize_pn(product["product_number"]), pending_image)
+        product["image_pending"] = True
     
     return product
 
@@ -942,19 +3693,19 @@ async def delete_product(
 ):
     """حذف منتج - يُحذف من التليجرام والكاش"""
     product_number = normalize_pn(product_number)
-    cache = load_cache()
+    cache = await run_db(load_cache)
     
     if product_number not in cache:
         raise HTTPException(status_code=404, detail="المنتج غير موجود")
     
     product = cache[product_number]
     
-    # حذف من التليجرام
-    if product.get("message_id"):
-        await delete_from_telegram(product["message_id"])
-    
     # حذف من Convex
-    delete_product_from_db(product_number)
+    await run_db(delete_product_from_db, product_number)
+    
+    # حذف من التليجرام (في الخلفية)
+    if product.get("message_id"):
+        outbox.enqueue("telegram_delete", product_number, {"message_id": product["message_id"]})
     
     return {"status": "deleted", "product_number": product_number}
 
@@ -969,19 +3720,19 @@ async def health_check():
     
     # Check Telegram
     if BOT_TOKEN and CHAT_ID:
-        async with httpx.AsyncClient(timeout=10) as client:
-            try:
-                resp = await client.get(f"{TG_URL}/getMe")
-                if resp.status_code == 200:
-                    bot_info = resp.json()["result"]
-                    status["telegram"] = {
-                        "status": "ok",
-                        "bot_username": bot_info.get("username"),
-                        "bot_name": bot_info.get("first_name"),
-                        "chat_id": CHAT_ID
-                    }
-            except:
-                status["telegram"] = {"status": "error", "message": "فشل الاتصال"}
+        client = http_client("telegram")
+        try:
+            resp = await client.get(f"{TG_URL}/getMe", timeout=10)
+            if resp.status_code == 200:
+                bot_info = resp.json()["result"]
+                status["telegram"] = {
+                    "status": "ok",
+                    "bot_username": bot_info.get("username"),
+                    "bot_name": bot_info.get("first_name"),
+                    "chat_id": CHAT_ID
+                }
+        except:
+            status["telegram"] = {"status": "error", "message": "فشل الاتصال"}
     
     # Check ImgBB
     if IMGBB_API_KEY and IMGBB_API_KEY != "ضع_مفتاح_imgbb_هنا":
@@ -996,7 +3747,7 @@ async def health_check():
 def create_backup(backup_type: str = "manual"):
     """إنشاء نسخة احتياطية مرتبة ومنسقة"""
     try:
-        cache = load_cache()
+        cache, statistics = catalog_with_statistics()
         
         now = datetime.now()
         timestamp = now.strftime("%Y%m%d_%H%M%S")
@@ -1009,20 +3760,10 @@ def create_backup(backup_type: str = "manual"):
                 "total_products": len(cache),
                 "created_by": "Auto Backup System"
             },
-            "statistics": {
-                "total_value": sum(p.get("price_iqd", 0) for p in cache.values()),
-                "total_wholesale_value": sum(p.get("wholesale_price_iqd", 0) for p in cache.values()),
-                "products_by_type": {}
-            },
+            "statistics": statistics,
             "products": dict(sorted(cache.items()))
         }
         
-        # إحصائيات حسب النوع
-        for product in cache.values():
-            ptype = product.get("type", "غير محدد")
-            backup_data["statistics"]["products_by_type"][ptype] = \
-                backup_data["statistics"]["products_by_type"].get(ptype, 0) + 1
-        
         # حفظ النسخة الاحتياطية محلياً
         filename = f"backup_{backup_type}_{timestamp}.json"
         filepath = os.path.join(BACKUP_DIR, filename)
@@ -1047,7 +3788,7 @@ def create_backup(backup_type: str = "manual"):
         
         # إرسال للتليجرام
         if BOT_TOKEN and CHAT_ID:
-            asyncio.create_task(send_backup_notification(backup_type, len(cache), filepath))
+            spawn(send_backup_notification(backup_type, len(cache), filepath))
         
         return filepath
         
@@ -1068,21 +3809,21 @@ async def send_backup_notification(backup_type: str, total_products: int, filepa
 ✅ تم الحفظ بنجاح
 """
         
-        async with httpx.AsyncClient(timeout=30) as client:
-            # إرسال الرسالة
-            await client.post(
-                f"{TG_URL}/sendMessage",
-                json={"chat_id": CHAT_ID, "text": message, "parse_mode": "HTML"}
+        # إرسال الرسالة
+        await telegram_queue.call(
+            "sendMessage",
+            json={"chat_id": CHAT_ID, "text": message, "parse_mode": "HTML"}
+        )
+        
+        # إرسال الملف
+        with open(filepath, "rb") as f:
+            files = {"document": (os.path.basename(filepath), f, "application/json")}
+            await telegram_queue.call(
+                "sendDocument",
+                data={"chat_id": CHAT_ID, "caption": "📎 ملف النسخة الاحتياطية"},
+                files=files,
+                timeout=60
             )
-            
-            # إرسال الملف
-            with open(filepath, "rb") as f:
-                files = {"document": (os.path.basename(filepath), f, "application/json")}
-                await client.post(
-                    f"{TG_URL}/sendDocument",
-                    data={"chat_id": CHAT_ID, "caption": "📎 ملف النسخة الاحتياطية"},
-                    files=files
-                )
     except Exception as e:
         print(f"Notification Error: {e}")
 
@@ -1105,7 +3846,28 @@ def cleanup_old_backups(days: int = 30):
 @app.on_event("startup")
 async def startup_event():
     """تشغيل المهام التلقائية عند بدء السيرفر"""
+    global _main_loop, _db_executor
+    _main_loop = asyncio.get_running_loop()
+    if _db_executor is None:
+        _db_executor = _new_db_executor()
+    for name in HTTP_UPSTREAMS:
+        http_client(name)
+    outbox.start()
     asyncio.create_task(auto_backup_scheduler())
+    asyncio.create_task(stats_reconcile_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """إيقاف الموارد المشتركة عند إغلاق السيرفر"""
+    global _db_executor
+    await outbox.drain(OUTBOX_DRAIN_TIMEOUT)
+    # كتابات Convex التي أُعلن نجاحها للمستدعين ولم تُرسل بعد
+    await asyncio.get_running_loop().run_in_executor(None, convex_batcher.drain, OUTBOX_DRAIN_TIMEOUT)
+    await telegram_queue.close()
+    await close_http_clients()
+    executor, _db_executor = _db_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
 
 async def auto_backup_scheduler():
     """جدولة النسخ الاحتياطية التلقائية"""
@@ -1118,14 +3880,14 @@ async def auto_backup_scheduler():
             
             # نسخة احتياطية يومية (كل يوم الساعة 2 صباحاً)
             if last_daily_backup != now.date() and now.hour == 2:
-                create_backup("daily")
+                await run_db(create_backup, "daily")
                 last_daily_backup = now.date()
                 print(f"Daily backup created: {now}")
             
             # نسخة احتياطية أسبوعية (كل يوم جمعة الساعة 3 صباحاً)
             week_num = now.isocalendar()[1]
             if last_weekly_backup != week_num and now.weekday() == 4 and now.hour == 3:
-                create_backup("weekly")
+                await run_db(create_backup, "weekly")
                 last_weekly_backup = week_num
                 cleanup_old_backups(30)  # حذف النسخ الأقدم من 30 يوم
                 print(f"Weekly backup created: {now}")
@@ -1140,7 +3902,7 @@ async def auto_backup_scheduler():
 @app.post("/api/backup/manual")
 async def create_manual_backup(session: dict = Depends(get_current_user)):
     """إنشاء نسخة احتياطية يدوية"""
-    filepath = create_backup("manual")
+    filepath = await run_db(create_backup, "manual")
     
     if filepath:
         return {
@@ -1177,121 +3939,586 @@ async def list_backups(session: dict = Depends(get_current_user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في قراءة النسخ الاحتياطية: {str(e)}")
 
+# ================================
+# Streaming Export
+# ================================
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+EXPORT_COLUMNS = [
+    "product_number", "product_name", "car_name", "model_number", "type",
+    "quantity", "original_quantity", "price_iqd", "wholesale_price_iqd",
+    "status", "image", "thumbnail", "message_id", "telegram_file_id", "telegram_photo", "last_update"
+]
+EXPORT_NUMERIC_COLUMNS = {"quantity", "original_quantity", "price_iqd", "wholesale_price_iqd", "message_id"}
+
+def catalog_keys() -> list:
+    """أرقام المنتجات مرتبة (المصدر المقسم إلى صفحات للتصدير)"""
+    if not ensure_catalog():
+        return []
+    with _catalog_lock:
+        return sorted(_catalog_snapshot)
+
+def iter_catalog_pages(keys: list, page_size: int = EXPORT_PAGE_SIZE):
+    """قراءة المنتجات صفحةً صفحة من اللقطة بدل نسخ الكتالوج كاملاً (المحذوف أثناء التصدير يُتخطى)"""
+    for i in range(0, len(keys), page_size):
+        with _catalog_lock:
+            page = [(key, _catalog_snapshot[key]) for key in keys[i:i + page_size] if key in _catalog_snapshot]
+        if page:
+            yield page
+
+class ExportStatistics:
+    """إحصائيات التصدير تُجمع أثناء المرور نفسه على المنتجات"""
+
+    def __init__(self):
+        self.total_products = 0
+        self.total_value = 0
+        self.total_wholesale_value = 0
+        self.products_by_type = {}
+
+    def add(self, product: dict):
+        self.total_products += 1
+        self.total_value += product.get("price_iqd", 0) or 0
+        self.total_wholesale_value += product.get("wholesale_price_iqd", 0) or 0
+        ptype = product.get("type", "غير محدد")
+        self.products_by_type[ptype] = self.products_by_type.get(ptype, 0) + 1
+
+    def as_dict(self) -> dict:
+        return {
+            "total_products": self.total_products,
+            "total_value": self.total_value,
+            "total_wholesale_value": self.total_wholesale_value,
+            "products_by_type": self.products_by_type
+        }
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False)
+
+def export_json(keys: list, backup_info: dict, stats: ExportStatistics):
+    """نفس شكل النسخة الاحتياطية القديم، مع الإحصائيات بعد المنتجات"""
+    yield f'{{"backup_info": {_dumps(backup_info)}, "products": {{'.encode("utf-8")
+    separator = ""
+    for page in iter_catalog_pages(keys):
+        chunk = []
+        for key, product in page:
+            stats.add(product)
+            chunk.append(f"{separator}{_dumps(key)}: {_dumps(product)}")
+            separator = ", "
+        yield "".join(chunk).encode("utf-8")
+    yield f'}}, "statistics": {_dumps(stats.as_dict())}}}'.encode("utf-8")
+
+def export_ndjson(keys: list, backup_info: dict, stats: ExportStatistics):
+    """سطر backup_info، ثم سطر لكل منتج، ثم سطر statistics"""
+    yield (_dumps({"backup_info": backup_info}) + "\n").encode("utf-8")
+    for page in iter_catalog_pages(keys):
+        lines = []
+        for _, product in page:
+            stats.add(product)
+            lines.append(_dumps(product) + "\n")
+        yield "".join(lines).encode("utf-8")
+    yield (_dumps({"statistics": stats.as_dict()}) + "\n").encode("utf-8")
+
+def export_csv(keys: list, backup_info: dict, stats: ExportStatistics):
+    """CSV مع BOM ليفتحه Excel بالعربية بشكل صحيح (بدون إحصائيات: لا مكان لها في الملف)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(EXPORT_COLUMNS)
+    for page in iter_catalog_pages(keys):
+        for _, product in page:
+            writer.writerow(["" if product.get(c) is None else product.get(c) for c in EXPORT_COLUMNS])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+class _ChunkSink:
+    """ملف للكتابة فقط يجمع ما يكتبه ParquetWriter لإرساله بعد كل صفحة"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def export_parquet(keys: list, backup_info: dict, stats: ExportStatistics):
+    """مجموعة صفوف (row group) لكل صفحة، والإحصائيات في بيانات الملف الوصفية"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [(c, pa.float64() if c in EXPORT_NUMERIC_COLUMNS else pa.string()) for c in EXPORT_COLUMNS],
+        metadata={"backup_info": _dumps(backup_info)}
+    )
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    for page in iter_catalog_pages(keys):
+        columns = {c: [] for c in EXPORT_COLUMNS}
+        for _, product in page:
+            stats.add(product)
+            for c in EXPORT_COLUMNS:
+                value = product.get(c)
+                if value is not None:
+                    value = float(value) if c in EXPORT_NUMERIC_COLUMNS else str(value)
+                columns[c].append(value)
+        writer.write_table(pa.table(columns, schema=schema))
+        yield sink.drain()
+    if hasattr(writer, "add_key_value_metadata"):
+        writer.add_key_value_metadata({"statistics": _dumps(stats.as_dict())})
+    writer.close()
+    yield sink.drain()
+
+# الصيغة -> (المولّد، نوع المحتوى، امتداد الملف)
+EXPORT_FORMATS = {
+    "json": (export_json, "application/json", "json"),
+    "ndjson": (export_ndjson, "application/x-ndjson", "ndjson"),
+    "csv": (export_csv, "text/csv; charset=utf-8", "csv"),
+    "parquet": (export_parquet, "application/vnd.apache.parquet", "parquet"),
+}
+
+# ================================
+# Streaming Import
+# ================================
+
+IMPORT_BATCH_SIZE = max(1, int(os.getenv("IMPORT_BATCH_SIZE", "200")))
+IMPORT_CONCURRENCY = max(1, int(os.getenv("IMPORT_CONCURRENCY", "4")))
+IMPORT_READ_SIZE = 64 * 1024
+IMPORT_MAX_ROW_BYTES = 1024 * 1024  # منتج واحد لا يتجاوز هذا الحجم في ملف سليم
+IMPORT_MAX_ERRORS = 1000
+
+# الحقول التي يقبلها products:importProducts ونوع كل منها
+IMPORT_FIELDS = {
+    "product_name": str, "car_name": str, "model_number": str, "type": str,
+    "quantity": int, "price_iqd": float, "wholesale_price_iqd": float,
+    "image": str, "thumbnail": str, "original_quantity": int, "message_id": int, "last_update": str,
+    "telegram_file_id": str, "telegram_photo": str,
+}
+IMPORT_REQUIRED = ("product_name", "quantity", "price_iqd")
+
+class ImportFormatError(ValueError):
+    pass
+
+class BackupStreamParser:
+    """محلل تدريجي لملف النسخة الاحتياطية JSON
+
+    يمر على مفاتيح المستوى الأعلى ويُخرج عناصر "products" (قاموس أو قائمة) واحداً واحداً
+    دون تحميل الملف كاملاً. يُغذّى بأجزاء نصية عبر feed().
+    """
+
+    _WS = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+        self._decoder = json.JSONDecoder()
+        self.found_products = False
+
+    def _skip_ws(self) -> bool:
+        self._pos = self._WS.match(self._buf, self._pos).end()
+        return self._pos < len(self._buf)
+
+    def _value(self, final: bool):
+        """قراءة قيمة JSON كاملة من الموضع الحالي، أو None إذا لم تكتمل بعد"""
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError as e:
+            if final or len(self._buf) - self._pos > IMPORT_MAX_ROW_BYTES:
+                raise ImportFormatError(f"JSON غير صالح: {e}")
+            return None
+        # رقم في نهاية الجزء قد تكون بقيته في الجزء التالي
+        if end == len(self._buf) and not final and not isinstance(value, (dict, list, str)):
+            return None
+        self._pos = end
+        return (value,)
+
+    def _expect(self, chars: str) -> str:
+        char = self._buf[self._pos]
+        if char not in chars:
+            raise ImportFormatError(f"JSON غير صالح: '{char}' غير متوقع")
+        self._pos += 1
+        return char
+
+    def feed(self, text: str, final: bool = False) -> list:
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        items = []
+        while self._skip_ws():
+            state = self._state
+            if state == "start":
+                self._expect("{")
+                self._state = "top_key"
+            elif state in ("top_key", "entry_key"):
+                char = self._buf[self._pos]
+                if char == ",":
+                    self._pos += 1
+                    continue
+                if char == "}":
+                    self._pos += 1
+                    self._state = "end" if state == "top_key" else "top_key"
+                    continue
+                key = self._value(final)
+                if key is None:
+                    break
+                if not isinstance(key[0], str):
+                    raise ImportFormatError("JSON غير صالح: مفتاح غير نصي")
+                self._key = key[0]
+                self._state = "top_colon" if state == "top_key" else "entry_colon"
+            elif state in ("top_colon", "entry_colon"):
+                self._expect(":")
+                if state == "entry_colon":
+                    self._state = "entry_value"
+                elif self._key == "products":
+                    self.found_products = True
+                    self._state = "products_open"
+                else:
+                    self._state = "top_value"
+            elif state == "top_value":
+                if self._value(final) is None:
+                    break
+                self._state = "top_key"
+            elif state == "products_open":
+                self._state = "entry_key" if self._expect("{[") == "{" else "item"
+            elif state == "entry_value":
+                value = self._value(final)
+                if value is None:
+                    break
+                items.append((self._key, value[0]))
+                self._state = "entry_key"
+            elif state == "item":
+                char = self._buf[self._pos]
+                if char == ",":
+                    self._pos += 1
+                    continue
+                if char == "]":
+                    self._pos += 1
+                    self._state = "top_key"
+                    continue
+                value = self._value(final)
+                if value is None:
+                    break
+                product = value[0]
+                items.append((product.get("product_number") if isinstance(product, dict) else None, product))
+            else:
+                raise ImportFormatError("JSON غير صالح: بيانات بعد نهاية الملف")
+        if final and self._state != "end":
+            raise ImportFormatError("JSON غير صالح: الملف غير مكتمل")
+        return items
+
+class UploadRowParser:
+    """تحويل أجزاء الملف المرفوع إلى صفوف importProducts جاهزة (يعمل في خيط منفصل)
+
+    كل استدعاء لـ feed يُرجع [(رقم المنتج، الصف أو None، الخطأ أو None)].
+    """
+
+    def __init__(self, fmt: str):
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._parser = BackupStreamParser() if fmt == "json" else None
+        self._pending = ""
+        self._line_no = 0
+
+    def _records(self, text: str, final: bool):
+        if self._parser is not None:
+            for key, product in self._parser.feed(text, final):
+                yield key, product, None
+            if final and not self._parser.found_products:
+                raise ImportFormatError("ملف غير صالح - لا يحتوي على بيانات منتجات")
+            return
+        self._pending += text
+        lines = self._pending.split("\n")
+        self._pending = "" if final else lines.pop()
+        if len(self._pending) > IMPORT_MAX_ROW_BYTES:
+            raise ImportFormatError(f"سطر أطول من المسموح بعد السطر {self._line_no}")
+        for line in lines:
+            self._line_no += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield None, None, f"السطر {self._line_no}: JSON غير صالح ({e.msg})"
+                continue
+            # أسطر backup_info و statistics في ملفات التصدير ليست منتجات
+            if isinstance(record, dict) and "product_number" not in record and (
+                    "backup_info" in record or "statistics" in record):
+                continue
+            yield (record.get("product_number") if isinstance(record, dict) else None), record, None
+
+    def feed(self, chunk: bytes, final: bool) -> list:
+        try:
+            text = self._decoder.decode(chunk, final=final)
+        except UnicodeDecodeError:
+            raise ImportFormatError("الملف ليس بترميز UTF-8")
+        rows = []
+        for product_number, data, error in self._records(text, final):
+            if error:
+                rows.append((product_number, None, error))
+                continue
+            try:
+                rows.append((product_number, clean_import_row(product_number, data), None))
+            except ValueError as e:
+                rows.append((product_number, None, str(e)))
+        return rows
+
+async def iter_upload_products(file: UploadFile, fmt: str):
+    """قراءة المنتجات من الملف المرفوع تدريجياً: (رقم المنتج، الصف النظيف، خطأ السطر)
+
+    فك الترميز والتحليل والتحقق تجري في خيط حتى لا تحجب حلقة الأحداث.
+    """
+    loop = asyncio.get_running_loop()
+    parser = UploadRowParser(fmt)
+    while True:
+        chunk = await file.read(IMPORT_READ_SIZE)
+        final = not chunk
+        for item in await loop.run_in_executor(None, parser.feed, chunk, final):
+            yield item
+        if final:
+            break
+
+def clean_import_row(product_number, data) -> dict:
+    """تحويل منتج من الملف إلى وسائط products:importProducts (مع التحقق من الأنواع)"""
+    if not isinstance(data, dict):
+        raise ValueError("بيانات المنتج ليست كائن JSON")
+    product_number = data.get("product_number") or product_number
+    if not product_number:
+        raise ValueError("رقم المنتج مفقود")
+    row = {"product_number": normalize_pn(product_number)}
+    for field, kind in IMPORT_FIELDS.items():
+        value = data.get(field)
+        if value is None or (kind is not str and value == ""):
+            continue
+        try:
+            if kind is int:
+                # "5" و 5.0 مقبولة، أما 5.5 فلا
+                number = float(value)
+                if not number.is_integer():
+                    raise ValueError
+                row[field] = int(number)
+            else:
+                row[field] = kind(value)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"قيمة غير صالحة للحقل {field}")
+    missing = [f for f in IMPORT_REQUIRED if f not in row]
+    if missing:
+        raise ValueError(f"حقول مفقودة: {', '.join(missing)}")
+    row.setdefault("car_name", "")
+    row.setdefault("model_number", "")
+    row.setdefault("type", "")
+    row.setdefault("wholesale_price_iqd", 0.0)
+    return row
+
+# آخر عمليات الاستيراد (للاستعلام عن التقدم أثناء التنفيذ)
+import_jobs = collections.OrderedDict()
+
+class ImportJob:
+    """عملية استيراد واحدة: تحليل تدريجي، مقارنة بالكتالوج، ثم كتابة على دفعات متوازية محدودة"""
+
+    def __init__(self, filename: str, fmt: str):
+        self.id = secrets.token_hex(8)
+        self.stats = {
+            "job_id": self.id,
+            "filename": filename,
+            "format": fmt,
+            "status": "running",
+            "started_at": datetime.now().isoformat(),
+            "finished_at": None,
+            "total_imported": 0,
+            "new_products": 0,
+            "updated_products": 0,
+            "skipped_duplicates": 0,
+            "failed": 0,
+            "batches_sent": 0,
+            "errors": []
+        }
+        import_jobs[self.id] = self.stats
+        while len(import_jobs) > 20:
+            import_jobs.popitem(last=False)
+
+    def _error(self, product_number, error):
+        self.stats["failed"] += 1
+        if len(self.stats["errors"]) < IMPORT_MAX_ERRORS:
+            self.stats["errors"].append({"product_number": product_number, "error": str(error)})
+
+    def _apply(self, row: dict, result: dict):
+        action = result.get("action")
+        if action == "skipped":
+            self.stats["skipped_duplicates"] += 1
+            return
+        self.stats["new_products" if action == "created" else "updated_products"] += 1
+        key = normalize_pn(row["product_number"])
+        with _catalog_lock:
+            current = _catalog_snapshot.get(key) or {}
+        product = {**current, **row, "_id": result.get("id"), "last_update": result.get("last_update")}
+        product.setdefault("original_quantity", row["quantity"])
+        product["status"] = "متوفر" if row["quantity"] > 0 else "نفذ"
+        _snapshot_put(product)
+
+    async def _send(self, batch: list):
+        self.stats["batches_sent"] += 1
+        try:
+            results = await run_db(convex_client.mutation, "products:importProducts", {"products": batch})
+        except Exception as e:
+            if len(batch) == 1:
+                self._error(batch[0]["product_number"], e)
+                return
+            # فشل الدفعة كاملة: إعادة إرسال صفوفها واحداً واحداً لمعرفة الصف المسبب
+            for row in batch:
+                await self._send([row])
+            return
+        for row, result in zip(batch, results or []):
+            self._apply(row, result)
+
+    async def run(self, file: UploadFile, fmt: str) -> dict:
+        slots = asyncio.Semaphore(IMPORT_CONCURRENCY)
+        tasks = set()
+
+        async def send(batch):
+            try:
+                await self._send(batch)
+            finally:
+                slots.release()
+
+        async def flush(batch):
+            # لا تبدأ دفعة جديدة قبل أن يتحرر مكان (يحد الذاكرة والضغط على Convex)
+            await slots.acquire()
+            task = asyncio.create_task(send(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        batch = []
+        try:
+            async for product_number, row, line_error in iter_upload_products(file, fmt):
+                self.stats["total_imported"] += 1
+                if line_error:
+                    self._error(product_number, line_error)
+                    continue
+                with _catalog_lock:
+                    existing = _catalog_snapshot.get(normalize_pn(row["product_number"]))
+                if existing is not None and row.get("last_update", "") <= existing.get("last_update", ""):
+                    # البيانات الحالية أحدث - نتجاهل
+                    self.stats["skipped_duplicates"] += 1
+                    continue
+                batch.append(row)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    await flush(batch)
+                    batch = []
+            if batch:
+                await flush(batch)
+            if tasks:
+                await asyncio.gather(*list(tasks))
+            self.stats["status"] = "done"
+        except Exception as e:
+            if tasks:
+                await asyncio.gather(*list(tasks), return_exceptions=True)
+            self.stats["status"] = "failed"
+            self.stats["error"] = str(e)
+            raise
+        finally:
+            self.stats["finished_at"] = datetime.now().isoformat()
+        return self.stats
+
 # ================================
 # Smart Backup & Restore System
 # ================================
 
 @app.get("/api/export")
-async def export_data(session: dict = Depends(require_permission("export"))):
-    """تصدير جميع البيانات (نسخة احتياطية ذكية ومرتبة)"""
-    cache = load_cache()
+async def export_data(
+    format: str = Query("json"),
+    session: dict = Depends(require_permission("export"))
+):
+    """تصدير جميع البيانات بشكل متدفق (json أو ndjson أو csv أو parquet)
+
+    المنتجات تُقرأ صفحةً صفحة وتُرسل فوراً، والإحصائيات تُجمع في نفس المرور وتأتي في النهاية.
+    """
+    fmt = format.lower()
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"صيغة غير مدعومة - المتاح: {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=400, detail="التصدير بصيغة Parquet يتطلب تثبيت pyarrow")
     
-    now = datetime.now()
+    keys = await run_db(catalog_keys)
     
-    backup = {
-        "backup_info": {
-            "version": "5.0.0",
-            "export_type": "manual",
-            "export_date": now.isoformat(),
-            "total_products": len(cache),
-            "exported_by": "User"
-        },
-        "statistics": {
-            "total_value": sum(p.get("price_iqd", 0) for p in cache.values()),
-            "total_wholesale_value": sum(p.get("wholesale_price_iqd", 0) for p in cache.values()),
-            "products_by_type": {},
-            "products_by_location": {}
-        },
-        "products": dict(sorted(cache.items()))
+    now = datetime.now()
+    backup_info = {
+        "version": "5.0.0",
+        "export_type": "manual",
+        "export_date": now.isoformat(),
+        "total_products": len(keys),
+        "exported_by": "User"
     }
     
-    # إحصائيات حسب النوع
-    for product in cache.values():
-        ptype = product.get("type", "غير محدد")
-        backup["statistics"]["products_by_type"][ptype] = \
-            backup["statistics"]["products_by_type"].get(ptype, 0) + 1
-        
-        location = product.get("location", "غير محدد")
-        backup["statistics"]["products_by_location"][location] = \
-            backup["statistics"]["products_by_location"].get(location, 0) + 1
-    
-    from fastapi.responses import JSONResponse
-    return JSONResponse(
-        content=backup,
+    writer, media_type, extension = EXPORT_FORMATS[fmt]
+    return StreamingResponse(
+        writer(keys, backup_info, ExportStatistics()),
+        media_type=media_type,
         headers={
-            "Content-Disposition": f"attachment; filename=car_stock_backup_{now.strftime('%Y%m%d_%H%M%S')}.json"
+            "Content-Disposition": f"attachment; filename=car_stock_backup_{now.strftime('%Y%m%d_%H%M%S')}.{extension}"
         }
     )
 
 @app.post("/api/import")
 async def import_data(
     file: UploadFile = File(...),
+    format: Optional[str] = Query(None),
     session: dict = Depends(require_permission("import"))
 ):
-    """استيراد البيانات بذكاء (يتجنب التكرار والخسارة)"""
+    """استيراد البيانات بذكاء (يتجنب التكرار والخسارة)
+
+    الملف يُقرأ تدريجياً (json أو ndjson حسب format أو امتداد الملف)، ويُقارن last_update
+    بالكتالوج الحالي، والجديد أو الأحدث يُكتب في Convex على دفعات. التقدم في /api/import/progress.
+    """
+    fmt = (format or ("ndjson" if (file.filename or "").lower().endswith((".ndjson", ".jsonl")) else "json")).lower()
+    if fmt not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="صيغة غير مدعومة - المتاح: json, ndjson")
+    if not convex_client:
+        raise HTTPException(status_code=500, detail="قاعدة البيانات غير متصلة")
     
+    await run_db(ensure_catalog)
+    job = ImportJob(file.filename or "", fmt)
     try:
-        # قراءة الملف
-        content = await file.read()
-        imported_data = json.loads(content.decode('utf-8'))
-        
-        # التحقق من صحة البيانات
-        if "products" not in imported_data:
-            raise HTTPException(status_code=400, detail="ملف غير صالح - لا يحتوي على بيانات منتجات")
-        
-        cache = load_cache()
-        
-        stats = {
-            "total_imported": 0,
-            "new_products": 0,
-            "skipped_duplicates": 0,
-            "updated_products": 0,
-            "errors": []
-        }
-        
-        imported_products = imported_data["products"]
-        
-        for product_number, product_data in imported_products.items():
-            try:
-                stats["total_imported"] += 1
-                
-                if product_number in cache:
-                    # المنتج موجود - نتحقق من التحديث
-                    existing = cache[product_number]
-                    existing_date = existing.get("last_update", "")
-                    new_date = product_data.get("last_update", "")
-                    
-                    if new_date > existing_date:
-                        # البيانات المستوردة أحدث
-                        cache[product_number] = product_data
-                        stats["updated_products"] += 1
-                    else:
-                        # البيانات الحالية أحدث - نتجاهل
-                        stats["skipped_duplicates"] += 1
-                else:
-                    # منتج جديد
-                    cache[product_number] = product_data
-                    stats["new_products"] += 1
-                    
-            except Exception as e:
-                stats["errors"].append({
-                    "product_number": product_number,
-                    "error": str(e)
-                })
-        
-        # حفظ البيانات المحدثة
-        save_cache(cache)
-        
-        return {
-            "status": "success",
-            "message": "تم الاستيراد بنجاح",
-            "statistics": stats
-        }
-        
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="ملف JSON غير صالح")
+        stats = await job.run(file, fmt)
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"خطأ في الاستيراد: {str(e)}")
+    
+    return {
+        "status": "success",
+        "message": "تم الاستيراد بنجاح",
+        "statistics": stats
+    }
+
+@app.get("/api/import/progress")
+async def import_progress(job_id: Optional[str] = None, session: dict = Depends(require_permission("import"))):
+    """تقدم عمليات الاستيراد (الجارية والأخيرة)"""
+    if job_id:
+        if job_id not in import_jobs:
+            raise HTTPException(status_code=404, detail="عملية الاستيراد غير موجودة")
+        return import_jobs[job_id]
+    return list(reversed(import_jobs.values()))
 
 
 async def sync_from_telegram():
@@ -1300,43 +4527,43 @@ async def sync_from_telegram():
     if not BOT_TOKEN or not CHAT_ID:
         raise HTTPException(status_code=500, detail="التليجرام غير مُعد")
     
-    async with httpx.AsyncClient(timeout=60) as client:
-        try:
-            # جلب آخر 100 رسالة من القناة
-            resp = await client.get(
-                f"{TG_URL}/getUpdates",
-                params={"limit": 100}
-            )
-            
-            if resp.status_code != 200:
-                raise Exception("فشل الاتصال بالتليجرام")
-            
-            updates = resp.json().get("result", [])
-            
-            cache = load_cache()
-            synced_count = 0
-            
-            for update in updates:
-                message = update.get("message", {})
-                if message.get("chat", {}).get("id") == int(CHAT_ID):
-                    # استخراج البيانات من caption
-                    caption = message.get("caption", "")
-                    # يمكن تطوير parser ذكي هنا
-                    synced_count += 1
-            
-            return {
-                "status": "success",
-                "synced_messages": synced_count,
-                "total_products": len(cache)
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"خطأ في المزامنة: {str(e)}")
+    client = http_client("telegram")
+    try:
+        # جلب آخر 100 رسالة من القناة
+        resp = await client.get(
+            f"{TG_URL}/getUpdates",
+            params={"limit": 100}
+        )
+        
+        if resp.status_code != 200:
+            raise Exception("فشل الاتصال بالتليجرام")
+        
+        updates = resp.json().get("result", [])
+        
+        cache = await run_db(load_cache)
+        synced_count = 0
+        
+        for update in updates:
+            message = update.get("message", {})
+            if message.get("chat", {}).get("id") == int(CHAT_ID):
+                # استخراج البيانات من caption
+                caption = message.get("caption", "")
+                # يمكن تطوير parser ذكي هنا
+                synced_count += 1
+        
+        return {
+            "status": "success",
+            "synced_messages": synced_count,
+            "total_products": len(cache)
+        }
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في المزامنة: {str(e)}")
 
 @app.get("/api/backup-status")
 async def backup_status(session: dict = Depends(get_current_user)):
     """حالة النسخ الاحتياطي"""
-    cache = load_cache()
+    cache = await run_db(load_cache)
     
     if not cache:
         return {
@@ -0,0 +1,196 @@
+import copy
+import itertools
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+# الخادم يكتب قواعد SQLite والنسخ الاحتياطية في مجلد العمل
+os.chdir(tempfile.mkdtemp(prefix="stock-tests-"))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "TEST")
+os.environ.setdefault("TELEGRAM_CHAT_ID", "1")
+os.environ["IMGBB_API_KEY"] = "TEST"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+class FakeConvex:
+    """بديل بسيط لـ ConvexClient يحفظ المنتجات في الذاكرة"""
+
+    def __init__(self):
+        self.docs = {}
+        self.ids = itertools.count(1)
+        # inject(name, args) يُستدعى قبل كل mutation ويمكنه رمي استثناء لمحاكاة فشل Convex
+        self.inject = None
+
+    def query(self, name, args=None):
+        if name == "products:getProducts":
+            return [dict(d, imageUrl=d.get("image")) for d in copy.deepcopy(list(self.docs.values()))]
+        if name == "products:getProductByNumber":
+            for d in self.docs.values():
+                if d.get("product_number") == args["product_number"]:
+                    return copy.deepcopy(d)
+            return None
+        raise KeyError(name)
+
+    def mutation(self, name, args=None):
+        if self.inject is not None:
+            self.inject(name, args)
+        if name == "products:importProducts":
+            return [self._import(row) for row in args["products"]]
+        if name != "products:applyBatch":
+            raise KeyError(name)
+        results = []
+        for op in args["ops"]:
+            try:
+                results.append({"ok": True, "value": getattr(self, "_" + op["op"])(op)})
+            except Exception as e:
+                results.append({"ok": False, "error": str(e)})
+        return results
+
+    def _add(self, op):
+        product = op["product"]
+        _id = f"id{next(self.ids)}"
+        self.docs[_id] = dict(
+            product, _id=_id,
+            original_quantity=product.get("original_quantity", product["quantity"]),
+            status=status_for(product["quantity"]),
+            last_update="2026-01-01T00:00:00Z"
+        )
+        return _id
+
+    def _update(self, op):
+        doc = self.docs[op["id"]]
+        doc.update(op["updates"])
+        doc["status"] = status_for(doc["quantity"])
+
+    def _import(self, row):
+        existing = next((d for d in self.docs.values() if d.get("product_number") == row["product_number"]), None)
+        last_update = row.get("last_update") or "2026-01-01T00:00:00Z"
+        if existing is None:
+            _id = f"id{next(self.ids)}"
+            self.docs[_id] = dict(
+                row, _id=_id, original_quantity=row.get("original_quantity", row["quantity"]),
+                status=status_for(row["quantity"]), last_update=last_update
+            )
+            action = "created"
+        elif last_update > existing["last_update"]:
+            existing.update(row, status=status_for(row["quantity"]), last_update=last_update)
+            _id, action = existing["_id"], "updated"
+        else:
+            _id, action, last_update = existing["_id"], "skipped", existing["last_update"]
+        return {"product_number": row["product_number"], "action": action, "id": _id, "last_update": last_update}
+
+    def _delete(self, op):
+        self.docs.pop(op["id"], None)
+
+    def _adjust(self, op):
+        doc = self.docs.get(op["id"])
+        if doc is None:
+            raise Exception("Product not found")
+        before = doc["quantity"]
+        quantity = 0 if op.get("clear") else max(0, before + op["delta"])
+        doc.update(quantity=quantity, status=status_for(quantity))
+        return {
+            "quantity": quantity, "status": doc["status"], "last_update": doc["last_update"],
+            "applied": quantity - before, "message_id": doc.get("message_id")
+        }
+
+
+def status_for(quantity):
+    return "متوفر" if quantity > 0 else "نفذ"
+
+
+class FakeHttp:
+    """يسجل طلبات Bot API وImgBB ويرد بنجاح ما لم يُستبدل المعالج"""
+
+    def __init__(self):
+        self.calls = []
+        self.uploads = []
+        self.message_ids = itertools.count(500)
+        self.responder = None
+
+    def __call__(self, request):
+        if request.url.host == "api.imgbb.com":
+            # ImgBB يبني الرابط من اسم الملف المرسل
+            filename = request.content.split(b'filename="', 1)[1].split(b'"', 1)[0].decode()
+            self.uploads.append(filename)
+            url = f"https://i.ibb.co/{len(self.uploads)}/{filename}"
+            return httpx.Response(200, json={"success": True, "data": {"url": url}})
+        method = request.url.path.rsplit("/", 1)[-1]
+        self.calls.append((method, request))
+        if self.responder is not None:
+            response = self.responder(method, request)
+            if response is not None:
+                return response
+        if method in ("sendMessage", "sendPhoto"):
+            return httpx.Response(200, json={"ok": True, "result": {
+                "message_id": next(self.message_ids), "photo": [{"file_id": "tg-photo", "width": 800}]
+            }})
+        return httpx.Response(200, json={"ok": True, "result": True})
+
+    def methods(self):
+        return [method for method, _ in self.calls]
+
+
+@pytest.fixture
+def convex(monkeypatch):
+    fake = FakeConvex()
+    monkeypatch.setattr(main, "convex_client", fake)
+    reset_catalog()
+    yield fake
+    reset_catalog()
+
+
+def reset_catalog():
+    """لقطة وفهارس فارغة وغير صالحة (الطلب التالي يجلب من Convex)"""
+    with main._catalog_lock:
+        main._catalog_snapshot = {}
+        main._written_versions = {}
+    main._snapshot_replace({}, main._catalog_version)
+    main.invalidate_catalog_cache()
+
+
+@pytest.fixture
+def http(monkeypatch):
+    fake = FakeHttp()
+    monkeypatch.setattr(main, "_new_http_client", lambda name: httpx.AsyncClient(transport=httpx.MockTransport(fake)))
+    return fake
+
+
+@pytest.fixture
+def images(monkeypatch):
+    index = main.ImageIndex(":memory:")
+    monkeypatch.setattr(main, "image_index", index)
+    return index
+
+
+@pytest.fixture
+def client(convex, http, images):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def add_product(convex, **fields):
+    product = {
+        "product_number": "P1", "product_name": "فلتر", "car_name": "كامري", "model_number": "",
+        "type": "قطعة", "quantity": 5, "price_iqd": 1000.0, "wholesale_price_iqd": 800.0,
+        "image": None, "message_id": None
+    }
+    product.update(fields)
+    return convex._add({"product": product})
+
+
+def wait_for(predicate, timeout=5.0):
+    """انتظار عمل في الخلفية (صندوق الصادر) حتى يتحقق الشرط"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for background work")
+        time.sleep(0.02)
@@ -0,0 +1,170 @@
+import pytest
+
+import main
+from conftest import add_product
+
+
+class BatchConvex:
+    """applyBatch مع نتائج يمكن استبدالها لكل استدعاء"""
+
+    def __init__(self, respond=None):
+        self.batches = []
+        self.respond = respond
+
+    def mutation(self, name, args):
+        assert name == "products:applyBatch"
+        ops = args["ops"]
+        self.batches.append(ops)
+        if self.respond is not None:
+            return self.respond(ops)
+        return [{"ok": True, "value": index} for index, _ in enumerate(ops)]
+
+
+@pytest.fixture
+def batcher():
+    return main.MutationBatcher(0.05, 50)
+
+
+def use(monkeypatch, respond=None):
+    fake = BatchConvex(respond)
+    monkeypatch.setattr(main, "convex_client", fake)
+    return fake
+
+
+def update(_id, **updates):
+    return {"op": "update", "id": _id, "updates": updates}
+
+
+def wait_all(futures):
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(("ok", future.result(timeout=5)))
+        except Exception as e:
+            outcomes.append(("error", str(e)))
+    return outcomes
+
+
+@pytest.mark.parametrize("response, expected", [
+    ([{"ok": True, "value": 1}], ["error", "error"]),
+    (None, ["error", "error"]),
+    ([{"ok": True}, "bad"], ["ok", "error"]),
+])
+def test_malformed_results_fail_the_unresolved_futures(batcher, monkeypatch, response, expected):
+    use(monkeypatch, lambda ops: response)
+
+    outcomes = wait_all(batcher.submit_many([update("a", quantity=1), update("b", quantity=2)]))
+
+    assert [kind for kind, _ in outcomes] == expected
+    assert batcher.snapshot()["failed"] == expected.count("error")
+
+
+def test_sender_survives_an_unexpected_error(batcher, monkeypatch):
+    use(monkeypatch)
+    original = batcher._apply
+    calls = []
+
+    def broken(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        original(batch)
+
+    monkeypatch.setattr(batcher, "_apply", broken)
+
+    assert wait_all([batcher.submit(update("a", quantity=1))]) == [("error", "boom")]
+    assert wait_all([batcher.submit(update("a", quantity=2))]) == [("ok", 0)]
+    assert batcher.drain(5)
+
+
+def test_failed_batch_is_resent_per_op_and_counted_once(batcher, monkeypatch):
+    def respond(ops):
+        if len(ops) > 1:
+            raise Exception("ArgumentValidationError")
+        if ops[0]["id"] == "bad":
+            raise Exception("Product not found")
+        return [{"ok": True, "value": ops[0]["id"]}]
+
+    fake = use(monkeypatch, respond)
+
+    outcomes = wait_all(batcher.submit_many([update("a", x=1), update("bad", x=2), update("c", x=3)]))
+
+    assert outcomes == [("ok", "a"), ("error", "Product not found"), ("ok", "c")]
+    assert [len(ops) for ops in fake.batches] == [3, 1, 1, 1]
+    stats = batcher.snapshot()
+    assert (stats["batches"], stats["ops"], stats["failed"]) == (1, 3, 1)
+
+
+def record(convex, fail=None):
+    """تسجيل عمليات كل applyBatch يصل إلى FakeConvex، مع فشل اختياري يُحقن قبل تنفيذها"""
+    batches = []
+
+    def inject(name, args):
+        batches.append([dict(op) for op in args["ops"]])
+        if fail is not None:
+            fail(args["ops"])
+
+    convex.inject = inject
+    return batches
+
+
+def test_updates_to_the_same_id_are_merged(batcher, convex):
+    a, b = add_product(convex, product_number="A"), add_product(convex, product_number="B")
+    batches = record(convex)
+
+    outcomes = wait_all(batcher.submit_many([
+        update(a, quantity=1, price_iqd=10.0), update(b, quantity=2), update(a, quantity=3)
+    ]))
+
+    assert outcomes == [("ok", None)] * 3
+    assert batches == [[update(a, quantity=3, price_iqd=10.0), update(b, quantity=2)]]
+    assert (convex.docs[a]["quantity"], convex.docs[a]["price_iqd"]) == (3, 10.0)
+    assert batcher.snapshot()["merged"] == 1
+
+
+def test_delete_keeps_order_and_is_not_merged_across(batcher, convex):
+    a = add_product(convex, product_number="A")
+    batches = record(convex)
+    delete = {"op": "delete", "id": a}
+
+    outcomes = wait_all(batcher.submit_many([update(a, quantity=1), delete, update(a, quantity=2)]))
+
+    assert batches == [[update(a, quantity=1), delete, update(a, quantity=2)]]
+    assert [kind for kind, _ in outcomes] == ["ok", "ok", "error"]
+    assert a not in convex.docs
+
+
+def test_rejected_batch_falls_back_to_one_op_at_a_time(batcher, convex):
+    a, b = add_product(convex, product_number="A"), add_product(convex, product_number="B")
+
+    def reject_batches(ops):
+        if len(ops) > 1:
+            raise Exception("ArgumentValidationError")
+
+    batches = record(convex, reject_batches)
+
+    outcomes = wait_all(batcher.submit_many([update(a, quantity=7), update("missing", quantity=1), update(b, quantity=8)]))
+
+    assert [kind for kind, _ in outcomes] == ["ok", "error", "ok"]
+    assert [[op["id"] for op in ops] for ops in batches] == [[a, "missing", b], [a], ["missing"], [b]]
+    assert (convex.docs[a]["quantity"], convex.docs[b]["quantity"]) == (7, 8)
+    stats = batcher.snapshot()
+    assert (stats["batches"], stats["ops"], stats["failed"]) == (1, 3, 1)
+
+
+def test_convex_failure_reaches_every_caller(batcher, convex):
+    a = add_product(convex, product_number="A")
+
+    def down(ops):
+        raise ConnectionError("Convex unavailable")
+
+    record(convex, down)
+
+    outcomes = wait_all(batcher.submit_many([update(a, quantity=1), update(a, price_iqd=5.0), {"op": "delete", "id": a}]))
+
+    assert outcomes == [("error", "Convex unavailable")] * 3
+    assert convex.docs[a]["quantity"] == 5
+    with pytest.raises(Exception, match="Convex unavailable"):
+        batcher.call(update(a, quantity=2))
+    assert batcher.snapshot()["failed"] == 3
+    assert batcher.drain(5)
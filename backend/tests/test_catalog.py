@@ -0,0 +1,84 @@
+import threading
+
+import main
+from conftest import reset_catalog
+
+
+def product(number, **fields):
+    return {
+        "_id": f"id-{number}", "product_number": number, "product_name": f"قطعة {number}",
+        "car_name": "كامري", "type": "قطعة", "quantity": 5, "price_iqd": 1000.0,
+        "wholesale_price_iqd": 800.0, "last_update": "2026-01-01T00:00:00", **fields
+    }
+
+
+def indexed_price(number):
+    return main.sort_index._current["price"].get(number)
+
+
+def test_fetch_started_before_a_write_keeps_the_newer_entry(convex):
+    main._snapshot_replace({"A": product("A"), "B": product("B")}, main._catalog_version)
+
+    version = main._catalog_version  # بدء جلب كامل
+    main._snapshot_patch("A", {"price_iqd": 2000.0})
+    main._snapshot_remove("B")
+    main._snapshot_put(product("C"))
+    stale = {"A": product("A"), "B": product("B"), "D": product("D")}
+    main._snapshot_replace(stale, version)
+
+    assert main._catalog_snapshot["A"]["price_iqd"] == 2000.0
+    assert set(main._catalog_snapshot) == {"A", "C", "D"}
+    assert indexed_price("A") == (2000.0, "A")
+    assert main.search_index.search("قطعة B") == {}
+    assert main.catalog_is_fresh()
+
+    # جلب لاحق يبدأ بعد الكتابة يطبق نتيجته كما هي
+    main._snapshot_replace({"A": product("A", price_iqd=3000.0)}, main._catalog_version)
+    assert set(main._catalog_snapshot) == {"A"}
+    assert indexed_price("A") == (3000.0, "A")
+
+
+def test_first_load_keeps_writes_made_while_fetching(convex):
+    version = main._catalog_version
+    main._snapshot_put(product("A", price_iqd=5000.0))
+    main._snapshot_replace({"A": product("A"), "B": product("B")}, version)
+
+    assert main._catalog_snapshot["A"]["price_iqd"] == 5000.0
+    assert indexed_price("A") == (5000.0, "A")
+    assert indexed_price("B") == (1000.0, "B")
+    assert main.stats_aggregate.total_products == 2
+
+
+def test_indexes_are_rebuilt_outside_the_catalog_lock(convex, monkeypatch):
+    held = []
+
+    class Probe:
+        def reset(self, products):
+            # خيط آخر (مثل طلب على حلقة الأحداث) يستطيع أخذ القفل أثناء البناء
+            result = []
+
+            def try_lock():
+                acquired = main._catalog_lock.acquire(timeout=1)
+                if acquired:
+                    main._catalog_lock.release()
+                result.append(acquired)
+
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            held.append(not result[0])
+            self.products = dict(products)
+
+        def upsert(self, key, old, new):
+            pass
+
+        def remove(self, key, old):
+            pass
+
+    probe = Probe()
+    monkeypatch.setattr(main, "catalog_listeners", main.catalog_listeners + [probe])
+    reset_catalog()
+    main._snapshot_replace({"A": product("A")}, main._catalog_version)
+
+    assert held and not any(held)
+    assert probe.products == {"A": product("A")}
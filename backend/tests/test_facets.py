@@ -0,0 +1,133 @@
+import random
+
+import pytest
+
+import main
+from conftest import add_product
+
+CARS = ["كامري", "كامري هايبرد", "كورولا", "سوناتا", ""]
+TYPES = ["فلتر", "فلتر زيت", "مساعد", "ضوء"]
+# أسعار على حدود الشرائح الافتراضية (FACET_PRICE_BUCKETS) وقربها
+PRICES = [0, 500, 9999, 10000, 10001, 24999.5, 25000, 60000, 100000, 249999, 250000, 999999]
+
+
+@pytest.fixture
+def catalog(client, convex):
+    rng = random.Random(14)
+    for i in range(120):
+        add_product(convex, product_number=f"F{i}", product_name=rng.choice(["فلتر زيت", "مساعد", "ضوء أمامي"]),
+                    car_name=rng.choice(CARS), type=rng.choice(TYPES), quantity=rng.choice([0, 0, 1, 7]),
+                    price_iqd=float(rng.choice(PRICES)), message_id=1)
+    assert client.get("/api/products", params={"limit": 1}).status_code == 200
+    return rng
+
+
+def brute_force(filters):
+    """نفس العدادات بالمرور على كل المنتجات: كل مجموعة بكل الفلاتر عدا فلترها"""
+    with main._catalog_lock:
+        products = dict(main._catalog_snapshot)
+        found = set(main.search_index.search(filters["search"])) if filters.get("search") else None
+    checks = {}
+    if found is not None:
+        checks["search"] = lambda key, p: key in found
+    if filters.get("car_name"):
+        checks["car_name"] = lambda key, p: filters["car_name"].lower() in p.get("car_name", "").lower()
+    if filters.get("product_type"):
+        checks["product_type"] = lambda key, p: filters["product_type"].lower() in p.get("type", "").lower()
+    if filters.get("status") == "available":
+        checks["status"] = lambda key, p: p["quantity"] > 0
+    elif filters.get("status") == "out_of_stock":
+        checks["status"] = lambda key, p: p["quantity"] == 0
+    low, high = filters.get("min_price"), filters.get("max_price")
+    if low is not None or high is not None:
+        checks["price"] = lambda key, p: (low is None or p["price_iqd"] >= low) and (high is None or p["price_iqd"] <= high)
+
+    def scope(excluded):
+        return [p for key, p in products.items() if all(check(key, p) for name, check in checks.items() if name != excluded)]
+
+    def grouped(field, excluded):
+        counts = {}
+        for p in scope(excluded):
+            counts[p.get(field, "")] = counts.get(p.get(field, ""), 0) + 1
+        return sorted(({"value": v, "count": c} for v, c in counts.items()), key=lambda r: (-r["count"], r["value"]))
+
+    buckets = main.facet_index.price_buckets
+    edges = buckets[1:] + [None]
+    in_price_scope = scope("price")
+    return {
+        "total": len(scope(None)),
+        "car_name": grouped("car_name", "car_name"),
+        "product_type": grouped("type", "product_type"),
+        "status": {
+            "available": sum(p["quantity"] > 0 for p in scope("status")),
+            "out_of_stock": sum(p["quantity"] == 0 for p in scope("status")),
+        },
+        "price": [
+            {"min": start, "max": end, "count": sum(
+                (i == 0 or p["price_iqd"] >= start) and (end is None or p["price_iqd"] < end) for p in in_price_scope
+            )}
+            for i, (start, end) in enumerate(zip(buckets, edges))
+        ],
+    }
+
+
+def random_filters(rng):
+    filters = {}
+    if rng.random() < 0.3:
+        filters["search"] = rng.choice(["فلتر", "مساعد", "ضوء"])
+    if rng.random() < 0.5:
+        filters["car_name"] = rng.choice(["كامري", "كورولا", "هايبرد", "لا يوجد"])
+    if rng.random() < 0.4:
+        filters["product_type"] = rng.choice(["فلتر", "زيت", "ضوء"])
+    if rng.random() < 0.5:
+        filters["status"] = rng.choice(["available", "out_of_stock"])
+    if rng.random() < 0.6:
+        filters["min_price"] = rng.choice(PRICES + [5000, 30000])
+    if rng.random() < 0.6:
+        filters["max_price"] = rng.choice(PRICES + [5000, 30000])
+    return filters
+
+
+def check(client, filters):
+    response = client.get("/api/products/facets", params=filters)
+    assert response.status_code == 200
+    assert response.json() == brute_force(filters), filters
+    listed = client.get("/api/products", params=filters).json()
+    assert response.json()["total"] == len(listed)
+
+
+def test_facets_match_a_brute_force_count(client, catalog):
+    check(client, {})
+    for _ in range(150):
+        check(client, random_filters(catalog))
+
+
+def test_facets_follow_incremental_writes(client, catalog):
+    rng = catalog
+    for step in range(60):
+        number = f"F{rng.randrange(130)}"
+        roll = rng.random()
+        if roll < 0.4:
+            main._snapshot_put({"product_number": number, "product_name": "فلتر جديد", "car_name": rng.choice(CARS),
+                                "type": rng.choice(TYPES), "quantity": rng.choice([0, 3]),
+                                "price_iqd": float(rng.choice(PRICES)), "last_update": f"2026-03-{step:02d}"})
+        elif roll < 0.7:
+            main._snapshot_patch(number, {"quantity": rng.choice([0, 2]), "price_iqd": float(rng.choice(PRICES))})
+        elif roll < 0.8:
+            main._snapshot_patch(number, {"product_number": f"G{step}", "car_name": rng.choice(CARS)})
+        else:
+            main._snapshot_remove(number)
+        check(client, random_filters(rng))
+
+
+def test_each_group_ignores_its_own_filter(client, convex):
+    add_product(convex, product_number="1", car_name="كامري", quantity=1, price_iqd=5000.0)
+    add_product(convex, product_number="2", car_name="كامري", quantity=0, price_iqd=30000.0)
+    add_product(convex, product_number="3", car_name="كورولا", quantity=2, price_iqd=30000.0)
+
+    facets = client.get("/api/products/facets", params={"car_name": "كامري", "status": "available"}).json()
+
+    assert facets["total"] == 1
+    assert facets["car_name"] == [{"value": "كامري", "count": 1}, {"value": "كورولا", "count": 1}]
+    assert facets["status"] == {"available": 1, "out_of_stock": 1}
+    assert [bucket["count"] for bucket in facets["price"][:3]] == [1, 0, 0]
@@ -0,0 +1,109 @@
+import hashlib
+import io
+import random
+import uuid
+
+import pytest
+from starlette.datastructures import Headers
+
+import main
+
+from conftest import add_product
+
+
+def test_same_key_and_payload_is_replayed(client, convex):
+    _id = add_product(convex, quantity=5)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    payload = [{"product_number": "P1", "delta": -1}]
+
+    first = client.post("/api/stock/movements", json=payload, headers=headers)
+    second = client.post("/api/stock/movements", json=payload, headers=headers)
+
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert second.headers.get("Idempotent-Replayed") == "true"
+    assert second.json() == first.json()
+    assert convex.docs[_id]["quantity"] == 4
+
+
+def test_same_key_with_different_payload_is_rejected(client, convex):
+    _id = add_product(convex, quantity=5)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    first = client.post("/api/stock/movements", json=[{"product_number": "P1", "delta": -1}], headers=headers)
+    second = client.post("/api/stock/movements", json=[{"product_number": "P1", "delta": -3}], headers=headers)
+
+    assert first.status_code == 200
+    assert second.status_code == 422
+    assert "Idempotent-Replayed" not in second.headers
+    assert convex.docs[_id]["quantity"] == 4
+
+
+def test_multipart_retry_with_new_boundary_is_replayed(client, convex):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), "red").save(buffer, format="PNG")
+    files = {"image": ("photo.png", buffer.getvalue(), "image/png")}
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    form = {
+        "product_number": "P9", "product_name": "فلتر", "car_name": "كامري",
+        "price_iqd": "1000", "wholesale_price_iqd": "800"
+    }
+
+    first = client.post("/api/products", data=form, files=files, headers=headers)
+    second = client.post("/api/products", data=form, files=files, headers=headers)
+    changed = client.post("/api/products", data={**form, "product_name": "زيت"}, files=files, headers=headers)
+
+    assert first.status_code == 200
+    assert second.headers.get("Idempotent-Replayed") == "true"
+    assert changed.status_code == 422
+    assert [d["product_number"] for d in convex.docs.values()] == ["P9"]
+
+
+def test_body_digest_ignores_the_boundary_across_chunk_splits():
+    boundary = "----boundary7MA4YWxkTrZu0gW"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"a\"\r\n\r\n1\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"b\"\r\n\r\n{boundary[:9]}x\r\n--{boundary}--\r\n"
+    ).encode()
+    expected = hashlib.sha256(body.replace(boundary.encode(), b"")).hexdigest()
+    headers = Headers({"content-type": f"multipart/form-data; boundary={boundary}"})
+    rng = random.Random(7)
+
+    for _ in range(200):
+        digest = main.BodyDigest(headers)
+        cuts = sorted(rng.sample(range(1, len(body)), rng.randint(1, 12)))
+        for start, end in zip([0] + cuts, cuts + [len(body)]):
+            digest.update(body[start:end])
+        assert digest.hexdigest() == expected
+
+
+def test_chunked_body_over_the_cap_is_rejected(client, convex, monkeypatch):
+    monkeypatch.setattr(main, "IDEMPOTENCY_MAX_BODY", 1024)
+    add_product(convex, quantity=5)
+
+    def chunks():
+        yield b'[{"product_number": "P1", "delta": -1, "note": "'
+        for _ in range(10):
+            yield b"x" * 256
+        yield b'"}]'
+
+    response = client.post(
+        "/api/stock/movements", content=chunks(),
+        headers={"Idempotency-Key": str(uuid.uuid4()), "Content-Type": "application/json"}
+    )
+
+    assert response.status_code == 413
+    assert next(iter(convex.docs.values()))["quantity"] == 5
+
+
+def test_route_without_body_is_replayed(client, convex):
+    _id = add_product(convex, quantity=5)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    first = client.post("/api/update-status/P1?action=sold_one", headers=headers)
+    second = client.post("/api/update-status/P1?action=sold_one", headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert second.headers.get("Idempotent-Replayed") == "true"
+    assert convex.docs[_id]["quantity"] == 4
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import io
+import tempfile
+import threading
+
+import pytest
+
+import main
+from conftest import add_product
+
+def png(color, size=(40, 30)):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create(client, product_number, image):
+    return client.post("/api/products", data={
+        "product_number": product_number, "product_name": "فلتر", "car_name": "كامري",
+        "price_iqd": "1000", "wholesale_price_iqd": "800"
+    }, files={"image": ("photo.png", image, "image/png")})
+
+
+def test_each_upload_gets_a_unique_imgbb_filename(client, convex, http):
+    assert create(client, "A1", png("red")).status_code == 200
+    assert create(client, "A2", png("blue")).status_code == 200
+
+    images = sorted(d["image"] for d in convex.docs.values())
+    assert len(set(http.uploads)) == len(http.uploads) == 4  # صورة ومصغرة لكل منتج
+    assert images[0].rsplit("/", 1)[-1] != images[1].rsplit("/", 1)[-1]
+
+
+def test_shared_file_names_do_not_serve_another_products_image(client, convex):
+    first, second = "https://i.ibb.co/abc123/image.webp", "https://i.ibb.co/def456/image.webp"
+    add_product(convex, product_number="B1", image=first)
+    add_product(convex, product_number="B2", image=second)
+
+    def redirect(image_id):
+        return client.get(f"/image/{image_id}", follow_redirects=False)
+
+    assert redirect("image").status_code == 404
+    assert redirect("image.webp").status_code == 404
+    assert redirect("abc123").headers["location"] == first
+    assert redirect("def456").headers["location"] == second
+    assert redirect(main.ImageUrlIndex.url_id(second)).headers["location"] == second
+
+
+def test_image_cache_indexes_existing_files_once(tmp_path, monkeypatch):
+    url = "https://i.ibb.co/abc123/photo.webp"
+    key = main.ImageCache._url_hash(url)
+    (tmp_path / f"{key}_etag1").write_bytes(b"cached")
+    cache = main.ImageCache(tmp_path, 1024)
+
+    def no_scan(*args):
+        raise AssertionError("lookup must not scan the cache directory")
+
+    monkeypatch.setattr(type(tmp_path), "glob", no_scan)
+    monkeypatch.setattr(type(tmp_path), "iterdir", no_scan)
+    assert cache.lookup(url) == (tmp_path / f"{key}_etag1", "etag1")
+    assert cache.lookup("https://i.ibb.co/other/photo.webp") is None
+
+
+def test_oversized_upload_is_rejected_from_content_length(client, convex, monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_MAX_UPLOAD_MB", 0.1)
+
+    async def parsed(upload):
+        raise AssertionError("the body must be rejected before the form is parsed")
+
+    monkeypatch.setattr(main, "receive_product_image", parsed)
+    response = client.post("/api/products", data={
+        "product_number": "C1", "product_name": "فلتر", "car_name": "كامري",
+        "price_iqd": "1000", "wholesale_price_iqd": "800"
+    }, files={"image": ("photo.png", b"\0" * 300_000, "image/png")})
+
+    assert response.status_code == 413
+    assert convex.docs == {}
+
+
+def test_shared_ingest_keeps_running_after_the_first_request_is_cancelled(client, images):
+    image = png("green")
+    digest = hashlib.sha256(image).hexdigest()
+
+    def spooled():
+        spool = tempfile.SpooledTemporaryFile()
+        spool.write(image)
+        spool.seek(0)
+        return spool
+
+    async def cancel_first_request():
+        first_file, second_file = spooled(), spooled()
+        first = asyncio.ensure_future(main.ingest_image(first_file, digest, len(image)))
+        while digest not in images._inflight:
+            await asyncio.sleep(0)
+        first.cancel()
+        # الطلب المكرر ينتظر نفس المهمة ويغلق ملفه فوراً
+        second = await main.ingest_image(second_file, digest, len(image))
+        return first_file, second_file, second
+
+    first_file, second_file, result = client.portal.call(cancel_first_request)
+
+    assert result["image"].endswith(f"/{digest}.webp")
+    assert images.get(digest) == result
+    assert first_file.closed and second_file.closed
+
+
+def test_upload_is_handed_to_the_ingest_task_without_copying(client, convex, monkeypatch):
+    def copied(*args, **kwargs):
+        raise AssertionError("the upload must not be copied")
+
+    monkeypatch.setattr(main.shutil, "copyfileobj", copied)
+
+    assert create(client, "D1", png("yellow")).status_code == 200
+    assert next(iter(convex.docs.values()))["image"].endswith(".webp")
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_image_index_and_disk_io_run_off_the_event_loop(client, convex, images, monkeypatch, background):
+    monkeypatch.setattr(main, "IMAGE_BACKGROUND_UPLOAD", background)
+    monkeypatch.setattr(main, "PENDING_UPLOADS_DIR", main.Path(tempfile.mkdtemp()))
+
+    async def loop_thread():
+        return threading.get_ident()
+
+    loop_ident = client.portal.call(loop_thread)
+    threads = []
+
+    def recorded(name, func):
+        def wrapper(*args, **kwargs):
+            threads.append((name, threading.get_ident()))
+            return func(*args, **kwargs)
+        monkeypatch.setattr(*name, wrapper)
+
+    recorded((images, "get"), images.get)
+    recorded((images, "put"), images.put)
+    recorded((main, "_save_pending_upload"), main._save_pending_upload)
+
+    assert create(client, "E1", png("purple")).status_code == 200
+
+    # في وضع الخلفية قد يبدأ صندوق الصادر رفع الصورة قبل انتهاء الاختبار
+    names = {name[1] for name, _ in threads}
+    assert names >= ({"get", "_save_pending_upload"} if background else {"get", "put"})
+    assert all(ident != loop_ident for _, ident in threads)
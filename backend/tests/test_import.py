@@ -0,0 +1,161 @@
+import json
+import random
+
+import pytest
+
+import main
+from conftest import add_product
+
+
+def row(number, **fields):
+    product = {"product_number": number, "product_name": f"قطعة {number}", "quantity": 3, "price_iqd": 1500}
+    product.update(fields)
+    return product
+
+
+# نصوص تختبر الحدود: علامات تنصيص وشرطات مائلة مهربة، وحروف UTF-8 متعددة البايت
+PRODUCTS = [
+    row("A1", product_name='فلتر "زيت" أصلي', car_name="كامري\\2020"),
+    row("A2", product_name="ضوء 💡 أمامي", quantity="4", price_iqd="2250.5"),
+    row("٣٣", product_name="مساعد\nخلفي", quantity=0),
+]
+
+
+def backup(products):
+    return json.dumps({
+        "backup_info": {"version": "5.0.0", "note": "} ] ,"},
+        "products": {p["product_number"]: p for p in products},
+        "statistics": {"total": len(products)}
+    }, ensure_ascii=False).encode()
+
+
+def ndjson(lines):
+    return "\n".join(lines).encode()
+
+
+def parse(fmt, data, cuts):
+    """تغذية المحلل بالبيانات مقطعة عند المواضع المعطاة (بالبايت)"""
+    parser = main.UploadRowParser(fmt)
+    rows = []
+    bounds = [0, *sorted(cuts), len(data)]
+    for start, end in zip(bounds, bounds[1:]):
+        rows += parser.feed(data[start:end], False)
+    return rows + parser.feed(b"", True)
+
+
+def expected_rows():
+    return [(p["product_number"], main.clean_import_row(p["product_number"], p), None) for p in PRODUCTS]
+
+
+@pytest.mark.parametrize("fmt, data", [
+    ("json", backup(PRODUCTS)),
+    ("json", json.dumps({"products": PRODUCTS}, ensure_ascii=False).encode()),
+    ("ndjson", ndjson([json.dumps({"backup_info": {}})] + [json.dumps(p, ensure_ascii=False) for p in PRODUCTS])),
+])
+def test_records_split_at_every_byte_parse_like_the_whole_file(fmt, data):
+    whole = parse(fmt, data, [])
+    assert whole == expected_rows()
+    assert whole[0][1]["product_name"] == 'فلتر "زيت" أصلي'
+    assert whole[1][1]["product_name"] == "ضوء 💡 أمامي"
+    assert (whole[2][1]["product_number"], whole[2][1]["quantity"]) == ("33", 0)
+
+    for cut in range(1, len(data)):
+        assert parse(fmt, data, [cut]) == whole, cut
+    assert parse(fmt, data, range(1, len(data))) == whole
+
+
+def test_random_chunking_matches_the_whole_file():
+    rng = random.Random(16)
+    products = [row(f"R{i}", product_name="قطعة " + "ع" * rng.randint(0, 40) + '\\"', quantity=rng.randint(0, 9))
+                for i in range(200)]
+    for fmt, data in (("json", backup(products)),
+                      ("ndjson", ndjson([json.dumps(p, ensure_ascii=False) for p in products]))):
+        whole = parse(fmt, data, [])
+        assert len(whole) == 200 and all(error is None for _, _, error in whole)
+        for _ in range(20):
+            cuts = rng.sample(range(1, len(data)), rng.randint(1, 300))
+            assert parse(fmt, data, cuts) == whole
+
+
+def test_malformed_rows_mid_stream_are_reported_and_parsing_continues():
+    lines = [
+        json.dumps(PRODUCTS[0], ensure_ascii=False),
+        '{"product_number": "X1", "quantity": ',
+        json.dumps(row("X2", quantity=2.5)),
+        json.dumps(row("X3", price_iqd=None)),
+        "[1, 2]",
+        json.dumps(PRODUCTS[1], ensure_ascii=False),
+    ]
+    data = ndjson(lines)
+
+    rows = parse("ndjson", data, range(1, len(data), 7))
+
+    assert [(pn, error is None) for pn, _, error in rows] == [
+        ("A1", True), (None, False), ("X2", False), ("X3", False), (None, False), ("A2", True)
+    ]
+    assert rows[1][2].startswith("السطر 2:")
+    assert "quantity" in rows[2][2]
+    assert "price_iqd" in rows[3][2]
+
+    data = backup([PRODUCTS[0], row("X2", quantity="كثير"), PRODUCTS[1]])
+    rows = parse("json", data, range(1, len(data), 5))
+    assert [(pn, error is None) for pn, _, error in rows] == [("A1", True), ("X2", False), ("A2", True)]
+
+
+@pytest.mark.parametrize("fmt, data", [
+    ("json", b'{"products": [{"product_number": "A1", "quantity": 1,, }]}'),
+    ("json", b'{"products": [' + json.dumps(PRODUCTS[0]).encode()),
+    ("json", b'{"backup_info": {}}'),
+    ("ndjson", "م".encode()[:1]),
+])
+def test_broken_files_raise_a_format_error(fmt, data):
+    with pytest.raises(main.ImportFormatError):
+        parse(fmt, data, range(1, len(data), 3))
+
+
+def test_import_job_counts_created_updated_skipped_and_failed(client, convex, monkeypatch):
+    older = add_product(convex, product_number="OLD", quantity=1)
+    newer = add_product(convex, product_number="NEW", quantity=1)
+    # أجزاء قراءة صغيرة ودفعات صغيرة حتى تمر الصفوف عبر حدود الأجزاء والدفعات
+    monkeypatch.setattr(main, "IMPORT_READ_SIZE", 11)
+    monkeypatch.setattr(main, "IMPORT_BATCH_SIZE", 2)
+
+    def reject_poison(name, args):
+        if name == "products:importProducts" and any(r["product_number"] == "POISON" for r in args["products"]):
+            raise Exception("ArgumentValidationError")
+
+    convex.inject = reject_poison
+    lines = [json.dumps(p, ensure_ascii=False) for p in PRODUCTS] + [
+        json.dumps(row("OLD", quantity=7, last_update="2027-01-01T00:00:00Z")),
+        json.dumps(row("NEW", quantity=7, last_update="2025-01-01T00:00:00Z")),
+        "{oops",
+        json.dumps(row("POISON")),
+        json.dumps(row("B1", product_name="بعد الخطأ")),
+    ]
+
+    response = client.post("/api/import", params={"format": "ndjson"},
+                           files={"file": ("backup.ndjson", ndjson(lines), "application/x-ndjson")})
+
+    assert response.status_code == 200, response.text
+    stats = response.json()["statistics"]
+    assert stats["status"] == "done"
+    assert (stats["total_imported"], stats["new_products"], stats["updated_products"],
+            stats["skipped_duplicates"], stats["failed"]) == (8, 4, 1, 1, 2)
+    assert [e["product_number"] for e in stats["errors"]] == [None, "POISON"]
+    assert client.get("/api/import/progress", params={"job_id": stats["job_id"]}).json() == stats
+
+    by_number = {d["product_number"]: d for d in convex.docs.values()}
+    assert set(by_number) == {"OLD", "NEW", "A1", "A2", "33", "B1"}
+    assert by_number["A1"]["product_name"] == 'فلتر "زيت" أصلي'
+    assert (convex.docs[older]["quantity"], convex.docs[newer]["quantity"]) == (7, 1)
+    # اللقطة تعكس ما كُتب دون إعادة جلب
+    with main._catalog_lock:
+        assert main._catalog_snapshot["OLD"]["quantity"] == 7
+        assert main._catalog_snapshot["33"]["status"] == "نفذ"
+
+
+def test_broken_upload_fails_the_job_with_400(client, convex):
+    response = client.post("/api/import", files={"file": ("backup.json", b'{"products": [', "application/json")})
+
+    assert response.status_code == 400
+    assert client.get("/api/import/progress").json()[0]["status"] == "failed"
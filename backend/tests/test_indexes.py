@@ -0,0 +1,187 @@
+import random
+
+import pytest
+
+import main
+from conftest import add_product
+
+NAMES = ["فلتر زيت", "فلتر هواء", "مساعد أمامي", "ضوء خلفي", "دعامية", "مرآة جانبية"]
+CARS = ["تويوتا كامري", "كامرى", "كيا سبورتاج", "هيونداي سوناتا", "نيسان"]
+TYPES = ["قطعة", "كهرباء", "بودي"]
+
+
+def random_product(rng, number):
+    return {
+        "product_number": number, "product_name": rng.choice(NAMES), "car_name": rng.choice(CARS),
+        "model_number": rng.choice(["", "2020", "2018-2022"]), "type": rng.choice(TYPES),
+        "quantity": rng.choice([0, 1, 3, 5, 12]), "original_quantity": rng.choice([0, 5, 12]),
+        "price_iqd": float(rng.choice([0, 1000, 2500, 2500, 40000])), "wholesale_price_iqd": 500.0,
+        "last_update": rng.choice(["", "2026-01-01T00:00:00Z", "2026-02-01T00:00:00Z"]),
+    }
+
+
+def random_number(rng):
+    # أرقام عربية وغربية لنفس المفتاح بعد التطبيع
+    number = str(rng.randrange(40))
+    return number.translate(str.maketrans("0123456789", "٠١٢٣٤٥٦٧٨٩")) if rng.random() < 0.2 else f"N{number}"
+
+
+@pytest.fixture
+def catalog(client, convex):
+    rng = random.Random(11)
+    for i in range(30):
+        add_product(convex, **random_product(rng, f"N{i}"))
+    assert client.get("/api/products", params={"limit": 1}).status_code == 200
+    return rng
+
+
+def mutate(rng):
+    """تعديل عشوائي واحد على اللقطة: إضافة أو تعديل أو إعادة تسمية أو حذف"""
+    number = random_number(rng)
+    roll = rng.random()
+    if roll < 0.35:
+        main._snapshot_put(random_product(rng, number))
+    elif roll < 0.65:
+        fresh = random_product(rng, number)
+        fields = rng.sample(sorted(fresh), 3)
+        main._snapshot_patch(number, {field: fresh[field] for field in fields if field != "product_number"})
+    elif roll < 0.8:
+        main._snapshot_patch(number, {"product_number": random_number(rng), "product_name": rng.choice(NAMES)})
+    else:
+        main._snapshot_remove(number)
+
+
+def snapshot():
+    with main._catalog_lock:
+        return dict(main._catalog_snapshot)
+
+
+# ================================
+# SearchIndex
+# ================================
+
+QUERIES = ["فلتر", "فلتر زيت", "كامري", "كامرى", "امامي", "ضو", "2020", "N1", "n12", "١٢", "قط", "x", "سوناتا"]
+
+
+def brute_force_search(products, query):
+    needle = main.normalize_search_text(query)
+    return {
+        key for key, p in products.items()
+        if any(needle in main.normalize_search_text(p.get(field, "")) for field in main.SearchIndex.FIELDS)
+    }
+
+
+def test_search_index_matches_a_full_rebuild_after_writes(client, catalog):
+    rng = catalog
+    for step in range(300):
+        mutate(rng)
+        if step % 10:
+            continue
+        products = snapshot()
+        fresh = main._rebuilt_listener(main.search_index, products)
+        with main._catalog_lock:
+            assert main.search_index._docs == fresh._docs
+            assert main.search_index._postings == fresh._postings
+            for query in QUERIES:
+                scores = main.search_index.search(query)
+                assert scores == fresh.search(query), query
+                assert set(scores) == brute_force_search(products, query), query
+
+
+def test_search_endpoint_finds_renamed_and_drops_removed_products(client, catalog):
+    main._snapshot_put(random_product(catalog, "OLD-1") | {"product_name": "بوري ماء"})
+    main._snapshot_patch("OLD-1", {"product_number": "NEW-1"})
+    main._snapshot_put(random_product(catalog, "GONE-1") | {"product_name": "بوري ماء"})
+    main._snapshot_remove("GONE-1")
+
+    found = client.get("/api/products", params={"search": "بوري"}).json()
+
+    assert [p["product_number"] for p in found] == ["NEW-1"]
+    assert client.get("/api/products", params={"search": "old-1"}).json() == []
+
+
+# ================================
+# SortIndex
+# ================================
+
+def test_sort_index_matches_a_full_sort_after_writes(client, catalog):
+    rng = catalog
+    for step in range(300):
+        mutate(rng)
+        if step % 10:
+            continue
+        products = snapshot()
+        with main._catalog_lock:
+            for mode, key_fn in main.PRODUCT_SORT_KEYS.items():
+                expected = sorted(key_fn(p, key) for key, p in products.items())
+                assert main.sort_index._arrays[mode] == expected, mode
+                assert main.sort_index._current[mode] == {key: key_fn(p, key) for key, p in products.items()}
+            assert len(main.sort_index) == len(products)
+
+
+@pytest.mark.parametrize("sort_by", ["price", "quantity", "name", "last_update"])
+def test_sorted_listing_follows_writes(client, catalog, sort_by):
+    rng = catalog
+    key_fn = main.PRODUCT_SORT_KEYS[sort_by]
+    for _ in range(40):
+        mutate(rng)
+        products = snapshot()
+        low = rng.choice([None, 1000, 2500])
+        params = {"sort_by": sort_by, "order": rng.choice(["asc", "desc"])}
+        if low is not None:
+            params["min_price"] = low
+        chosen = {k: p for k, p in products.items() if low is None or (p.get("price_iqd") or 0) >= low}
+        expected = sorted(chosen, key=lambda k: key_fn(chosen[k], k), reverse=params["order"] == "desc")
+
+        listed = client.get("/api/products", params=params).json()
+
+        assert [main.normalize_pn(p["product_number"]) for p in listed] == expected
+
+
+# ================================
+# StatsAggregate
+# ================================
+
+@pytest.fixture
+def drift(monkeypatch):
+    report = {"checks": 0, "drifted": 0, "last_checked": None, "last_drift_at": None, "last_drift": []}
+    monkeypatch.setattr(main, "stats_drift", report)
+    return report
+
+
+def test_stats_match_a_full_recompute_after_writes(client, catalog, drift):
+    rng = catalog
+    for step in range(300):
+        mutate(rng)
+        if step % 10:
+            continue
+        products = snapshot()
+        recomputed = main.StatsAggregate()
+        recomputed.reset(products)
+        with main._catalog_lock:
+            assert main.stats_aggregate.diff(recomputed) == []
+            assert main.stats_aggregate.report(products) == recomputed.report(products)
+            assert sorted(main.stats_aggregate._sold) == main.stats_aggregate._sold
+        assert client.get("/api/stats").json() == recomputed.report(products)
+
+    response = client.get("/api/stats/drift", params={"recompute": "true"}).json()
+
+    assert (response["checks"], response["drifted"], response["last_drift"]) == (1, 0, [])
+
+
+def test_drift_endpoint_reports_and_corrects_drift(client, catalog, drift):
+    for _ in range(20):
+        mutate(catalog)
+    expected = client.get("/api/stats").json()
+    with main._catalog_lock:
+        main.stats_aggregate.total_items += 7
+        main.stats_aggregate.by_car.pop(next(iter(main.stats_aggregate.by_car)))
+
+    response = client.get("/api/stats/drift", params={"recompute": "true"}).json()
+
+    assert (response["checks"], response["drifted"]) == (1, 1)
+    fields = {entry["field"] for entry in response["last_drift"]}
+    assert "total_items" in fields and any(field.startswith("by_car.") for field in fields)
+    assert client.get("/api/stats").json() == expected
+    assert client.get("/api/stats/drift").json()["drifted"] == 1
+    assert client.get("/api/stats/drift", params={"recompute": "true"}).json()["drifted"] == 1
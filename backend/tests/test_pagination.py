@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+import main
+from conftest import add_product
+
+NAMES = ["فلتر زيت", "فلتر هواء", "مساعد أمامي", "ضوء خلفي"]
+CARS = ["كامري", "كورولا", "سوناتا"]
+
+
+@pytest.fixture
+def catalog(client, convex):
+    """كتالوج عشوائي بقيم قليلة التنوع حتى تتكرر مفاتيح الترتيب كثيراً"""
+    rng = random.Random(10)
+    for i in range(rng.randint(60, 90)):
+        _id = add_product(
+            convex, product_number=f"P{rng.randint(1, 400)}-{i}", product_name=rng.choice(NAMES),
+            car_name=rng.choice(CARS), quantity=rng.choice([0, 1, 1, 5]),
+            price_iqd=float(rng.choice([500, 1000, 1000, 2500])), message_id=1
+        )
+        convex.docs[_id]["last_update"] = rng.choice(["2026-01-01T00:00:00Z", "2026-02-01T00:00:00Z", ""])
+    return rng
+
+
+def all_pages(client, params, limit):
+    items, cursor, totals = [], None, set()
+    while True:
+        page = client.get("/api/products", params={**params, "limit": limit, **({"cursor": cursor} if cursor else {})})
+        assert page.status_code == 200, page.text
+        body = page.json()
+        assert len(body["items"]) <= limit
+        items += [p["product_number"] for p in body["items"]]
+        totals.add(body["total"])
+        cursor = body["next_cursor"]
+        # مؤشر لا يتقدم يعني صفحات بلا نهاية
+        assert len(items) <= body["total"]
+        if cursor is None:
+            return items, totals
+
+
+@pytest.mark.parametrize("sort_by", ["price", "quantity", "name", "last_update", "relevance"])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_cursor_pages_concatenate_to_the_unpaged_list(client, convex, catalog, sort_by, order):
+    filter_sets = [{}, {"status": "available"}, {"car_name": "كامري"}, {"min_price": 600, "max_price": 2000},
+                   {"search": "فلتر"}, {"search": "فلتر", "min_price": 1000}]
+    for filters in filter_sets:
+        params = {"sort_by": sort_by, "order": order, **filters}
+        unpaged = client.get("/api/products", params=params)
+        expected = [p["product_number"] for p in unpaged.json()]
+        for limit in (1, catalog.randint(2, 7), 500):
+            items, totals = all_pages(client, params, limit)
+            assert items == expected, (params, limit)
+            assert totals == {len(expected)} == {int(unpaged.headers["X-Total-Count"])}
+
+
+@pytest.mark.parametrize("sort_by", ["price", "quantity", "name", "last_update"])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_unpaged_order_matches_a_full_sort(client, convex, catalog, sort_by, order):
+    products = {d["product_number"]: d for d in convex.docs.values()}
+    sort_key = main.PRODUCT_SORT_KEYS[sort_by]
+    expected = sorted(products, key=lambda pn: sort_key(products[pn], pn), reverse=order == "desc")
+
+    response = client.get("/api/products", params={"sort_by": sort_by, "order": order})
+
+    assert [p["product_number"] for p in response.json()] == expected
+
+
+def test_cursor_from_another_sort_is_rejected(client, convex, catalog):
+    cursor = client.get("/api/products", params={"sort_by": "price", "limit": 2}).json()["next_cursor"]
+
+    response = client.get("/api/products", params={"sort_by": "name", "limit": 2, "cursor": cursor})
+
+    assert response.status_code == 400
@@ -0,0 +1,27 @@
+import main
+from conftest import add_product, wait_for
+
+
+def test_edit_posts_a_product_that_was_never_sent_to_telegram(client, convex, http):
+    _id = add_product(convex, message_id=None)
+
+    response = client.patch("/api/products/P1", data={"price_iqd": "1500"})
+
+    assert response.status_code == 200
+    wait_for(lambda: convex.docs[_id].get("message_id") is not None)
+    assert http.methods() == ["sendMessage"]
+
+
+def test_new_image_without_thumbnail_clears_the_old_thumbnail(client, convex, monkeypatch):
+    _id = add_product(convex, image="https://i.ibb.co/1/old.webp", thumbnail="https://i.ibb.co/2/old-thumb.webp")
+
+    async def no_thumbnail(upload):
+        await upload.read()
+        return {"image": "https://i.ibb.co/3/new.webp", "thumbnail": None}
+
+    monkeypatch.setattr(main, "receive_product_image", no_thumbnail)
+    response = client.patch("/api/products/P1", files={"image": ("photo.png", b"png", "image/png")})
+
+    assert response.status_code == 200
+    assert convex.docs[_id]["image"] == "https://i.ibb.co/3/new.webp"
+    assert not convex.docs[_id]["thumbnail"]
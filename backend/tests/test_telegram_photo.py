@@ -0,0 +1,27 @@
+import json
+
+import httpx
+
+import main
+from conftest import add_product
+
+
+def test_photo_fallback_uses_file_id_when_image_was_cleared(client, convex, http):
+    add_product(
+        convex, image=None, message_id=77,
+        telegram_file_id="old-file-id", telegram_photo="https://i.ibb.co/1/old.webp"
+    )
+    product = main.load_cache()["P1"]
+
+    def message_deleted(method, request):
+        if method == "editMessageCaption":
+            return httpx.Response(400, json={"ok": False, "description": "Bad Request: message to edit not found"})
+
+    http.responder = message_deleted
+    sent = client.portal.call(main.send_photo_to_telegram, product, 77)
+
+    assert http.methods()[:2] == ["editMessageCaption", "sendPhoto"]
+    assert json.loads(http.calls[1][1].content)["photo"] == "old-file-id"
+    assert sent["message_id"] != 77
+    assert sent["telegram_file_id"] == "tg-photo"
+    assert sent["telegram_photo"] == "https://i.ibb.co/1/old.webp"
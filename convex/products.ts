@@ -1,5 +1,97 @@
-import { mutation, query } from "./_generated/server";
-import { v } from "convex/values";
+import { mutation, query, MutationCtx } from "./_generated/server";
+import { Id } from "./_generated/dataModel";
+import { v, Infer } from "convex/values";
+
+const addProductArgs = v.object({
+    product_number: v.optional(v.string()),
+    product_name: v.string(),
+    car_name: v.string(),
+    model_number: v.string(),
+    type: v.string(),
+    quantity: v.number(),
+    price_iqd: v.number(),
+    wholesale_price_iqd: v.number(),
+    image: v.optional(v.string()),
+    thumbnail: v.optional(v.string()),
+    original_quantity: v.optional(v.number()),
+    message_id: v.optional(v.number()),
+    telegram_file_id: v.optional(v.string()),
+    telegram_photo: v.optional(v.string()),
+    status: v.optional(v.string()),
+    last_update: v.optional(v.string()),
+});
+
+const productUpdates = v.object({
+    product_number: v.optional(v.string()),
+    product_name: v.optional(v.string()),
+    car_name: v.optional(v.string()),
+    model_number: v.optional(v.string()),
+    type: v.optional(v.string()),
+    quantity: v.optional(v.number()),
+    price_iqd: v.optional(v.number()),
+    wholesale_price_iqd: v.optional(v.number()),
+    image: v.optional(v.string()),
+    thumbnail: v.optional(v.string()),
+    message_id: v.optional(v.number()),
+    telegram_file_id: v.optional(v.string()),
+    telegram_photo: v.optional(v.string()),
+    status: v.optional(v.string()),
+    last_update: v.optional(v.string()),
+});
+
+async function insertProduct(ctx: MutationCtx, args: Infer<typeof addProductArgs>) {
+    let finalProductNumber = args.product_number;
+
+    if (finalProductNumber) {
+        const existing = await ctx.db
+            .query("products")
+            .withIndex("by_product_number", (q) => q.eq("product_number", finalProductNumber))
+            .first();
+
+        if (existing) {
+            throw new Error("Product number already exists");
+        }
+    } else {
+        // Generate a unique product number if not provided
+        // PN-YYYYMMDD-RAND
+        const date = new Date().toISOString().slice(0, 10).replace(/-/g, '');
+        const rand = Math.random().toString(36).substring(2, 6).toUpperCase();
+        finalProductNumber = `PN-${date}-${rand}`;
+    }
+
+    return await ctx.db.insert("products", {
+        ...args,
+        product_number: finalProductNumber,
+        original_quantity: args.original_quantity ?? args.quantity,
+        status: args.status ?? (args.quantity > 0 ? "متوفر" : "نفذ"),
+        last_update: args.last_update ?? new Date().toISOString(),
+    });
+}
+
+async function patchProduct(ctx: MutationCtx, id: Id<"products">, updates: Infer<typeof productUpdates>) {
+    const product = await ctx.db.get(id);
+    if (!product) throw new Error("Product not found");
+
+    if (updates.product_number && updates.product_number !== product.product_number) {
+        const existing = await ctx.db
+            .query("products")
+            .withIndex("by_product_number", (q) => q.eq("product_number", updates.product_number))
+            .first();
+
+        if (existing) {
+            throw new Error("New product number already exists");
+        }
+    }
+
+    const newQuantity = updates.quantity !== undefined ? updates.quantity : product.quantity;
+    const status = newQuantity > 0 ? "متوفر" : "نفذ";
+
+    await ctx.db.patch(id, {
+        ...updates,
+        status,
+        last_update: new Date().toISOString()
+    });
+}
 
 export const getProducts = query({
     args: {
@@ -29,7 +121,8 @@ export const getProducts = query({
         // Resolve image URLs
         const resolved = await Promise.all(products.map(async p => {
             let url = p.image || null;
-            if (p.image && !p.image.startsWith("http")) {
+            // Storage IDs only: http(s) links and /image/... paths served by the backend are used as-is
+            if (p.image && !p.image.startsWith("http") && !p.image.startsWith("/")) {
                 url = await ctx.storage.getUrl(p.image);
             }
             return { ...p, imageUrl: url };
@@ -41,93 +134,148 @@ export const getProducts = query({
     },
 });
 
+export const getProductByNumber = query({
+    args: { product_number: v.string() },
+    handler: async (ctx, args) => {
+        return await ctx.db
+            .query("products")
+            .withIndex("by_product_number", (q) => q.eq("product_number", args.product_number))
+            .first();
+    },
+});
+
+// Atomic stock change: floor at zero and status derived in the same transaction
+async function applyQuantityDelta(ctx: MutationCtx, id: Id<"products">, delta: number, clear: boolean) {
+    const product = await ctx.db.get(id);
+    if (!product) throw new Error("Product not found");
+
+    const quantity = clear ? 0 : Math.max(0, product.quantity + delta);
+    const status = quantity > 0 ? "متوفر" : "نفذ";
+    let last_update = product.last_update;
+
+    if (quantity !== product.quantity || status !== product.status) {
+        last_update = new Date().toISOString();
+        await ctx.db.patch(id, { quantity, status, last_update });
+    }
+
+    return {
+        quantity,
+        status,
+        last_update,
+        applied: quantity - product.quantity,
+        message_id: product.message_id ?? null,
+    };
+}
+
 export const addProduct = mutation({
+    args: addProductArgs,
+    handler: async (ctx, args) => {
+        return await insertProduct(ctx, args);
+    },
+});
+
+export const updateProduct = mutation({
     args: {
-        product_number: v.optional(v.string()),
-        product_name: v.string(),
-        car_name: v.string(),
-        model_number: v.string(),
-        type: v.string(),
-        quantity: v.number(),
-        price_iqd: v.number(),
-        wholesale_price_iqd: v.number(),
-        image: v.optional(v.string()),
-        original_quantity: v.optional(v.number()),
-        message_id: v.optional(v.number()),
-        status: v.optional(v.string()),
-        last_update: v.optional(v.string()),
+        id: v.id("products"),
+        updates: productUpdates,
     },
     handler: async (ctx, args) => {
-        let finalProductNumber = args.product_number;
+        await patchProduct(ctx, args.id, args.updates);
+    }
+});
 
-        if (finalProductNumber) {
-            const existing = await ctx.db
-                .query("products")
-                .withIndex("by_product_number", (q) => q.eq("product_number", finalProductNumber))
-                .first();
+export const adjustQuantity = mutation({
+    args: {
+        id: v.id("products"),
+        delta: v.number(),
+        clear: v.optional(v.boolean()),
+    },
+    handler: async (ctx, args) => {
+        return await applyQuantityDelta(ctx, args.id, args.delta, args.clear ?? false);
+    }
+});
 
-            if (existing) {
-                throw new Error("Product number already exists");
+// Several product writes in one round trip. Each op succeeds or fails on its own
+// and gets its own result ({ ok, value } or { ok: false, error }), in order.
+export const applyBatch = mutation({
+    args: {
+        ops: v.array(v.union(
+            v.object({ op: v.literal("add"), product: addProductArgs }),
+            v.object({ op: v.literal("update"), id: v.id("products"), updates: productUpdates }),
+            v.object({ op: v.literal("delete"), id: v.id("products") }),
+            v.object({ op: v.literal("adjust"), id: v.id("products"), delta: v.number(), clear: v.optional(v.boolean()) }),
+        ))
+    },
+    handler: async (ctx, args) => {
+        const results = [];
+        for (const op of args.ops) {
+            try {
+                if (op.op === "add") {
+                    results.push({ ok: true, value: await insertProduct(ctx, op.product) });
+                } else if (op.op === "update") {
+                    await patchProduct(ctx, op.id, op.updates);
+                    results.push({ ok: true, value: null });
+                } else if (op.op === "adjust") {
+                    results.push({ ok: true, value: await applyQuantityDelta(ctx, op.id, op.delta, op.clear ?? false) });
+                } else {
+                    await ctx.db.delete(op.id);
+                    results.push({ ok: true, value: null });
+                }
+            } catch (e) {
+                results.push({ ok: false, error: e instanceof Error ? e.message : String(e) });
             }
-        } else {
-            // Generate a unique product number if not provided
-            // PN-YYYYMMDD-RAND
-            const date = new Date().toISOString().slice(0, 10).replace(/-/g, '');
-            const rand = Math.random().toString(36).substring(2, 6).toUpperCase();
-            finalProductNumber = `PN-${date}-${rand}`;
         }
-
-        await ctx.db.insert("products", {
-            ...args,
-            product_number: finalProductNumber,
-            original_quantity: args.original_quantity ?? args.quantity,
-            status: args.status ?? (args.quantity > 0 ? "متوفر" : "نفذ"),
-            last_update: args.last_update ?? new Date().toISOString(),
-        });
-    },
+        return results;
+    }
 });
 
-export const updateProduct = mutation({
+export const importProducts = mutation({
     args: {
-        id: v.id("products"),
-        updates: v.object({
-            product_number: v.optional(v.string()),
-            product_name: v.optional(v.string()),
-            car_name: v.optional(v.string()),
-            model_number: v.optional(v.string()),
-            type: v.optional(v.string()),
-            quantity: v.optional(v.number()),
-            price_iqd: v.optional(v.number()),
-            wholesale_price_iqd: v.optional(v.number()),
+        products: v.array(v.object({
+            product_number: v.string(),
+            product_name: v.string(),
+            car_name: v.string(),
+            model_number: v.string(),
+            type: v.string(),
+            quantity: v.number(),
+            price_iqd: v.number(),
+            wholesale_price_iqd: v.number(),
             image: v.optional(v.string()),
+            thumbnail: v.optional(v.string()),
+            original_quantity: v.optional(v.number()),
             message_id: v.optional(v.number()),
-            status: v.optional(v.string()),
+            telegram_file_id: v.optional(v.string()),
+            telegram_photo: v.optional(v.string()),
             last_update: v.optional(v.string()),
-        })
+        }))
     },
     handler: async (ctx, args) => {
-        const product = await ctx.db.get(args.id);
-        if (!product) throw new Error("Product not found");
-
-        if (args.updates.product_number && args.updates.product_number !== product.product_number) {
+        // Upsert by product_number: only newer rows (by last_update) replace existing ones
+        const results = [];
+        for (const row of args.products) {
             const existing = await ctx.db
                 .query("products")
-                .withIndex("by_product_number", (q) => q.eq("product_number", args.updates.product_number))
+                .withIndex("by_product_number", (q) => q.eq("product_number", row.product_number))
                 .first();
+            const status = row.quantity > 0 ? "متوفر" : "نفذ";
+            const last_update = row.last_update ?? new Date().toISOString();
 
-            if (existing) {
-                throw new Error("New product number already exists");
+            if (!existing) {
+                const id = await ctx.db.insert("products", {
+                    ...row,
+                    original_quantity: row.original_quantity ?? row.quantity,
+                    status,
+                    last_update,
+                });
+                results.push({ product_number: row.product_number, action: "created", id, last_update });
+            } else if (last_update > existing.last_update) {
+                await ctx.db.patch(existing._id, { ...row, status, last_update });
+                results.push({ product_number: row.product_number, action: "updated", id: existing._id, last_update });
+            } else {
+                results.push({ product_number: row.product_number, action: "skipped", id: existing._id, last_update: existing.last_update });
             }
         }
-
-        const newQuantity = args.updates.quantity !== undefined ? args.updates.quantity : product.quantity;
-        const status = newQuantity > 0 ? "متوفر" : "نفذ";
-
-        await ctx.db.patch(args.id, {
-            ...args.updates,
-            status,
-            last_update: new Date().toISOString()
-        });
+        return results;
     }
 });
 
@@ -24,8 +24,11 @@ export default defineSchema({
         wholesale_price_iqd: v.number(),
         status: v.string(),
         image: v.optional(v.string()),
+        thumbnail: v.optional(v.string()),
         last_update: v.string(),
         message_id: v.optional(v.number()),
+        telegram_file_id: v.optional(v.string()),
+        telegram_photo: v.optional(v.string()),
     })
         .index("by_product_number", ["product_number"])
         .index("by_type", ["type"])
@@ -0,0 +1,151 @@
+"""
+Benchmark: dict-of-dicts catalog vs the optional columnar catalog.
+
+For each catalog size it builds synthetic products shaped like the Convex
+documents and compares:
+  memory     - bytes traced while building the product dicts vs the
+               ColumnarCatalog arrays (quantity, both prices, encoded
+               type / car_name)
+  aggregate  - backup/export statistics (price sums, wholesale sums,
+               counts per type) plus inventory value
+  filter     - counting products for a car + status + price-range filter
+
+Usage (from the repository root, with backend requirements and numpy):
+    python tools/bench_columnar.py --sizes 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+CARS = ["تويوتا كامري", "تويوتا كورولا", "هيونداي النترا", "كيا سبورتاج", "نيسان صني", "هوندا اكورد"]
+TYPES = ["فلتر", "بريك", "مساعد", "كشاف", "راديتر", "دينمو", "سلف"]
+
+
+def make_products(n: int) -> dict:
+    rng = random.Random(42)
+    products = {}
+    for i in range(n):
+        pn = str(100000 + i)
+        quantity = rng.randrange(0, 30)
+        products[pn] = {
+            "_id": f"k{i:024d}",
+            "_creationTime": 1.7e12 + i,
+            "product_number": pn,
+            "product_name": f"قطعة {i % 5000}",
+            "car_name": rng.choice(CARS),
+            "model_number": str(2000 + i % 25),
+            "type": rng.choice(TYPES),
+            "quantity": quantity,
+            "original_quantity": quantity + rng.randrange(0, 10),
+            "price_iqd": float(rng.randrange(1000, 500000, 250)),
+            "wholesale_price_iqd": float(rng.randrange(800, 400000, 250)),
+            "status": "متوفر" if quantity else "نفذ",
+            "last_update": "2026-01-01T00:00:00",
+        }
+    return products
+
+
+def python_aggregate(products: dict) -> dict:
+    by_type = {}
+    for p in products.values():
+        ptype = p.get("type", "غير محدد")
+        by_type[ptype] = by_type.get(ptype, 0) + 1
+    return {
+        "total_value": sum(p.get("price_iqd", 0) for p in products.values()),
+        "total_wholesale_value": sum(p.get("wholesale_price_iqd", 0) for p in products.values()),
+        "inventory_value": sum(p.get("price_iqd", 0) * p.get("quantity", 0) for p in products.values()),
+        "products_by_type": by_type,
+    }
+
+
+def columnar_aggregate(columns) -> dict:
+    totals = columns.totals()
+    return {
+        "total_value": totals["price_sum"],
+        "total_wholesale_value": totals["wholesale_sum"],
+        "inventory_value": totals["inventory_value"],
+        "products_by_type": columns.value_counts("type"),
+    }
+
+
+def python_filter(products: dict, car: str, low: float, high: float) -> int:
+    return sum(
+        1 for p in products.values()
+        if car in p.get("car_name", "").lower() and p.get("quantity", 0) > 0
+        and low <= (p.get("price_iqd") or 0) <= high
+    )
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(main, n: int, repeat: int):
+    tracemalloc.start()
+    products = make_products(n)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    columns = main.ColumnarCatalog()
+    columns.reset(products)
+    column_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    expected, got = python_aggregate(products), columnar_aggregate(columns)
+    assert expected["products_by_type"] == got["products_by_type"]
+    assert abs(expected["inventory_value"] - got["inventory_value"]) <= 1e-6 * expected["inventory_value"]
+    car = "كامري"
+    assert python_filter(products, car, 50000, 250000) == columns.count(
+        car_name=car, status="available", min_price=50000, max_price=250000)
+
+    py_agg = best_of(lambda: python_aggregate(products), repeat)
+    np_agg = best_of(lambda: columnar_aggregate(columns), repeat)
+    py_filter = best_of(lambda: python_filter(products, car, 50000, 250000), repeat)
+    np_filter = best_of(lambda: columns.count(car_name=car, status="available", min_price=50000, max_price=250000), repeat)
+
+    print(f"SKUs={n:,}")
+    print(f"  memory     dict {dict_bytes / 2**20:9.1f} MiB ({dict_bytes / n:6.0f} B/SKU)   "
+          f"columnar {column_bytes / 2**20:7.1f} MiB ({column_bytes / n:4.0f} B/SKU)")
+    print(f"  aggregate  dict {py_agg * 1000:9.1f} ms   columnar {np_agg * 1000:7.2f} ms   x{py_agg / np_agg:5.0f}")
+    print(f"  filter     dict {py_filter * 1000:9.1f} ms   columnar {np_filter * 1000:7.2f} ms   x{py_filter / np_filter:5.0f}")
+    del products, columns
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Isolate the app from real services and from the working tree
+    os.environ["COLUMNAR_CATALOG"] = "true"
+    os.environ["TELEGRAM_BOT_TOKEN"] = ""
+    os.environ["TELEGRAM_CHAT_ID"] = ""
+    os.chdir(tempfile.mkdtemp(prefix="carstock-bench-"))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import logging
+    import main
+    logging.disable(logging.INFO)
+
+    if main.columnar_catalog is None:
+        sys.exit("numpy is required for this benchmark")
+    for n in args.sizes:
+        run(main, n, args.repeat)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,153 @@
+"""
+Benchmark: event-loop blocking by synchronous Convex calls.
+
+Runs mixed traffic against the FastAPI app in-process (no network):
+closed-loop clients sending slow requests that hit Convex
+(GET /api/products with the snapshot disabled) and an open-loop stream
+of cheap requests (GET /api/health) at --fast-rate per second. Convex is
+replaced by a stub that sleeps for --latency seconds per call.
+
+Two modes are compared:
+  blocking  - Convex calls run inline on the event loop (old behaviour)
+  threaded  - Convex calls go through run_db() (bounded thread pool)
+
+Usage (from the repository root, with backend requirements installed):
+    python tools/bench_event_loop.py --latency 0.15 --duration 5
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+class StubConvex:
+    """Blocking stand-in for ConvexClient with a fixed per-call latency."""
+
+    def __init__(self, latency: float, products: int):
+        self.latency = latency
+        self.products = [
+            {
+                "_id": f"id{i}",
+                "product_number": str(i),
+                "product_name": f"part {i}",
+                "car_name": "car",
+                "model_number": "",
+                "type": "type",
+                "quantity": i % 7,
+                "price_iqd": 1000.0 + i,
+                "wholesale_price_iqd": 900.0 + i,
+                "status": "متوفر",
+                "last_update": "2026-01-01T00:00:00",
+            }
+            for i in range(products)
+        ]
+
+    def query(self, name, args=None):
+        time.sleep(self.latency)
+        return list(self.products)
+
+    def mutation(self, name, args=None):
+        time.sleep(self.latency)
+        return None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[k]
+
+
+async def run_mode(main, mode: str, duration: float, slow_clients: int, fast_rate: float):
+    import httpx
+
+    if mode == "blocking":
+        async def inline(func, *args, **kwargs):
+            return func(*args, **kwargs)
+        main.run_db = inline
+    else:
+        main.run_db = original_run_db
+
+    latencies = {"slow": [], "fast": []}
+    transport = httpx.ASGITransport(app=main.app)
+    deadline = time.perf_counter() + duration
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def slow_worker():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                resp = await client.get("/api/products")
+                resp.raise_for_status()
+                latencies["slow"].append(time.perf_counter() - start)
+
+        async def fast_request(scheduled: float):
+            # Open loop: latency is measured from the scheduled send time, so
+            # time spent waiting for a blocked event loop is counted.
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            resp = await client.get("/api/health")
+            resp.raise_for_status()
+            latencies["fast"].append(time.perf_counter() - scheduled)
+
+        begin = time.perf_counter()
+        interval = 1.0 / fast_rate
+        schedule = [begin + i * interval for i in range(int(duration * fast_rate))]
+        await asyncio.gather(
+            *[slow_worker() for _ in range(slow_clients)],
+            *[fast_request(t) for t in schedule],
+        )
+    return latencies
+
+
+def report(mode: str, latencies: dict):
+    for kind in ("fast", "slow"):
+        values = latencies[kind]
+        print(
+            f"{mode:9s} {kind:4s} n={len(values):5d} "
+            f"p50={percentile(values, 50) * 1000:8.1f}ms "
+            f"p99={percentile(values, 99) * 1000:8.1f}ms "
+            f"mean={(statistics.mean(values) if values else 0) * 1000:8.1f}ms"
+        )
+
+
+def main_cli():
+    global original_run_db
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.15, help="simulated Convex latency per call (s)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per mode")
+    parser.add_argument("--slow-clients", type=int, default=4)
+    parser.add_argument("--fast-rate", type=float, default=100.0, help="cheap requests per second")
+    parser.add_argument("--products", type=int, default=500)
+    args = parser.parse_args()
+
+    # Isolate the app from real services and from the working tree
+    os.environ["CATALOG_CACHE_TTL"] = "0"
+    os.environ["TELEGRAM_BOT_TOKEN"] = ""
+    os.environ["TELEGRAM_CHAT_ID"] = ""
+    os.chdir(tempfile.mkdtemp(prefix="carstock-bench-"))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import logging
+    import main
+    logging.disable(logging.INFO)
+
+    main.convex_client = StubConvex(args.latency, args.products)
+    original_run_db = main.run_db
+
+    print(f"latency={args.latency}s duration={args.duration}s slow={args.slow_clients} "
+          f"fast_rate={args.fast_rate}/s pool={main.CONVEX_MAX_CONCURRENCY}")
+    for mode in ("blocking", "threaded"):
+        latencies = asyncio.run(run_mode(main, mode, args.duration, args.slow_clients, args.fast_rate))
+        report(mode, latencies)
+
+
+original_run_db = None
+
+if __name__ == "__main__":
+    main_cli()